@@ -0,0 +1,109 @@
+"""
+Compares the storage codecs on voucher documents of different sizes: time to encode and decode
+one document, and its size plain and compressed. Run it with:
+
+    PYTHONPATH=src python benchmarks/codec_speed.py
+"""
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+import pytz
+import yaml
+
+import storage_codecs
+from storage_codecs import JsonCodec, YamlCodec
+
+BERLIN = pytz.timezone("Europe/Berlin")
+
+
+def voucher_document(vouchers: int, seed: int = 0) -> dict:
+    """A voucher document like it looks late in the voucher phase, with a long history"""
+    rng = random.Random(seed)
+    start = BERLIN.localize(datetime(2024, 12, 1, 10))
+    users = [f"user{i}" for i in range(vouchers * 2)]
+    data = {
+        "voucher": [],
+        "queue": rng.sample(users, min(len(users), 50)),
+        "demand": {user: rng.randint(0, 3) for user in users},
+        "total_persons_reported": vouchers * 3,
+        "voucher_topics": {"38C3": 12345},
+        "voucher_phase_range": {
+            "38C3": {"start": start, "end": start + timedelta(days=26)}
+        },
+        "voucher_history_image": {
+            "38C3": {"id": 1, "short_url": "upload://abc.png", "url": "/uploads/a.png"}
+        },
+    }
+    for i in range(vouchers):
+        history = []
+        received_at = start
+        for _ in range(rng.randint(1, 12)):
+            received_at += timedelta(hours=rng.randint(1, 30))
+            history.append(
+                {
+                    "username": rng.choice(users),
+                    "received_at": received_at.isoformat(),
+                    "returned_at": (received_at + timedelta(hours=20)).isoformat(),
+                }
+            )
+        data["voucher"].append(
+            {
+                "index": i,
+                "voucher": f"CHAOS{rng.getrandbits(40):010x}",
+                "owner": history[-1]["username"],
+                "old_owner": history[-2]["username"] if len(history) > 1 else None,
+                "message_id": 10000 + i,
+                "persons": 1,
+                "received_at": received_at,
+                "checked_post_number": rng.randint(1, 8),
+                "offered_to": [],
+                "history": history,
+            }
+        )
+    return data
+
+
+def best_of(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    codecs = {
+        "yaml (pure python)": YamlCodec(use_libyaml=False),
+        "yaml (libyaml)": YamlCodec(),
+        "json": JsonCodec(),
+    }
+    print(f"libyaml available: {yaml.__with_libyaml__}")
+    print(
+        f"{'vouchers':>8} {'codec':>20} {'encode':>10} {'decode':>10} {'size':>10} {'zlib':>10}"
+    )
+    for size in args.sizes:
+        data = voucher_document(size)
+        for name, codec in codecs.items():
+            document = codec.dumps(data)
+            assert codec.loads(document) == data
+            encode = best_of(lambda: codec.dumps(data), args.repeat)
+            decode = best_of(lambda: codec.loads(document), args.repeat)
+            compressed = storage_codecs.encode(data, codec.name, compress=True)
+            print(
+                f"{size:>8} {name:>20} {encode * 1000:>8.1f}ms {decode * 1000:>8.1f}ms "
+                f"{len(document.encode()) / 1024:>8.1f}kB "
+                f"{len(compressed.encode()) / 1024:>8.1f}kB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Runs the per-minute jobs end-to-end against the in-process fake Discourse with a large inbox
+and many assigned vouchers, and reports how long each job took and how many requests it made.
+
+    PYTHONPATH=src:. python benchmarks/load_test.py --pms 2000 --vouchers 300 --latency 0.05
+"""
+
+import argparse
+import os
+import time
+
+import yaml
+
+os.environ.setdefault("DISCOURSE_API_KEY", "load-test")
+os.environ.setdefault("DISCOURSE_USERNAME", "flipbot")
+os.environ.setdefault("FORCE_VOUCHER_PHASE", "true")
+
+import app  # noqa: E402
+import constants  # noqa: E402
+import tasks.plenum.remind  # noqa: E402
+import tasks.voucher  # noqa: E402
+from client import DiscourseStorageClient, RequestScheduler  # noqa: E402
+from metrics import request_metrics  # noqa: E402
+from tests.fake_discourse import FakeDiscourse  # noqa: E402
+
+UNLIMITED = float("inf")
+
+
+def populate(fake: FakeDiscourse, pms: int, vouchers: int) -> None:
+    bot = fake.username
+    # Old conversations the bot already answered
+    for i in range(pms):
+        topic = fake.create_topic(
+            f"Frage {i}", "Hallo?", username=f"user{i}", recipients=[bot]
+        )
+        fake.create_post(topic.id, "Hallo!", bot)
+
+    voucher_list = []
+    for i in range(vouchers):
+        owner = f"owner{i}"
+        topic = fake.create_topic("Dein Voucher", f"CHAOS{i:04d}", recipients=[owner])
+        voucher_list.append(
+            {
+                "index": i,
+                "voucher": f"CHAOS{i:04d}",
+                "owner": owner,
+                "old_owner": bot,
+                "message_id": topic.id,
+                "persons": 1,
+                "history": [
+                    {"username": owner, "received_at": "2024-11-01T10:00:00+01:00"}
+                ],
+            }
+        )
+    congress_id = tasks.voucher.get_congress_id()
+    voucher_topic = fake.create_topic(
+        f"Voucher {congress_id}",
+        "Voucher",
+        category_id=fake.categories[constants.CCC_CATEGORY_NAME],
+    )
+    fake.create_topic(
+        "STORAGE_voucher",
+        yaml.safe_dump(
+            {
+                "voucher": voucher_list,
+                "queue": [],
+                "demand": {},
+                "voucher_topics": {congress_id: voucher_topic.id},
+            }
+        ),
+        recipients=[bot],
+    )
+
+
+def run_job(name: str, fake: FakeDiscourse, job, *args) -> None:
+    fake.requests.clear()
+    request_metrics.reset()
+    start = time.perf_counter()
+    job(*args)
+    duration = time.perf_counter() - start
+    print(f"{name:>28}: {duration:7.2f} s, {len(fake.requests):5d} requests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pms", type=int, default=2000)
+    parser.add_argument("--vouchers", type=int, default=300)
+    parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per response"
+    )
+    parser.add_argument("--ticks", type=int, default=2)
+    args = parser.parse_args()
+
+    with FakeDiscourse(
+        username=constants.DISCOURSE_CREDENTIALS["api_username"],
+        categories={constants.CCC_CATEGORY_NAME: 17, "orga/plena": 23, "test": 24},
+    ) as fake:
+        populate(fake, args.pms, args.vouchers)
+        fake.latency = args.latency
+        client = DiscourseStorageClient(
+            host=fake.url,
+            api_username=fake.username,
+            api_key="load-test",
+            # The load test measures our side, not the forum's rate limits
+            scheduler=RequestScheduler(
+                read_rate=UNLIMITED,
+                read_burst=UNLIMITED,
+                write_rate=UNLIMITED,
+                write_burst=UNLIMITED,
+            ),
+        )
+
+        for tick in range(args.ticks):
+            print(f"Tick {tick + 1}")
+            run_job("tasks.voucher.main", fake, tasks.voucher.main, client)
+            run_job("fetch_unread_messages", fake, app.fetch_unread_messages, client)
+            run_job("tasks.plenum.remind.main", fake, tasks.plenum.remind.main, client)
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
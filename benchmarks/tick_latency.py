@@ -0,0 +1,123 @@
+"""
+Measures the latency of one simulated `tasks.voucher.main` tick against a local stand-in server.
+
+The stand-in server sleeps once per *new connection* to emulate the TCP + TLS handshake
+we pay when talking to the real forum. Run it with:
+
+    PYTHONPATH=src python benchmarks/tick_latency.py
+"""
+
+import argparse
+import json
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from client import DiscourseStorageClient, RequestScheduler
+
+HANDSHAKE_DELAY = 0.03
+UNLIMITED = float("inf")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, avoid waiting for delayed ACKs on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        time.sleep(HANDSHAKE_DELAY)
+
+    def _reply(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        body = json.dumps(
+            {
+                "id": 1,
+                "topic_id": 1,
+                "yours": True,
+                "raw": "voucher: []\n",
+                "topics": [{"id": 1, "title": "STORAGE_voucher"}],
+                "topic_list": {"topics": []},
+                "post_stream": {"posts": [{"id": 1}]},
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class UnpooledClient(DiscourseStorageClient):
+    """Behaves like upstream pydiscourse: a new connection for every request."""
+
+    def _send(self, verb, url, **request_kwargs):
+        return requests.request(verb, url, **request_kwargs)
+
+
+def simulate_tick(client: DiscourseStorageClient) -> None:
+    # Roughly the requests `tasks.voucher.main` makes with one assigned voucher
+    client.search("STORAGE_voucher")
+    client.posts(1)
+    client.single_post(1)
+    client.posts(2)
+    client.update_post(1, "voucher: []")
+    client.category_topics("ccc")
+    client.single_post(1)
+    client.topic_posts(1)
+    client.update_post(2, "content")
+    client.update_post(1, "voucher: []")
+
+
+def measure(client: DiscourseStorageClient, ticks: int) -> list[float]:
+    durations = []
+    for _ in range(ticks):
+        start = time.perf_counter()
+        simulate_tick(client)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ticks", type=int, default=20)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_port}"
+    credentials = {"host": host, "api_username": "bench", "api_key": "bench"}
+
+    def unlimited():
+        # The benchmark measures the connections, not the forum's rate limits
+        return RequestScheduler(
+            read_rate=UNLIMITED,
+            read_burst=UNLIMITED,
+            write_rate=UNLIMITED,
+            write_burst=UNLIMITED,
+        )
+
+    before = measure(UnpooledClient(**credentials, scheduler=unlimited()), args.ticks)
+    pooled_client = DiscourseStorageClient(**credentials, scheduler=unlimited())
+    after = measure(pooled_client, args.ticks)
+    pooled_client.close()
+    server.shutdown()
+
+    for name, durations in (("fresh connections", before), ("pooled session", after)):
+        print(
+            f"{name:>18}: median {statistics.median(durations) * 1000:7.1f} ms, "
+            f"max {max(durations) * 1000:7.1f} ms per tick"
+        )
+
+
+if __name__ == "__main__":
+    main()
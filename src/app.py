@@ -1,16 +1,44 @@
 import argparse
 import logging
+import re
 import sys
+from datetime import timedelta
 from typing import Optional
 
-from client import DiscourseClient, DiscourseStorageClient
+from client import (
+    DiscourseClient,
+    DiscourseStorageClient,
+    RequestScheduler,
+    SQLiteStorage,
+)
 from pydiscourse.exceptions import DiscourseClientError
 
-from constants import DISCOURSE_CREDENTIALS, SENTRY_DSN
+from constants import (
+    DISCOURSE_CREDENTIALS,
+    DISCOURSE_HTTP_OPTIONS,
+    DISCOURSE_MAX_POST_LENGTH,
+    DISCOURSE_RATE_LIMITS,
+    DISCOURSE_STORAGE_CACHE_TTL,
+    DISCOURSE_STORAGE_MISSING_TTL,
+    METRICS_FILE,
+    SENTRY_DSN,
+    STORAGE_BACKEND,
+    STORAGE_CODEC,
+    STORAGE_COMPRESS,
+    STORAGE_JOURNAL,
+    STORAGE_JOURNAL_COMPACT_AFTER,
+    STORAGE_MIRROR,
+    STORAGE_SHARDING,
+    STORAGE_SNAPSHOT_PATH,
+    STORAGE_SQLITE_PATH,
+    WEBHOOK_HOST,
+    WEBHOOK_POLL_MINUTES,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+)
 from time import sleep
 
 import locale
-import schedule
 import tasks.voucher
 import tasks.plenum.announce
 import tasks.plenum.remind
@@ -18,7 +46,11 @@ import tasks.plenum.post_protocol
 
 import sentry_sdk
 
+from inbox import INBOX_STORAGE_KEY, InboxSync
+from job_scheduler import JobScheduler
 from mailing import read_emails
+from metrics import request_metrics
+from webhooks import WebhookEvent, WebhookServer
 
 logging.basicConfig(
     format="%(asctime)s - %(levelname)s: %(message)s", level=logging.INFO
@@ -60,40 +92,129 @@ def disable_request(
 
 
 def fetch_unread_messages(client: DiscourseStorageClient):
-    # TODO: Something is still wrong about the unseen thingy. Dunno when it get's set.
-    topics = [
-        t
-        for t in client.private_messages()["topic_list"]["topics"]
-        if t["unseen"]
-        or t["last_read_post_number"] is None
-        or t["highest_post_number"] > t["last_read_post_number"]
-    ]
-    for topic in topics:
-        posts = client.topic_posts(topic["id"])
-        was_handled = tasks.voucher.private_message_handler(client, topic, posts)
-
-        if not was_handled:
-            client.create_post(
-                "Es tut mir leid, aber ich verstehe nicht, was du möchtest. "
-                "Du kannst mir gerne in diesem Thread antworten und es nochmal probieren.",
-                topic_id=topic["id"],
-            )
-
-
-def schedule_jobs(client: DiscourseStorageClient) -> None:
-    # TODO: timezone is not correct, quickfix by subtracting an hour
-    schedule.every().day.at("12:37").do(tasks.plenum.announce.main, client)
-    schedule.every().day.at("12:37").do(tasks.plenum.remind.main, client)
-    schedule.every().day.at("20:00").do(tasks.plenum.post_protocol.main, client)
-
-    schedule.every(12).hours.do(tasks.voucher.update_history_image, client)
-    schedule.every().minute.do(tasks.voucher.main, client)
-    schedule.every().minute.do(fetch_unread_messages, client)
-    schedule.every().minute.do(read_emails, client, days_back=1)
-
-    # schedule.every(15).seconds.do(fetch_unread_messages, client)
-    # schedule.every(15).seconds.do(tasks.voucher.main, client)
-    # schedule.every(15).seconds.do(tasks.voucher.update_history_image, client)
+    inbox = InboxSync(client)
+    try:
+        # Handle the threads one after another since the handlers modify the storage
+        for topic, posts in inbox.pending():
+            was_handled = tasks.voucher.private_message_handler(client, topic, posts)
+
+            if not was_handled:
+                client.create_post(
+                    "Es tut mir leid, aber ich verstehe nicht, was du möchtest. "
+                    "Du kannst mir gerne in diesem Thread antworten und es nochmal probieren.",
+                    topic_id=topic["id"],
+                )
+            inbox.mark_handled(topic)
+    finally:
+        inbox.save()
+
+
+def dispatch_webhook_event(client: DiscourseStorageClient, event: WebhookEvent) -> None:
+    if event.name == "post_created":
+        post = event.payload["post"]
+        topic_id = post["topic_id"]
+        archetype = post.get("topic_archetype")
+        author = post["username"]
+    else:
+        topic = event.payload["topic"]
+        topic_id = topic["id"]
+        archetype = topic.get("archetype")
+        author = topic.get("created_by", {}).get("username")
+
+    if author == client.api_username or archetype == "regular":
+        # Our own posts and public topics need no reaction
+        return
+    # A post in a voucher thread may return the code, but also be a question or a command,
+    # so the inbox handles it as well
+    tasks.voucher.handle_voucher_thread_post(client, topic_id)
+    # The inbox sync only fetches the new posts and remembers what was handled, so
+    # the polling fallback won't answer the same message again
+    fetch_unread_messages(client)
+
+
+def log_client_stats(client: DiscourseStorageClient) -> None:
+    if client.response_cache:
+        logging.info(f"Response cache: {client.response_cache.stats()}")
+    logging.info(f"Request scheduler: {client.scheduler.stats()}")
+    logging.info(f"Storage: {client.storage.stats()}")
+
+
+def client_gauges(client: DiscourseStorageClient) -> dict[str, float]:
+    gauges = {}
+    if client.response_cache:
+        for name, value in client.response_cache.stats().items():
+            gauges[f"response_cache_{name}"] = value
+    for kind, stats in client.scheduler.stats().items():
+        for name in ("tokens", "queued", "throttled", "rate_limited"):
+            gauges[f"scheduler_{kind}_{name}"] = stats[name]
+    for name, value in client.storage.stats().items():
+        gauges[f"storage_{name}"] = value
+    return gauges
+
+
+def job_gauges(scheduler: JobScheduler) -> dict[str, float]:
+    gauges = {}
+    for name, stats in scheduler.stats().items():
+        prefix = "job_" + re.sub(r"\W", "_", name)
+        for stat in ("lateness_seconds", "max_lateness_seconds", "failures"):
+            gauges[f"{prefix}_{stat}"] = stats[stat]
+    return gauges
+
+
+def write_metrics(client: DiscourseStorageClient, scheduler: JobScheduler) -> None:
+    request_metrics.write(
+        METRICS_FILE, gauges={**client_gauges(client), **job_gauges(scheduler)}
+    )
+
+
+# Storage keys which jobs read and write back later, see `schedule_jobs`
+LOCKED_STORAGE_KEYS = ("voucher", INBOX_STORAGE_KEY, "NEXT_PLENUM_TOPICS")
+# Resources of the webhook handler, which may answer a PM or change the vouchers
+WEBHOOK_RESOURCES = (f"storage:{INBOX_STORAGE_KEY}", "storage:voucher")
+
+
+def schedule_jobs(
+    client: DiscourseStorageClient, scheduler: JobScheduler, poll_minutes: int = 1
+) -> None:
+    # Jobs run in parallel, unless they declare the same resource. A storage resource is the
+    # key's lock, which storage transactions hold as well.
+    for key in LOCKED_STORAGE_KEYS:
+        scheduler.locks.register(f"storage:{key}", client.storage.lock(key))
+
+    # Wall-clock times in Europe/Berlin
+    plenum = ("storage:NEXT_PLENUM_TOPICS",)
+    scheduler.daily("13:37", tasks.plenum.announce.main, client, resources=plenum)
+    scheduler.daily("13:37", tasks.plenum.remind.main, client)
+    scheduler.daily("21:00", tasks.plenum.post_protocol.main, client, resources=plenum)
+
+    voucher = ("storage:voucher",)
+    scheduler.every(
+        timedelta(hours=12),
+        tasks.voucher.update_history_image,
+        client,
+        resources=voucher,
+    )
+    # With webhooks, polling only catches up on missed events
+    scheduler.every(
+        timedelta(minutes=poll_minutes), tasks.voucher.main, client, resources=voucher
+    )
+    scheduler.every(
+        timedelta(minutes=poll_minutes),
+        fetch_unread_messages,
+        client,
+        resources=WEBHOOK_RESOURCES,
+    )
+    # Its voucher updates are transactions, which wait for the voucher jobs
+    scheduler.every(
+        timedelta(minutes=1), read_emails, client, days_back=1, resources=("imap",)
+    )
+    scheduler.every(timedelta(hours=1), log_client_stats, client)
+    if METRICS_FILE:
+        scheduler.every(timedelta(minutes=1), write_metrics, client, scheduler)
+
+    # scheduler.every(timedelta(seconds=15), fetch_unread_messages, client)
+    # scheduler.every(timedelta(seconds=15), tasks.voucher.main, client)
+    # scheduler.every(timedelta(seconds=15), tasks.voucher.update_history_image, client)
 
     tasks.plenum.announce.main(client)
     tasks.plenum.remind.main(client)
@@ -127,7 +248,36 @@ def main():
 
     args = parser.parse_args()
 
-    client = DiscourseStorageClient(**DISCOURSE_CREDENTIALS)
+    storage_options = {
+        "codec": STORAGE_CODEC,
+        "compress": STORAGE_COMPRESS,
+        "max_post_length": DISCOURSE_MAX_POST_LENGTH,
+        "journal": STORAGE_JOURNAL,
+        "journal_compact_after": STORAGE_JOURNAL_COMPACT_AFTER,
+    }
+    storage_config = {
+        "storage_options": {**storage_options, "snapshot_path": STORAGE_SNAPSHOT_PATH}
+    }
+    if STORAGE_BACKEND == "sqlite":
+        storage_config = {
+            "storage_cls": SQLiteStorage,
+            "storage_options": {
+                "path": STORAGE_SQLITE_PATH,
+                "mirror": STORAGE_MIRROR,
+                **storage_options,
+            },
+        }
+    client = DiscourseStorageClient(
+        **DISCOURSE_CREDENTIALS,
+        **DISCOURSE_HTTP_OPTIONS,
+        scheduler=RequestScheduler(**DISCOURSE_RATE_LIMITS),
+        storage_cache_ttl=DISCOURSE_STORAGE_CACHE_TTL,
+        storage_missing_ttl=DISCOURSE_STORAGE_MISSING_TTL,
+        storage_layouts=(
+            {"voucher": tasks.voucher.STORAGE_LAYOUT} if STORAGE_SHARDING else None
+        ),
+        **storage_config,
+    )
     if args.dry:
         disable_request(client, "POST")
         disable_request(client, "PUT")
@@ -153,16 +303,39 @@ def main():
         task.main(client)
         sys.exit()
 
-    schedule_jobs(client)
+    scheduler = JobScheduler()
+    webhook_server = None
+    if WEBHOOK_PORT:
+        webhook_server = WebhookServer(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET)
+        webhook_server.start()
+        schedule_jobs(client, scheduler, poll_minutes=WEBHOOK_POLL_MINUTES)
+    else:
+        schedule_jobs(client, scheduler)
 
-    for job in schedule.jobs:
+    for job in scheduler.jobs:
         logging.info(f"Scheduled job: {job}")
     while True:
         try:
-            schedule.run_pending()
-            sleep(1)
+            scheduler.run_pending()
+            # Sleep until the next job is due, webhooks wake us up earlier
+            if webhook_server:
+                webhook_server.handle_pending(
+                    lambda event: scheduler.submit(
+                        dispatch_webhook_event,
+                        client,
+                        event,
+                        resources=WEBHOOK_RESOURCES,
+                    ),
+                    timeout=scheduler.wait_time(),
+                )
+            else:
+                sleep(scheduler.wait_time())
         except KeyboardInterrupt:
             logging.info("Shutting down")
+            if webhook_server:
+                webhook_server.stop()
+            scheduler.shutdown()
+            client.close()
             sys.exit(0)
 
 
@@ -1,11 +1,42 @@
-from typing import Dict
+import asyncio
+import copy
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator
+from urllib.parse import urlencode
 from abc import ABC, abstractmethod
 
+import requests
 from pydiscourse import DiscourseClient
-import yaml
+from pydiscourse.exceptions import (
+    DiscourseClientError,
+    DiscourseError,
+    DiscourseRateLimitedError,
+    DiscourseServerError,
+)
+from requests.adapters import HTTPAdapter
 
 from logging import getLogger
 
+import storage_codecs
+import storage_journal
+from metrics import endpoint_label, request_metrics
+
 logger = getLogger(__name__)
 
 
@@ -13,13 +44,439 @@ class DiscourseStorageError(Exception):
     pass
 
 
+class StorageConflictError(DiscourseStorageError):
+    """The stored value was changed by someone else since we read it"""
+
+
+# Default for `expected_revision`: write without checking what's stored
+ANY_REVISION = object()
+
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+
+
+@dataclass
+class CachedResponse:
+    etag: str | None
+    last_modified: str | None
+    body: bytes
+
+
+class ResponseCache:
+    """
+    Remembers the validators (ETag / Last-Modified) and bodies of GET responses, so
+    we can send conditional requests and reuse the body when Discourse answers with 304.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, CachedResponse] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(url: str, params: dict | None) -> str:
+        if not params:
+            return url
+        return f"{url}?{urlencode(sorted(params.items()), doseq=True)}"
+
+    def conditional_headers(self, key: str) -> dict:
+        with self._lock:
+            entry = self._entries.get(key)
+        if not entry:
+            return {}
+        headers = {}
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def hit(self, key: str):
+        """Returns the decoded cached body for a 304 response, or None if we don't know the URL (anymore)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += len(entry.body)
+        # Decoding the cached body is cheaper than deep copying a decoded object,
+        # and callers are free to modify what we return.
+        return json.loads(entry.body)
+
+    def store(self, key: str, response: requests.Response) -> None:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        with self._lock:
+            self.misses += 1
+            if not (etag or last_modified):
+                self._entries.pop(key, None)
+                return
+            self._entries[key] = CachedResponse(etag, last_modified, response.content)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+class RequestPriority(IntEnum):
+    """Lower values are sent first when requests have to wait for the rate limit."""
+
+    VOUCHER_DELIVERY = 0
+    DEFAULT = 1
+    NOTIFICATION = 2
+
+
+# Context variables are inherited by `asyncio.to_thread`, so the priority also applies
+# to requests that AsyncDiscourseStorageClient runs in worker threads.
+_request_priority: ContextVar[RequestPriority] = ContextVar(
+    "request_priority", default=RequestPriority.DEFAULT
+)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        """
+        :param rate: tokens refilled per second
+        :param capacity: maximum number of tokens, i.e. the allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.blocked_until = 0.0
+        self.clock = clock
+        self._updated = clock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def delay(self) -> float:
+        """Seconds until a token can be taken. 0 if one is available right now."""
+        now = self.clock()
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self._refill(self.clock())
+        self.tokens -= 1
+
+    def block(self, seconds: float) -> None:
+        """Discourse told us to back off. No tokens are handed out until then."""
+        self.blocked_until = max(self.blocked_until, self.clock() + seconds)
+        self.tokens = 0
+
+
+class RequestScheduler:
+    """
+    Paces requests to Discourse with separate token buckets for reads (GET) and writes.
+    With `total_rate`, every request also takes a token from a bucket shared by reads and
+    writes, since Discourse limits all requests of a user together.
+    Requests waiting for a token are served by priority, then in order of arrival.
+    """
+
+    def __init__(
+        self,
+        read_rate: float = 1.0,
+        read_burst: float = 20,
+        write_rate: float = 0.5,
+        write_burst: float = 10,
+        total_rate: float | None = None,
+        total_burst: float = 10,
+        clock=time.monotonic,
+    ):
+        self.buckets = {
+            "read": TokenBucket(read_rate, read_burst, clock),
+            "write": TokenBucket(write_rate, write_burst, clock),
+        }
+        self.total = TokenBucket(total_rate, total_burst, clock) if total_rate else None
+        self._condition = threading.Condition()
+        self._waiting: dict[str, list[tuple[int, int]]] = {"read": [], "write": []}
+        self._sequence = itertools.count()
+        self.throttled = {"read": 0, "write": 0}
+        self.rate_limited = {"read": 0, "write": 0}
+
+    @staticmethod
+    def kind(verb: str) -> str:
+        return "read" if verb == "GET" else "write"
+
+    def acquire(self, verb: str, priority: RequestPriority) -> None:
+        kind = self.kind(verb)
+        bucket = self.buckets[kind]
+        queue = self._waiting[kind]
+        ticket = (int(priority), next(self._sequence))
+        with self._condition:
+            heapq.heappush(queue, ticket)
+            try:
+                was_throttled = False
+                while True:
+                    timeout = None
+                    if queue[0] == ticket:
+                        timeout = bucket.delay()
+                        if self.total:
+                            timeout = max(timeout, self.total.delay())
+                        if timeout <= 0:
+                            bucket.take()
+                            if self.total:
+                                self.total.take()
+                            return
+                    if not was_throttled:
+                        was_throttled = True
+                        self.throttled[kind] += 1
+                    self._condition.wait(timeout)
+            finally:
+                queue.remove(ticket)
+                heapq.heapify(queue)
+                self._condition.notify_all()
+
+    def back_off(self, verb: str, seconds: float) -> None:
+        kind = self.kind(verb)
+        with self._condition:
+            self.rate_limited[kind] += 1
+            self.buckets[kind].block(seconds)
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                kind: {
+                    "tokens": round(self.buckets[kind].tokens, 2),
+                    "queued": len(self._waiting[kind]),
+                    "queued_by_priority": {
+                        priority.name: sum(
+                            1 for p, _ in self._waiting[kind] if p == priority
+                        )
+                        for priority in RequestPriority
+                    },
+                    "throttled": self.throttled[kind],
+                    "rate_limited": self.rate_limited[kind],
+                }
+                for kind in self.buckets
+            }
+
+
+def retry_after_seconds(response: requests.Response, default: float) -> float:
+    """Reads how long Discourse wants us to wait from the Retry-After header or the response body."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    try:
+        return float(response.json()["extras"]["wait_seconds"])
+    except (ValueError, TypeError, KeyError):
+        return default
+
+
 class DiscourseStorageClient(DiscourseClient):
     def __init__(
-        self, *args, storage_cls: type["BaseDiscourseStorage"] | None = None, **kwargs
+        self,
+        *args,
+        storage_cls: type["BaseDiscourseStorage"] | None = None,
+        storage_options: dict | None = None,
+        storage_layouts: dict[str, "ShardLayout"] | None = None,
+        pool_connections: int = 4,
+        pool_maxsize: int = 8,
+        response_cache_size: int = 256,
+        scheduler: RequestScheduler | None = None,
+        storage_cache_ttl: float = 10.0,
+        storage_missing_ttl: float = 300.0,
+        **kwargs,
     ):
+        """
+        :param storage_cls: backend for `self.storage`, DiscourseStorage by default
+        :param storage_options: additional keyword arguments for `storage_cls`
+        :param storage_layouts: keys whose values are split into separately stored shards
+        :param pool_connections: number of hosts we keep a connection pool for
+        :param pool_maxsize: number of keep-alive connections kept per host
+        :param response_cache_size: number of GET responses kept for conditional requests, 0 disables the cache
+        :param scheduler: paces requests to stay within the forum's rate limits
+        :param storage_cache_ttl: seconds a stored value is used without checking the post's revision
+        :param storage_missing_ttl: seconds we remember that a storage key doesn't exist before searching again
+        """
         super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or RequestScheduler()
+        self.storage_cache_ttl = storage_cache_ttl
+        self.storage_missing_ttl = storage_missing_ttl
+        self.pool_maxsize = pool_maxsize
+        self.session = self._create_session(pool_connections, pool_maxsize)
+        self.response_cache = (
+            ResponseCache(response_cache_size) if response_cache_size else None
+        )
         storage_cls = storage_cls or DiscourseStorage
-        self.storage: BaseDiscourseStorage = storage_cls(self)
+        self.storage: BaseDiscourseStorage = storage_cls(
+            self, **(storage_options or {})
+        )
+        if storage_layouts:
+            self.storage = ShardedStorage(self.storage, storage_layouts)
+
+    @staticmethod
+    def _create_session(pool_connections: int, pool_maxsize: int) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self) -> None:
+        self.storage.close()
+        self.session.close()
+
+    @contextmanager
+    def request_priority(self, priority: RequestPriority):
+        """All requests made inside this block use the given priority."""
+        token = _request_priority.set(priority)
+        try:
+            yield
+        finally:
+            _request_priority.reset(token)
+
+    def _send(self, verb: str, url: str, **request_kwargs) -> requests.Response:
+        endpoint = f"{verb} {endpoint_label(url.removeprefix(self.host))}"
+        with request_metrics.track("discourse", endpoint) as call:
+            response = self.session.request(verb, url, **request_kwargs)
+            call.response(response)
+        return response
+
+    def _request(
+        self,
+        verb,
+        path,
+        params=None,
+        files=None,
+        data=None,
+        json=None,
+        override_request_kwargs=None,
+    ):
+        # Same behaviour as DiscourseClient._request, but all requests go through our
+        # pooled session, so consecutive calls reuse the same keep-alive connection
+        # instead of doing a new TCP + TLS handshake every time.
+        override_request_kwargs = override_request_kwargs or {}
+        url = self.host + path
+        headers = {
+            "Accept": JSON_CONTENT_TYPE,
+            "Api-Key": self.api_key,
+            "Api-Username": self.api_username,
+        }
+        cache_key = None
+        if verb == "GET" and self.response_cache:
+            cache_key = self.response_cache.key(url, params)
+            headers.update(self.response_cache.conditional_headers(cache_key))
+
+        # How many times should we retry if rate limited
+        retry_count = 4
+        # Extra time (on top of that required by API) to wait on a retry.
+        retry_backoff = 1
+
+        while retry_count > 0:
+            request_kwargs = dict(
+                allow_redirects=False,
+                params=params,
+                files=files,
+                data=data,
+                json=json,
+                headers=headers,
+                timeout=self.timeout,
+            )
+            request_kwargs.update(override_request_kwargs)
+
+            self.scheduler.acquire(verb, _request_priority.get())
+            response = self._send(verb, url, **request_kwargs)
+            if response.ok:
+                break
+
+            if response.status_code == 429:
+                wait_delay = retry_backoff + retry_after_seconds(response, default=10)
+                retry_count -= 1
+                if retry_count > 0:
+                    # Holds back all requests of the same kind, not only this one
+                    self.scheduler.back_off(verb, wait_delay)
+                logger.info(
+                    f"We have been rate limited, waiting {wait_delay} seconds ({retry_count} retries left)"
+                )
+                continue
+
+            try:
+                msg = ",".join(response.json()["errors"])
+            except (ValueError, TypeError, KeyError):
+                msg = response.reason or f"{response.status_code}: {response.text}"
+            if 400 <= response.status_code < 500:
+                raise DiscourseClientError(msg, response=response)
+            raise DiscourseServerError(msg, response=response)
+
+        if retry_count == 0:
+            raise DiscourseRateLimitedError(
+                "Number of rate limit retries exceeded. Increase retry_backoff or retry_count",
+                response=response,
+            )
+
+        if cache_key and response.status_code == 304:
+            cached = self.response_cache.hit(cache_key)
+            if cached is None:
+                # The entry was evicted in the meantime, ask again without validators
+                return self._request(
+                    verb,
+                    path,
+                    params=params,
+                    override_request_kwargs=override_request_kwargs,
+                )
+            return cached
+
+        decoded = self._decode_response(response)
+        if cache_key and response.status_code == 200:
+            self.response_cache.store(cache_key, response)
+        return decoded
+
+    @staticmethod
+    def _decode_response(response: requests.Response):
+        if response.status_code == 302:
+            raise DiscourseError(
+                "Unexpected Redirect, invalid api key or host?", response=response
+            )
+
+        content_type = response.headers["content-type"]
+        if content_type != JSON_CONTENT_TYPE:
+            # some calls return empty html documents
+            if not response.content.strip():
+                return None
+            raise DiscourseError(
+                f'Invalid Response, expecting "{JSON_CONTENT_TYPE}" got "{content_type}"',
+                response=response,
+            )
+
+        try:
+            decoded = response.json()
+        except ValueError:
+            raise DiscourseError("failed to decode response", response=response)
+
+        if "errors" in decoded:
+            message = decoded.get("message") or ",".join(decoded["errors"])
+            raise DiscourseError(message, response=response)
+
+        return decoded
 
     # TODO: Add this method upstream
     def private_messages_sent(self, username=None, **kwargs):
@@ -38,30 +495,412 @@ class DiscourseStorageClient(DiscourseClient):
         # Original method forces a "term" parameter but q works fine for us.
         return self._get("/search.json", q=query, **kwargs)
 
+    @staticmethod
+    def iter_topic_list(
+        fetch_page: Callable[..., dict],
+        since: datetime | None = None,
+        max_pages: int | None = None,
+    ) -> Iterator[dict]:
+        """
+        Lazily walks through all pages of a topic list. Topic lists are ordered by `bumped_at`,
+        newest first. If `since` is given, we stop at the first topic bumped before it.
+        Pinned topics are listed first regardless of their age, so they never stop the walk.
+        With `max_pages`, at most that many pages are fetched.
+        """
+        page = 0
+        while True:
+            topic_list = fetch_page(**({"page": page} if page else {}))["topic_list"]
+            for topic in topic_list["topics"]:
+                bumped_at = topic.get("bumped_at")
+                if (
+                    since
+                    and bumped_at
+                    and not topic.get("pinned")
+                    and datetime.fromisoformat(bumped_at) < since
+                ):
+                    return
+                yield topic
+            if not topic_list["topics"] or not topic_list.get("more_topics_url"):
+                return
+            page += 1
+            if max_pages is not None and page >= max_pages:
+                return
+
+    def iter_private_messages(
+        self, username=None, since: datetime | None = None
+    ) -> Iterator[dict]:
+        return self.iter_topic_list(
+            lambda **kwargs: self.private_messages(username, **kwargs), since
+        )
+
+    def iter_private_messages_sent(
+        self, username=None, since: datetime | None = None, max_pages: int | None = None
+    ) -> Iterator[dict]:
+        return self.iter_topic_list(
+            lambda **kwargs: self.private_messages_sent(username, **kwargs),
+            since,
+            max_pages,
+        )
+
+    def iter_category_topics(
+        self, category_id, since: datetime | None = None
+    ) -> Iterator[dict]:
+        return self.iter_topic_list(
+            lambda **kwargs: self.category_topics(category_id, **kwargs), since
+        )
+
+    def iter_posts(self, topic_id, chunk_size: int = 20) -> Iterator[dict]:
+        """
+        Lazily yields all posts of a topic. `posts()` only returns the first chunk, the
+        remaining posts are fetched by their ids, `chunk_size` at a time.
+        """
+        posts = self.posts(topic_id)["post_stream"]["posts"]
+        yield from posts
+        if len(posts) < chunk_size:
+            return
+        seen = {p["id"] for p in posts}
+        stream = self.single_topic(topic_id)["post_stream"]["stream"]
+        remaining = [post_id for post_id in stream if post_id not in seen]
+        for i in range(0, len(remaining), chunk_size):
+            yield from self.posts(topic_id, post_ids=remaining[i : i + chunk_size])[
+                "post_stream"
+            ]["posts"]
+
+
+class AsyncDiscourseStorageClient:
+    """
+    Asyncio front end for a DiscourseStorageClient. Every call runs the blocking client in a worker
+    thread, so many requests can be in flight at once while sharing the client's connection pool,
+    response cache and rate limits. At most `max_concurrency` calls run at the same time.
+    """
+
+    def __init__(
+        self, client: DiscourseStorageClient, max_concurrency: int | None = None
+    ):
+        self.client = client
+        self.max_concurrency = max_concurrency or client.pool_maxsize
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.storage = AsyncStorage(self)
+
+    async def run(self, fn, *args, **kwargs):
+        """Runs any blocking function that talks to Discourse, respecting the concurrency limit."""
+        async with self._semaphore:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def posts(self, topic_id, post_ids=None, **kwargs):
+        return await self.run(self.client.posts, topic_id, post_ids, **kwargs)
+
+    async def topic_posts(self, topic_id, **kwargs):
+        return await self.run(self.client.topic_posts, topic_id, **kwargs)
+
+    async def single_post(self, post_id, **kwargs):
+        return await self.run(self.client.single_post, post_id, **kwargs)
+
+    async def create_post(self, content, **kwargs):
+        return await self.run(self.client.create_post, content, **kwargs)
+
+    async def search(self, query, **kwargs):
+        return await self.run(self.client.search, query, **kwargs)
+
+
+class AsyncStorage:
+    def __init__(self, async_client: AsyncDiscourseStorageClient):
+        self.async_client = async_client
+
+    async def get(self, key, default=None) -> Dict:
+        storage = self.async_client.client.storage
+        return await self.async_client.run(storage.get, key, default)
+
+    async def put(self, key, value):
+        storage = self.async_client.client.storage
+        return await self.async_client.run(storage.put, key, value)
+
+    async def get_many(self, keys, default=None) -> dict[str, Dict]:
+        storage = self.async_client.client.storage
+        return await self.async_client.run(storage.get_many, keys, default)
+
+    async def put_many(self, values: dict):
+        storage = self.async_client.client.storage
+        return await self.async_client.run(storage.put_many, values)
+
+
+# Values of the storage transactions open in the current context, by (storage, key)
+_open_transactions: ContextVar[dict] = ContextVar("open_transactions", default={})
+
 
 class BaseDiscourseStorage(ABC):
     def __init__(self, client: "DiscourseStorageClient"):
         self.client = client
+        self._key_locks: Dict[str, threading.RLock] = {}
+        self._key_locks_guard = threading.Lock()
+
+    def lock(self, key) -> threading.RLock:
+        """
+        Lock of a key, held by `update` and `transaction`. Code which reads and later writes a key
+        without them, from several threads, holds it as well.
+        """
+        with self._key_locks_guard:
+            return self._key_locks.setdefault(key, threading.RLock())
 
     @abstractmethod
     def get(self, key, default=None) -> Dict: ...
 
     @abstractmethod
-    def put(self, key, value): ...
+    def put(self, key, value, expected_revision=ANY_REVISION):
+        """
+        If `expected_revision` is given, the write fails with a StorageConflictError unless
+        the stored value still has this revision (None: the key must not exist yet).
+        """
+
+    def get_versioned(self, key, default=None) -> tuple[Dict, object]:
+        """
+        Returns the value together with its revision, for a checked `put`.
+        Backends which don't track revisions return ANY_REVISION.
+        """
+        return self.get(key, default), ANY_REVISION
+
+    def get_many(self, keys, default=None) -> dict[str, Dict]:
+        """Values of several keys by key, backends fetch them at once where they can"""
+        return {
+            key: value
+            for key, (value, _) in self.get_many_versioned(keys, default).items()
+        }
+
+    def get_many_versioned(self, keys, default=None) -> dict[str, tuple[Dict, object]]:
+        return {key: self.get_versioned(key, default) for key in keys}
+
+    def put_many(self, values: dict, expected_revisions: dict | None = None) -> None:
+        """
+        Writes several keys in the given order. Keys in `expected_revisions` are checked like in
+        `put`. Backends which can write them atomically do so, others stop at the first conflict.
+        """
+        for key, value in values.items():
+            revision = (expected_revisions or {}).get(key, ANY_REVISION)
+            self.put(key, value, expected_revision=revision)
+
+    def update(self, key, mutate: Callable[[Dict], Dict], default=None, retries=5):
+        """
+        Read-modify-write which doesn't lose concurrent changes: `mutate` gets the current value and
+        returns the new one. If the key was written in between, `mutate` is applied again to the
+        fresh value, so it must not have side effects. Returns the written value.
+        """
+        for attempt in range(1, retries + 1):
+            with self.lock(key):
+                value, revision = self.get_versioned(key, default)
+                value = mutate(value)
+                try:
+                    self.put(key, value, expected_revision=revision)
+                    return value
+                except StorageConflictError:
+                    logger.info(
+                        f'Storage "{key}" was changed concurrently ({attempt}/{retries})'
+                    )
+        raise StorageConflictError(
+            f'Could not update storage "{key}" after {retries} attempts'
+        )
+
+    @contextmanager
+    def transaction(self, key, default=None):
+        """
+        Loads `key` once and writes it back once when the block ends, if it was changed.
+        Nothing is written if the block raises. Transactions on the same key opened inside
+        the block, e.g. by helper functions, share the same object and don't write themselves.
+        Other threads wait for the block to end before they can open a transaction on the key.
+        The write expects the revision which was read, so if the key was changed in the meantime,
+        by another process or a `put` inside the block, StorageConflictError is raised instead
+        of overwriting the change.
+        """
+        open_transactions = _open_transactions.get()
+        if (self, key) in open_transactions:
+            yield open_transactions[self, key]
+            return
+
+        with self.lock(key):
+            data, revision = self.get_versioned(key, default)
+            original = copy.deepcopy(data)
+            token = _open_transactions.set({**open_transactions, (self, key): data})
+            try:
+                yield data
+            finally:
+                _open_transactions.reset(token)
+            if data != original:
+                self.put(key, data, expected_revision=revision)
+
+    def stats(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+@dataclass
+class CachedValue:
+    revision: tuple | None
+    value: object
+    validated_at: float
+
+
+def _as_tuple(revision):
+    """Revisions are compared to tuples, but a snapshot stores them as lists"""
+    if isinstance(revision, list):
+        return tuple(_as_tuple(part) for part in revision)
+    return revision
+
+
+@dataclass
+class JournalPosition:
+    # Id of the newest post in the topic which is contained in our value
+    last_post_id: int
+    # Journal entries written since the first post was last rewritten
+    entries: int
+
+
+JOURNAL_PREFIX = "#storage-journal: "
 
 
 class DiscourseStorage(BaseDiscourseStorage):
     """
     Uses a PM to itself to persist data. This way, we won't need to care about storage.
+
+    In journal mode, a write only replies the changes to the PM (see `storage_journal`), and every
+    `journal_compact_after` entries the whole value is written to the first post again. Its first
+    line names the last reply included, later replies are applied when reading. Checked writes
+    compare the topic's newest post before replying, so unlike an edit there is a small window in
+    which a concurrent change isn't detected.
     """
 
-    def __init__(self, client: DiscourseStorageClient):
+    # Share of `max_post_length` from which we warn about a growing key
+    SIZE_WARNING_RATIO = 0.8
+    # Pages of sent PMs scanned for storage keys. The list grows with every conversation, keys
+    # in older pages are found by a search instead.
+    INDEX_PAGES = 2
+
+    def __init__(
+        self,
+        client: DiscourseStorageClient,
+        codec: str = "yaml",
+        compress: bool = False,
+        max_post_length: int = 32000,
+        journal: bool = False,
+        journal_compact_after: int = 50,
+        snapshot_path: str | None = None,
+    ):
+        """
+        :param codec: format new values are written in, see `storage_codecs`
+        :param compress: write values zlib compressed, about a tenth of the size but unreadable in the forum
+        :param max_post_length: the forum's "max post length" setting, writes of larger values fail
+        :param journal: write changes as replies instead of editing the whole value
+        :param journal_compact_after: number of replies after which the value is rewritten
+        :param snapshot_path: file to keep the values in across restarts, they are checked
+            against the forum before they're used
+        """
         super().__init__(client)
+        self.codec = codec
+        self.compress = compress
+        self.max_post_length = max_post_length
+        self.journal = journal
+        self.journal_compact_after = journal_compact_after
+        # Keys stored with a journal
+        self._journals: Dict[str, JournalPosition] = {}
+        self.journal_entries = 0
+        self.journal_compactions = 0
+        self.snapshot_path = snapshot_path
+        # Jobs on other threads share the storage. Its state is only used under this lock, which
+        # is held during the requests as well, so the storage handles one call at a time.
+        self._lock = threading.RLock()
+        # Length of each key's post as last read or written
+        self._sizes: Dict[str, int] = {}
+        self._size_warned: set[str] = set()
+        self.size_warnings = 0
         self._storage_ids: Dict[str, tuple[int | None, int | None]] = {}
+        self._index_built = False
+        # Hash of the serialized value we last read or wrote per key, to skip writes which change nothing
+        self._hashes: Dict[str, str] = {}
+        self.writes_performed = 0
+        self.writes_skipped = 0
+        # Parsed values per key. Callers always get deep copies, so they can't modify the cache.
+        self._cache: Dict[str, CachedValue] = {}
+        self._clock = time.monotonic
+        self.cache_hits = 0
+        self.cache_revalidations = 0
+        self.cache_misses = 0
+        # When we last searched in vain for a key
+        self._missing: Dict[str, float] = {}
+        self.missing_hits = 0
+        if snapshot_path:
+            self._load_snapshot()
+
+    def _serialize(self, value) -> str:
+        # Codecs sort keys, so equal values always give the same document
+        return storage_codecs.encode(value, self.codec, self.compress)
+
+    def _check_size(self, key: str, data: str) -> None:
+        size = self._sizes[key] = len(data)
+        if size > self.max_post_length:
+            self.size_warnings += 1
+            logger.error(
+                f'Storage "{key}" has {size} characters, more than the forum allows '
+                f"({self.max_post_length}). Writing it will fail."
+            )
+        elif size >= self.max_post_length * self.SIZE_WARNING_RATIO:
+            if key not in self._size_warned:
+                self._size_warned.add(key)
+                self.size_warnings += 1
+                logger.warning(
+                    f'Storage "{key}" has {size} of {self.max_post_length} allowed characters'
+                    + ("" if self.compress else ", consider enabling compression")
+                )
+        else:
+            self._size_warned.discard(key)
+
+    @staticmethod
+    def _hash(data: str) -> str:
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    @staticmethod
+    def _revision(post: dict) -> tuple | None:
+        if "version" not in post:
+            return None
+        return post["version"], post.get("updated_at")
+
+    def _build_index(self) -> None:
+        """
+        Resolves the storage keys at once from the PMs we've sent recently, so we don't need a
+        search per key. The list doesn't contain post ids, they're fetched when a key is used.
+        """
+        self._index_built = True
+        prefix = "STORAGE_"
+        try:
+            for topic in self.client.iter_private_messages_sent(
+                max_pages=self.INDEX_PAGES
+            ):
+                if topic["title"].startswith(prefix):
+                    key = topic["title"].removeprefix(prefix)
+                    self._storage_ids.setdefault(key, (topic["id"], None))
+        except requests.RequestException:
+            logger.exception(
+                "Could not list sent messages, resolving storage keys via search"
+            )
+            return
+        logger.info(f"Found storage keys: {', '.join(self._storage_ids) or 'none'}")
+
+    def _first_post_id(self, key: str, topic_id: int) -> int:
+        post_id = self.client.posts(topic_id)["post_stream"]["posts"][0]["id"]
+        self._storage_ids[key] = topic_id, post_id
+        return post_id
 
     def _resolve_key(self, key: str) -> tuple[int | None, int | None]:
+        if not self._index_built:
+            self._build_index()
         if key in self._storage_ids:
             return self._storage_ids[key]
+        missed_at = self._missing.get(key)
+        if (
+            missed_at is not None
+            and self._clock() - missed_at < self.client.storage_missing_ttl
+        ):
+            self.missing_hits += 1
+            return None, None
 
         logger.info(f'Resolving storage key "{key}" via search')
         query = f"STORAGE_{key} @{self.client.api_username} in:title in:messages"
@@ -73,42 +912,864 @@ class DiscourseStorage(BaseDiscourseStorage):
             if topic["title"] == f"STORAGE_{key}":
                 topic_id = topic["id"]
                 # Search results only give us the topic ID. Fetch the first post ID.
-                post_id = self.client.posts(topic_id)["post_stream"]["posts"][0]["id"]
-                self._storage_ids[key] = topic_id, post_id
+                post_id = self._first_post_id(key, topic_id)
                 logger.info(f'Resolved storage key "{key}" to topic {topic_id}')
                 return topic_id, post_id
 
         logger.info(f'No storage topic found for key "{key}"')
+        self._missing[key] = self._clock()
         return None, None
 
     def get(self, key, default=None) -> Dict:
+        return self.get_versioned(key, default)[0]
+
+    def _is_fresh(self, cached: CachedValue | None) -> bool:
+        return bool(
+            cached
+            and self._clock() - cached.validated_at < self.client.storage_cache_ttl
+        )
+
+    def get_versioned(self, key, default=None) -> tuple[Dict, tuple | None]:
+        with self._lock:
+            return self._get_resolved(key, default)
+
+    @staticmethod
+    def _is_not_found(error: DiscourseClientError) -> bool:
+        return error.response is not None and error.response.status_code == 404
+
+    def _forget(self, key: str) -> None:
+        """Drops what we know about a key whose post is gone, e.g. from an old snapshot"""
+        logger.warning(
+            f'Storage "{key}" is gone from its known post, resolving it again'
+        )
+        self._storage_ids.pop(key, None)
+        self._cache.pop(key, None)
+        self._hashes.pop(key, None)
+        self._journals.pop(key, None)
+        self._index_built = False
+
+    def _get_resolved(
+        self, key, default=None, post: dict | None = None
+    ) -> tuple[Dict, tuple | None]:
+        try:
+            return self._get_versioned(key, default, post)
+        except DiscourseClientError as e:
+            if not self._is_not_found(e) or key not in self._storage_ids:
+                raise
+            self._forget(key)
+        return self._get_versioned(key, default)
+
+    def get_many_versioned(self, keys, default=None) -> dict[str, tuple[Dict, object]]:
+        """Fetches the posts of all keys which aren't cached in parallel"""
+        with self._lock:
+            post_ids = {}
+            for key in keys:
+                if self._is_fresh(self._cache.get(key)):
+                    continue
+                if self.journal or key in self._journals:
+                    continue
+                topic_id, post_id = self._resolve_key(key)
+                if topic_id:
+                    post_ids[key] = post_id or self._first_post_id(key, topic_id)
+            posts = {}
+            if len(post_ids) > 1:
+                with ThreadPoolExecutor(
+                    min(len(post_ids), self.client.pool_maxsize)
+                ) as executor:
+                    futures = {
+                        key: executor.submit(
+                            copy_context().run, self.client.single_post, post_id
+                        )
+                        for key, post_id in post_ids.items()
+                    }
+                    for key, future in futures.items():
+                        try:
+                            posts[key] = future.result()
+                        except DiscourseClientError as e:
+                            # Fetched and resolved again below
+                            if not self._is_not_found(e):
+                                raise
+            return {
+                key: self._get_resolved(key, default, posts.get(key)) for key in keys
+            }
+
+    def _get_versioned(
+        self, key, default=None, post: dict | None = None
+    ) -> tuple[Dict, tuple | None]:
+        """`post` is the storage post if it was already fetched"""
+        cached = self._cache.get(key)
+        if self._is_fresh(cached):
+            self.cache_hits += 1
+            return copy.deepcopy(cached.value), cached.revision
+
         topic_id, post_id = self._resolve_key(key)
         if not topic_id:
             logger.info(f'No storage "{key}" found.')
-            return default or {}
+            return default or {}, None
         if not post_id:
-            post_id = self.client.posts(topic_id)["post_stream"]["posts"][0]["id"]
-            self._storage_ids[key] = topic_id, post_id
-        post = self.client.single_post(post_id)
+            post_id = self._first_post_id(key, topic_id)
+        if self.journal or key in self._journals:
+            return self._get_journaled(key, topic_id, post_id, cached)
+        post = self._own_post(key, post_id, post)
+        if post["raw"].startswith(JOURNAL_PREFIX):
+            # Written in journal mode
+            return self._get_journaled(key, topic_id, post_id, cached, post)
+
+        revision = self._revision(post)
+        if cached and revision and cached.revision == revision:
+            # Nobody edited the post since we last read or wrote it, skip parsing
+            self.cache_revalidations += 1
+            cached.validated_at = self._clock()
+            return copy.deepcopy(cached.value), revision
+
+        self.cache_misses += 1
+        self._sizes[key] = len(post["raw"])
+        value = storage_codecs.decode(post["raw"])
+        self._hashes[key] = self._hash(self._serialize(value))
+        self._cache[key] = CachedValue(revision, value, self._clock())
+        self._save_snapshot()
+        return copy.deepcopy(value), revision
+
+    def _load_snapshot(self) -> None:
+        """
+        Restores the known keys and values. The values count as expired, so the first read
+        only compares the revision with the forum's instead of downloading and parsing them.
+        """
+        try:
+            snapshot = storage_codecs.decode(Path(self.snapshot_path).read_text())
+            for key, entry in snapshot["keys"].items():
+                self._storage_ids[key] = entry["topic_id"], entry["post_id"]
+                if "value" in entry:
+                    revision = _as_tuple(entry["revision"])
+                    self._cache[key] = CachedValue(
+                        revision, entry["value"], float("-inf")
+                    )
+                    self._hashes[key] = entry["hash"]
+                if "journal" in entry:
+                    self._journals[key] = JournalPosition(*entry["journal"])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError):
+            logger.exception(f"Could not load storage snapshot {self.snapshot_path}")
+            return
+        # Keys we don't know yet are resolved by search
+        self._index_built = True
+        logger.info(
+            f"Loaded storage snapshot with keys: {', '.join(self._storage_ids)}"
+        )
+
+    def _save_snapshot(self) -> None:
+        if not self.snapshot_path:
+            return
+        keys = {}
+        for key, (topic_id, post_id) in self._storage_ids.items():
+            entry = keys[key] = {"topic_id": topic_id, "post_id": post_id}
+            cached = self._cache.get(key)
+            if cached and key in self._hashes:
+                entry["revision"] = cached.revision
+                entry["value"] = cached.value
+                entry["hash"] = self._hashes[key]
+            if key in self._journals:
+                position = self._journals[key]
+                entry["journal"] = [position.last_post_id, position.entries]
+        path = Path(self.snapshot_path)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        try:
+            tmp_path.write_text(storage_codecs.encode({"keys": keys}, "json"))
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception(f"Could not write storage snapshot {path}")
+
+    def _own_post(self, key: str, post_id: int, post: dict | None = None) -> dict:
+        post = post or self.client.single_post(post_id)
         if post["yours"] is not True:
             raise DiscourseStorageError(
                 f'The "STORAGE_{key}" was not created by ourself (post_id: {post_id})'
             )
-        return yaml.safe_load(post["raw"])
+        return post
+
+    def _journal_stream(self, topic_id: int) -> tuple[tuple, list[int]]:
+        """
+        Returns the revision of a journaled value, made of the first post's revision and the
+        id of the newest post, and the ids of all posts
+        """
+        post_stream = self.client.single_topic(topic_id)["post_stream"]
+        stream = post_stream["stream"]
+        return (self._revision(post_stream["posts"][0]), stream[-1]), stream
+
+    def _journal_replies(
+        self, topic_id: int, stream: list[int], after: int
+    ) -> Iterator[dict]:
+        pending = [post_id for post_id in stream[1:] if post_id > after]
+        for i in range(0, len(pending), 20):
+            posts = self.client.posts(
+                topic_id, post_ids=pending[i : i + 20], include_raw="true"
+            )["post_stream"]["posts"]
+            for post in sorted(posts, key=lambda p: p["post_number"]):
+                if post["yours"] is True:
+                    yield post
+
+    def _get_journaled(
+        self, key, topic_id: int, post_id: int, cached, post: dict | None = None
+    ) -> tuple[Dict, tuple]:
+        revision, stream = self._journal_stream(topic_id)
+        if cached and cached.revision == revision:
+            self.cache_revalidations += 1
+            cached.validated_at = self._clock()
+            return copy.deepcopy(cached.value), revision
+
+        self.cache_misses += 1
+        post = post or self._own_post(key, post_id)
+        self._sizes[key] = len(post["raw"])
+        raw, after = post["raw"], 0
+        if raw.startswith(JOURNAL_PREFIX):
+            marker, _, raw = raw.partition("\n")
+            after = int(marker.removeprefix(JOURNAL_PREFIX))
+        value = storage_codecs.decode(raw)
+        entries = 0
+        for reply in self._journal_replies(topic_id, stream, after):
+            entry = storage_codecs.decode(reply["raw"])
+            value = storage_journal.apply(value, entry["ops"])
+            entries += 1
+        self._journals[key] = JournalPosition(stream[-1], entries)
+        self._hashes[key] = self._hash(self._serialize(value))
+        self._cache[key] = CachedValue(revision, value, self._clock())
+        self._save_snapshot()
+        return copy.deepcopy(value), revision
+
+    def _put_journaled(
+        self, key, topic_id: int, post_id: int, value, data: str, expected_revision
+    ) -> tuple | None:
+        """Writes a journal entry or rewrites the first post, returns the new revision"""
+        current = None
+        if expected_revision is not ANY_REVISION:
+            current = self._journal_stream(topic_id)[0]
+            if current != expected_revision:
+                raise self._conflict(key)
+
+        position = self._journals.get(key)
+        cached = self._cache.get(key)
+        if (
+            self.journal
+            and position
+            and cached
+            and position.entries < self.journal_compact_after
+        ):
+            entry = {
+                "at": datetime.now(timezone.utc).isoformat(),
+                "ops": storage_journal.diff(cached.value, value),
+            }
+            res = self.client.create_post(
+                storage_codecs.encode(entry, self.codec, self.compress),
+                topic_id=topic_id,
+            )
+            self._journals[key] = JournalPosition(res["id"], position.entries + 1)
+            self.journal_entries += 1
+            return cached.revision[0], res["id"]
+
+        if not self.journal:
+            # Journal mode was switched off, the replies are contained in our value
+            self._journals.pop(key, None)
+            res = self.client.update_post(post_id, data)
+            return self._revision(res.get("post", res))
+        # Our value replaces everything written so far, including all replies
+        last_post_id = (current or self._journal_stream(topic_id)[0])[1]
+        res = self.client.update_post(
+            post_id, f"{JOURNAL_PREFIX}{last_post_id}\n{data}"
+        )
+        self._journals[key] = JournalPosition(last_post_id, 0)
+        self.journal_compactions += 1
+        return self._revision(res.get("post", res)), last_post_id
+
+    def _put_edit(
+        self, key, post_id: int, data: str, expected_revision
+    ) -> tuple | None:
+        """Replaces the value in the first post, returns the new revision"""
+        kwargs = {}
+        if expected_revision is not ANY_REVISION:
+            post = self.client.single_post(post_id)
+            if self._revision(post) != expected_revision:
+                raise self._conflict(key)
+            # Discourse rejects the edit with 409 if the post changed after this check
+            kwargs["post[raw_old]"] = post["raw"]
+        try:
+            res = self.client.update_post(post_id, data, **kwargs)
+        except DiscourseClientError as e:
+            if e.response is not None and e.response.status_code == 409:
+                raise self._conflict(key) from e
+            raise
+        return self._revision(res.get("post", res))
 
-    def put(self, key, value):
-        data = yaml.safe_dump(value)
+    def _conflict(self, key: str) -> StorageConflictError:
+        # Make sure the next read fetches the current value
+        self._cache.pop(key, None)
+        self._hashes.pop(key, None)
+        self._journals.pop(key, None)
+        return StorageConflictError(f'Storage "{key}" was changed by someone else')
+
+    def put(self, key, value, expected_revision=ANY_REVISION):
+        with self._lock:
+            try:
+                self._put(key, value, expected_revision)
+            except DiscourseClientError as e:
+                if not self._is_not_found(e) or key not in self._storage_ids:
+                    raise
+                self._forget(key)
+                self._put(key, value, expected_revision)
+
+    def _put(self, key, value, expected_revision):
+        data = self._serialize(value)
+        data_hash = self._hash(data)
+        if self._hashes.get(key) == data_hash:
+            logger.debug(f'Storage "{key}" is unchanged, skipping write')
+            self.writes_skipped += 1
+            return
+        self._check_size(key, data)
         topic_id, post_id = self._resolve_key(key)
         if not topic_id:
+            if expected_revision not in (ANY_REVISION, None):
+                raise self._conflict(key)
             logger.info(
                 f'No storage "{key}" found. Creating a new storage by sending a message to ourself'
             )
             res = self.client.create_post(
-                data,
+                f"{JOURNAL_PREFIX}0\n{data}" if self.journal else data,
                 title=f"STORAGE_{key}",
                 archetype="private_message",
                 target_recipients=self.client.api_username,
             )
             self._storage_ids[key] = res.get("topic_id"), res.get("id")
+            self._missing.pop(key, None)
+            revision = self._revision(res)
+            if self.journal:
+                self._journals[key] = JournalPosition(res["id"], 0)
+                revision = revision, res["id"]
         else:
-            self.client.update_post(post_id, data)
+            if expected_revision is None:
+                raise self._conflict(key)
+            if not post_id:
+                post_id = self._first_post_id(key, topic_id)
+            if self.journal or key in self._journals:
+                revision = self._put_journaled(
+                    key, topic_id, post_id, value, data, expected_revision
+                )
+            else:
+                revision = self._put_edit(key, post_id, data, expected_revision)
+        self._hashes[key] = data_hash
+        self._cache[key] = CachedValue(revision, copy.deepcopy(value), self._clock())
+        self.writes_performed += 1
+        self._save_snapshot()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return self._stats()
+
+    def _stats(self) -> dict:
+        sizes = list(self._sizes.values())
+        largest_size = max(sizes) if sizes else 0
+        return {
+            "writes_performed": self.writes_performed,
+            "writes_skipped": self.writes_skipped,
+            "cache_hits": self.cache_hits,
+            "cache_revalidations": self.cache_revalidations,
+            "cache_misses": self.cache_misses,
+            "missing_hits": self.missing_hits,
+            "largest_value_size": largest_size,
+            "largest_value_usage": largest_size / self.max_post_length,
+            "size_warnings": self.size_warnings,
+            "journal_entries": self.journal_entries,
+            "journal_compactions": self.journal_compactions,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._save_snapshot()
+
+
+class SQLiteStorage(BaseDiscourseStorage):
+    """
+    Keeps the data in a local SQLite database, one document per key. Reads and writes take
+    milliseconds instead of forum round-trips.
+
+    With `mirror`, every write is also put to the DiscourseStorage, so the data stays visible
+    (and its revisions auditable) in the forum. Keys missing locally are then imported from the
+    forum on first read, which migrates an existing installation.
+    """
+
+    def __init__(
+        self,
+        client: DiscourseStorageClient,
+        path: str = "forumbot.sqlite3",
+        mirror: bool = False,
+        codec: str = "yaml",
+        **mirror_options,
+    ):
+        """
+        :param mirror_options: passed to the DiscourseStorage mirror, e.g. `compress` or `journal`
+        """
+        super().__init__(client)
+        self.codec = codec
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS storage (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "updated_at TEXT NOT NULL, version INTEGER NOT NULL DEFAULT 1)"
+            )
+            columns = {
+                row[1] for row in self._connection.execute("PRAGMA table_info(storage)")
+            }
+            if "version" not in columns:
+                # Databases created before writes were versioned
+                self._connection.execute(
+                    "ALTER TABLE storage ADD COLUMN version INTEGER NOT NULL DEFAULT 1"
+                )
+        self.mirror = (
+            DiscourseStorage(client, codec, **mirror_options) if mirror else None
+        )
+
+    def _read(self, key: str) -> tuple[str, int] | None:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT value, version FROM storage WHERE key = ?", (key,)
+            ).fetchone()
+
+    def _write(self, key: str, data: str, expected_revision=ANY_REVISION) -> int:
+        """Writes `data` and returns its new version"""
+        return self._write_many({key: data}, {key: expected_revision})[key]
+
+    def _write_many(
+        self, documents: dict[str, str], expected_revisions: dict
+    ) -> dict[str, int]:
+        """Writes all documents in one transaction and returns their new versions"""
+        now = datetime.now(timezone.utc).isoformat()
+        versions = {}
+        with self._lock, self._connection:
+            for key, data in documents.items():
+                expected_revision = expected_revisions.get(key, ANY_REVISION)
+                if expected_revision is ANY_REVISION:
+                    row = self._connection.execute(
+                        "INSERT INTO storage (key, value, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET value = excluded.value, "
+                        "updated_at = excluded.updated_at, version = version + 1 "
+                        "RETURNING version",
+                        (key, data, now),
+                    ).fetchone()
+                elif expected_revision is None:
+                    row = self._connection.execute(
+                        "INSERT INTO storage (key, value, updated_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT (key) DO NOTHING RETURNING version",
+                        (key, data, now),
+                    ).fetchone()
+                else:
+                    row = self._connection.execute(
+                        "UPDATE storage SET value = ?, updated_at = ?, version = version + 1 "
+                        "WHERE key = ? AND version = ? RETURNING version",
+                        (data, now, key, expected_revision),
+                    ).fetchone()
+                if row is None:
+                    # Rolls back the other writes
+                    raise StorageConflictError(
+                        f'Storage "{key}" was changed by someone else'
+                    )
+                versions[key] = row[0]
+        return versions
+
+    def get(self, key, default=None) -> Dict:
+        return self.get_versioned(key, default)[0]
+
+    def get_versioned(self, key, default=None) -> tuple[Dict, int | None]:
+        row = self._read(key)
+        if row is None:
+            if self.mirror and (value := self.mirror.get(key)):
+                logger.info(f'Imported storage "{key}" from Discourse')
+                try:
+                    return value, self._write(
+                        key, storage_codecs.encode(value, self.codec), None
+                    )
+                except StorageConflictError:
+                    # Imported concurrently, use that one
+                    return self.get_versioned(key, default)
+            return default or {}, None
+        data, version = row
+        return storage_codecs.decode(data), version
+
+    def get_many_versioned(self, keys, default=None) -> dict[str, tuple[Dict, object]]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT key, value, version FROM storage WHERE key IN ({', '.join('?' * len(keys))})",
+                keys,
+            ).fetchall()
+        found = {
+            key: (storage_codecs.decode(data), version) for key, data, version in rows
+        }
+        return {
+            key: found[key] if key in found else self.get_versioned(key, default)
+            for key in keys
+        }
+
+    def put(self, key, value, expected_revision=ANY_REVISION):
+        self.put_many({key: value}, {key: expected_revision})
+
+    def put_many(self, values: dict, expected_revisions: dict | None = None) -> None:
+        """Writes all values in one transaction, nothing is written if one of them conflicts"""
+        self._write_many(
+            {
+                key: storage_codecs.encode(value, self.codec)
+                for key, value in values.items()
+            },
+            expected_revisions or {},
+        )
+        if self.mirror:
+            for key, value in values.items():
+                try:
+                    self.mirror.put(key, value)
+                except requests.RequestException:
+                    # The local database is authoritative, the mirror catches up with the next write
+                    logger.exception(f'Could not mirror storage "{key}" to Discourse')
+
+    def stats(self) -> dict:
+        return self.mirror.stats() if self.mirror else {}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class ShardLayout:
+    """
+    Describes how a dict value is split into shards, so a change only rewrites the shards it touched:
+
+    - `partitioned_fields` are maps like {congress_id: ...}. Each map key gets a shard `<key>_<map key>`
+      with its entries of all these fields.
+    - `cold_fields` maps list fields to the fields of their items which rarely change and keep growing,
+      like the voucher history. They are stored together in the shard `<key>_cold`.
+    - Everything else stays in the shard `<key>`, together with the list of the other shards.
+
+    With `current_partition`, only the shard of the partition it returns is read, e.g. the current
+    congress. The other partitions are missing from the value and are kept as they are when it's
+    written.
+    """
+
+    META = "_shards"
+
+    def __init__(
+        self,
+        partitioned_fields: tuple[str, ...] = (),
+        cold_fields: dict[str, tuple[str, ...]] | None = None,
+        current_partition: Callable[[], str] | None = None,
+    ):
+        self.partitioned_fields = partitioned_fields
+        self.cold_fields = cold_fields or {}
+        self.current_partition = current_partition
+
+    def split(
+        self,
+        key: str,
+        value,
+        keep_partitions: Iterable[str] = (),
+        keep_cold: bool = False,
+    ) -> dict[str, object]:
+        """
+        Returns the shards by their storage key. The main shard comes last.
+        `keep_partitions` and `keep_cold` name stored shards which weren't read, the main shard
+        keeps referring to them.
+        """
+        if not isinstance(value, dict):
+            return {key: value}
+        main = dict(value)
+        partitions: dict[str, dict] = {}
+        partitioned = []
+        for field in self.partitioned_fields:
+            if isinstance(main.get(field), dict):
+                partitioned.append(field)
+                for partition, entry in main.pop(field).items():
+                    partitions.setdefault(partition, {})[field] = entry
+
+        cold: dict[str, dict] = {}
+        for list_field, item_fields in self.cold_fields.items():
+            if not isinstance(main.get(list_field), list):
+                continue
+            items = []
+            for position, item in enumerate(main[list_field]):
+                if isinstance(item, dict):
+                    item = dict(item)
+                    for field in item_fields:
+                        if field in item:
+                            cold.setdefault(list_field, {}).setdefault(field, {})[
+                                position
+                            ] = item.pop(field)
+                items.append(item)
+            main[list_field] = items
+
+        main[self.META] = {
+            "partitioned": partitioned,
+            "partitions": [
+                *partitions,
+                *(p for p in keep_partitions if p not in partitions),
+            ],
+            "cold": bool(cold) or keep_cold,
+        }
+        shards = {f"{key}_{partition}": v for partition, v in partitions.items()}
+        if cold:
+            shards[f"{key}_cold"] = cold
+        shards[key] = main
+        return shards
+
+    def partitions(self, main) -> list[str]:
+        """Partitions the main shard refers to"""
+        if not isinstance(main, dict) or self.META not in main:
+            return []
+        return main[self.META]["partitions"]
+
+    def has_cold(self, main) -> bool:
+        return isinstance(main, dict) and main.get(self.META, {}).get("cold", False)
+
+    def shard_keys(self, key: str, main, lazy: bool = False) -> list[str]:
+        """
+        Keys of the other shards the main shard refers to. With `lazy`, only the current partition
+        and no cold shard.
+        """
+        partitions = self.partitions(main)
+        if lazy and self.current_partition:
+            partitions = [p for p in partitions if p == self.current_partition()]
+        keys = [f"{key}_{partition}" for partition in partitions]
+        if self.has_cold(main) and not lazy:
+            keys.append(f"{key}_cold")
+        return keys
+
+    def join(
+        self,
+        key: str,
+        shards: dict[str, object],
+        load_cold: Callable[[], dict] | None = None,
+    ):
+        """
+        Assembles the value from its shards, as listed by `shard_keys`. Without the cold shard,
+        the items get their cold fields from `load_cold` when one of them is first accessed.
+        """
+        main = shards[key]
+        if not isinstance(main, dict) or self.META not in main:
+            # Stored before it was sharded
+            return main
+        main = dict(main)
+        meta = main.pop(self.META)
+        for field in meta["partitioned"]:
+            main[field] = {}
+        for partition in meta["partitions"]:
+            for field, entry in shards.get(f"{key}_{partition}", {}).items():
+                main[field][partition] = entry
+        if meta["cold"] and f"{key}_cold" not in shards:
+            for list_field in self.cold_fields:
+                if isinstance(main.get(list_field), list):
+                    main[list_field] = [
+                        ColdItem(item, list_field, position, load_cold)
+                        if isinstance(item, dict) and load_cold
+                        else item
+                        for position, item in enumerate(main[list_field])
+                    ]
+        elif meta["cold"]:
+            for list_field in self.cold_fields:
+                if isinstance(main.get(list_field), list):
+                    main[list_field] = list(main[list_field])
+            for list_field, fields in shards[f"{key}_cold"].items():
+                for field, values in fields.items():
+                    for position, entry in values.items():
+                        main[list_field][position] = {
+                            **main[list_field][position],
+                            field: entry,
+                        }
+        return main
+
+
+class ColdItem(dict):
+    """
+    A list item whose cold fields (see ShardLayout) are read when one of them is first accessed
+    with `item[field]`. `item.get(field)` and `field in item` don't read them.
+    """
+
+    def __init__(
+        self, item: dict, list_field: str, position: int, load_cold: Callable[[], dict]
+    ):
+        super().__init__(item)
+        self.list_field = list_field
+        self.position = position
+        self.load_cold = load_cold
+
+    def fill(self) -> None:
+        for field, values in self.load_cold().get(self.list_field, {}).items():
+            if self.position in values and field not in self:
+                self[field] = copy.deepcopy(values[self.position])
+
+    def __missing__(self, field):
+        self.fill()
+        if field in self:
+            return self[field]
+        raise KeyError(field)
+
+
+class ShardedStorage(BaseDiscourseStorage):
+    """
+    Stores the keys with a ShardLayout in several shards of the wrapped storage and writes only the
+    shards which changed. All other keys and attributes are passed through.
+
+    The shards of a value are read with one `get_many` after the main shard, and written with one
+    `put_many`, the main shard last. A checked `put` compares the revision of every changed shard.
+    It's atomic if the wrapped storage's `put_many` is, like SQLiteStorage's.
+
+    Only the current partition is read, and the cold shard only once a cold field is accessed
+    (see ColdItem), or a write moves the items around.
+    """
+
+    def __init__(self, storage: BaseDiscourseStorage, layouts: dict[str, ShardLayout]):
+        super().__init__(storage.client)
+        self.storage = storage
+        self.layouts = layouts
+        # Shards as last read or written, to find the changed ones
+        self._shards: Dict[str, object] = {}
+        # Per key: partitions which weren't read, and the cold shard's loader and list lengths
+        # if it wasn't read
+        self._unread: Dict[str, dict] = {}
+        # Guards the two above, jobs on other threads share the storage
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        if name == "storage":
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def get(self, key, default=None) -> Dict:
+        return self.get_versioned(key, default)[0]
+
+    def get_versioned(self, key, default=None) -> tuple[Dict, object]:
+        if key not in self.layouts:
+            return self.storage.get_versioned(key, default)
+        with self._lock:
+            return self._get_sharded(key, default)
+
+    def _get_sharded(self, key, default) -> tuple[Dict, object]:
+        layout = self.layouts[key]
+        main = self.storage.get_versioned(key, default)
+        shards = {key: main}
+        shards.update(
+            self.storage.get_many_versioned(layout.shard_keys(key, main[0], lazy=True))
+        )
+        for shard_key, (shard, _) in shards.items():
+            self._shards[shard_key] = copy.deepcopy(shard)
+        revisions = {k: revision for k, (_, revision) in shards.items()}
+
+        cold_key = f"{key}_cold"
+        cold = {}
+
+        def load_cold() -> dict:
+            with self._lock:
+                if not cold:
+                    shard, revision = self.storage.get_versioned(cold_key, {})
+                    self._shards[cold_key] = copy.deepcopy(shard)
+                    revisions[cold_key] = revision
+                    cold["shard"] = shard
+                return cold["shard"]
+
+        unread = {
+            "partitions": [
+                p for p in layout.partitions(main[0]) if f"{key}_{p}" not in shards
+            ],
+            "load_cold": None,
+        }
+        if layout.has_cold(main[0]):
+            unread["load_cold"] = load_cold
+            unread["lengths"] = {
+                field: len(main[0][field])
+                for field in layout.cold_fields
+                if isinstance(main[0].get(field), list)
+            }
+        self._unread[key] = unread
+
+        value = layout.join(
+            key, {k: shard for k, (shard, _) in shards.items()}, load_cold
+        )
+        if ANY_REVISION in revisions.values():
+            return value, ANY_REVISION
+        return value, revisions
+
+    @staticmethod
+    def _cold_unchanged(layout: ShardLayout, value, unread: dict) -> bool:
+        """If the items of the cold shard, which wasn't read, are still where they were stored"""
+        for list_field, length in unread["lengths"].items():
+            items = value.get(list_field)
+            if not isinstance(items, list) or len(items) != length:
+                return False
+            for position, item in enumerate(items):
+                if (
+                    not isinstance(item, ColdItem)
+                    or item.position != position
+                    or any(field in item for field in layout.cold_fields[list_field])
+                ):
+                    return False
+        return True
+
+    def get_many_versioned(self, keys, default=None) -> dict[str, tuple[Dict, object]]:
+        keys = list(keys)
+        values = self.storage.get_many_versioned(
+            [key for key in keys if key not in self.layouts], default
+        )
+        return {
+            key: values[key] if key in values else self.get_versioned(key, default)
+            for key in keys
+        }
+
+    def put(self, key, value, expected_revision=ANY_REVISION):
+        if key not in self.layouts:
+            self.storage.put(key, value, expected_revision=expected_revision)
+            return
+        with self._lock:
+            self._put_sharded(key, value, expected_revision)
+
+    def _put_sharded(self, key, value, expected_revision) -> None:
+        layout = self.layouts[key]
+        unread = self._unread.get(key, {"partitions": [], "load_cold": None})
+        keep_cold = False
+        if unread["load_cold"] and isinstance(value, dict):
+            if self._cold_unchanged(layout, value, unread):
+                keep_cold = True
+            else:
+                # The whole cold shard is rewritten, so all items need their cold fields
+                for list_field in layout.cold_fields:
+                    for item in value.get(list_field) or []:
+                        if isinstance(item, ColdItem):
+                            item.fill()
+                unread["load_cold"] = None
+        shards = layout.split(key, value, unread["partitions"], keep_cold)
+
+        revisions = {}
+        if expected_revision is not ANY_REVISION:
+            revisions.update(expected_revision)
+        for partition in unread["partitions"]:
+            shard_key = f"{key}_{partition}"
+            if shard_key in shards:
+                # Written without being read, keep its other fields
+                stored, revisions[shard_key] = self.storage.get_versioned(shard_key, {})
+                shards[shard_key] = {**stored, **shards[shard_key]}
+                self._shards[shard_key] = copy.deepcopy(stored)
+
+        changed = {
+            shard_key: shard
+            for shard_key, shard in shards.items()
+            if shard_key not in self._shards or self._shards[shard_key] != shard
+        }
+        expected_revisions = None
+        if expected_revision is not ANY_REVISION:
+            expected_revisions = {k: revisions.get(k) for k in changed}
+        self.storage.put_many(changed, expected_revisions)
+        for shard_key, shard in changed.items():
+            self._shards[shard_key] = copy.deepcopy(shard)
+
+    def stats(self) -> dict:
+        return self.storage.stats()
+
+    def close(self) -> None:
+        self.storage.close()
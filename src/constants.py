@@ -13,6 +13,63 @@ DISCOURSE_CREDENTIALS = {
     "host": DISCOURSE_HOST,
 }
 
+# Connection pool, conditional GET cache and timeout (connect, read) used for all requests to Discourse
+DISCOURSE_HTTP_OPTIONS = {
+    "pool_connections": int(os.getenv("DISCOURSE_POOL_CONNECTIONS", 4)),
+    "pool_maxsize": int(os.getenv("DISCOURSE_POOL_MAXSIZE", 8)),
+    "response_cache_size": int(os.getenv("DISCOURSE_RESPONSE_CACHE_SIZE", 256)),
+    "timeout": (
+        float(os.getenv("DISCOURSE_CONNECT_TIMEOUT", 10)),
+        float(os.getenv("DISCOURSE_READ_TIMEOUT", 60)),
+    ),
+}
+
+# Seconds a value read from or written to the storage is reused without checking the post's revision
+DISCOURSE_STORAGE_CACHE_TTL = float(os.getenv("DISCOURSE_STORAGE_CACHE_TTL", 10))
+# Seconds we remember that a storage key doesn't exist before searching for it again
+DISCOURSE_STORAGE_MISSING_TTL = float(os.getenv("DISCOURSE_STORAGE_MISSING_TTL", 300))
+
+# "discourse" keeps the data in PMs to ourself, "sqlite" in a local database at STORAGE_SQLITE_PATH.
+# With STORAGE_MIRROR, the sqlite backend also writes every change to the forum.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "discourse")
+STORAGE_SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", "forumbot.sqlite3")
+STORAGE_MIRROR = os.getenv("STORAGE_MIRROR", "true").lower() in ("true", "1", "yes")
+# Format new values are written in: "yaml" or "json". Existing values are read in the format they were written in.
+STORAGE_CODEC = os.getenv("STORAGE_CODEC", "yaml")
+# Writes values to the forum zlib compressed. Smaller, but not readable in the forum anymore.
+STORAGE_COMPRESS = os.getenv("STORAGE_COMPRESS", "false").lower() in (
+    "true",
+    "1",
+    "yes",
+)
+# The forum's "max post length" setting. We warn when a storage value gets close to it.
+DISCOURSE_MAX_POST_LENGTH = int(os.getenv("DISCOURSE_MAX_POST_LENGTH", 32000))
+# Writes only the changes to the forum, as replies to the storage PM. After STORAGE_JOURNAL_COMPACT_AFTER
+# replies, the whole value is written to the first post again.
+STORAGE_JOURNAL = os.getenv("STORAGE_JOURNAL", "false").lower() in ("true", "1", "yes")
+STORAGE_JOURNAL_COMPACT_AFTER = int(os.getenv("STORAGE_JOURNAL_COMPACT_AFTER", 50))
+# Stores the "voucher" storage in several PMs, see tasks.voucher.STORAGE_LAYOUT. Moves existing
+# data on its first write, and fewer bytes per write cost more reads.
+STORAGE_SHARDING = os.getenv("STORAGE_SHARDING", "false").lower() in (
+    "true",
+    "1",
+    "yes",
+)
+# Local copy of the forum storage, so a restart doesn't need to download everything again. Disabled if
+# empty. The file belongs to one forum, use a separate one per DISCOURSE_HOST.
+STORAGE_SNAPSHOT_PATH = os.getenv("STORAGE_SNAPSHOT_PATH") or None
+
+# Token buckets for reads (GET) and writes, and one shared by all requests. Discourse allows 60 admin
+# API requests per minute; the shared bucket allows at most 0.75 * 60 + 10 = 55 in any minute.
+DISCOURSE_RATE_LIMITS = {
+    "read_rate": float(os.getenv("DISCOURSE_READS_PER_SECOND", 0.75)),
+    "read_burst": float(os.getenv("DISCOURSE_READ_BURST", 10)),
+    "write_rate": float(os.getenv("DISCOURSE_WRITES_PER_SECOND", 0.5)),
+    "write_burst": float(os.getenv("DISCOURSE_WRITE_BURST", 10)),
+    "total_rate": float(os.getenv("DISCOURSE_REQUESTS_PER_SECOND", 0.75)),
+    "total_burst": float(os.getenv("DISCOURSE_REQUEST_BURST", 10)),
+}
+
 CCC_CATEGORY_NAME = os.getenv("CCC_CATEGORY_NAME", "ccc")
 
 CATEGORY_ID_MAPPING = {
@@ -23,6 +80,16 @@ CATEGORY_ID_MAPPING = {
 
 SENTRY_DSN = os.getenv("SENTRY_DSN")
 
+# Prometheus text file with request metrics, rewritten every minute. Disabled if empty.
+METRICS_FILE = os.getenv("METRICS_FILE")
+
+# Receive Discourse webhooks (post_created, topic_created) on this port. Disabled if empty.
+# Polling then only runs every WEBHOOK_POLL_MINUTES as a fallback for missed events.
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT") or 0)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_POLL_MINUTES = int(os.getenv("WEBHOOK_POLL_MINUTES", 15))
+
 IMAP_HOST = os.getenv("IMAP_HOST", "mail.flipdot.org")
 IMAP_USERNAME = os.getenv("IMAP_USERNAME")
 IMAP_PASSWORD = os.getenv("IMAP_PASSWORD")
@@ -37,3 +104,6 @@ FORCE_VOUCHER_PHASE = os.getenv("FORCE_VOUCHER_PHASE", "false").lower() in (
 assert DISCOURSE_CREDENTIALS["api_key"], (
     "Environment variable DISCOURSE_API_KEY not set"
 )
+assert WEBHOOK_SECRET or not WEBHOOK_PORT, (
+    "Environment variable WEBHOOK_SECRET not set, but required for WEBHOOK_PORT"
+)
@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from client import AsyncDiscourseStorageClient, DiscourseStorageClient
+
+INBOX_STORAGE_KEY = "pm_inbox"
+# Without a cursor (first run), only look for unread messages in conversations with activity during this period
+UNREAD_MESSAGES_LOOKBACK = timedelta(days=7)
+# Conversations whose last handled post number we keep. Older ones (lower topic ids) fall back to
+# the read state from Discourse when they get a new post.
+MAX_HANDLED_TOPICS = 1000
+
+
+class InboxSync:
+    """
+    Finds private messages with posts we haven't handled yet.
+
+    The state lives in the storage: a cursor (`bumped_at` of the newest conversation we've seen)
+    and the last handled post number of the newest conversations. Each sync only walks the PM
+    list down to the cursor and only fetches conversations with new posts from somebody else,
+    so its cost is proportional to the new activity.
+    """
+
+    def __init__(self, client: DiscourseStorageClient):
+        self.client = client
+        state = client.storage.get(INBOX_STORAGE_KEY, {})
+        self.cursor: str | None = state.get("cursor")
+        self.handled: dict[int, int] = dict(state.get("handled") or {})
+        self._listed: dict[int, dict] = {}
+        self._pending: dict[int, dict] = {}
+        self._saved_state = self._state()
+
+    def _state(self) -> dict:
+        return {"cursor": self.cursor, "handled": dict(self.handled)}
+
+    def _needs_handling(self, topic: dict) -> bool:
+        if topic.get("last_poster_username") == self.client.api_username:
+            # We had the last word, nothing to answer
+            return False
+        if topic["id"] in self.handled:
+            return topic["highest_post_number"] > self.handled[topic["id"]]
+        # Conversations we haven't seen since the cursor: rely on the read state from Discourse
+        return (
+            topic["unseen"]
+            or topic["last_read_post_number"] is None
+            or topic["highest_post_number"] > topic["last_read_post_number"]
+        )
+
+    def pending(self) -> list[tuple[dict, dict]]:
+        """Returns (topic, posts) of every conversation with unhandled posts, oldest first."""
+        if self.cursor:
+            since = datetime.fromisoformat(self.cursor)
+        else:
+            since = datetime.now(timezone.utc) - UNREAD_MESSAGES_LOOKBACK
+
+        for topic in self.client.iter_private_messages(since=since):
+            self._listed[topic["id"]] = topic
+            if self._needs_handling(topic):
+                self._pending[topic["id"]] = topic
+            else:
+                self.handled[topic["id"]] = topic["highest_post_number"]
+
+        topics = sorted(self._pending.values(), key=lambda t: t["bumped_at"])
+        return list(zip(topics, asyncio.run(self._fetch_posts(topics))))
+
+    async def _fetch_posts(self, topics: list[dict]) -> list[dict]:
+        async_client = AsyncDiscourseStorageClient(self.client)
+
+        def all_posts(topic_id):
+            return {"post_stream": {"posts": list(self.client.iter_posts(topic_id))}}
+
+        return await asyncio.gather(
+            *(async_client.run(all_posts, topic["id"]) for topic in topics)
+        )
+
+    def mark_handled(self, topic: dict) -> None:
+        self.handled[topic["id"]] = topic["highest_post_number"]
+        self._pending.pop(topic["id"], None)
+
+    def save(self) -> None:
+        """
+        Moves the cursor and persists the state. If some conversations could not be handled,
+        the cursor stays before them, so they are picked up again by the next sync.
+        """
+        if self._pending:
+            self.cursor = min(t["bumped_at"] for t in self._pending.values())
+        elif self._listed:
+            self.cursor = max(t["bumped_at"] for t in self._listed.values())
+        # Conversations bumped before the cursor are listed again when they get a new post,
+        # so their post numbers are kept as well
+        newest = sorted(self.handled, reverse=True)[:MAX_HANDLED_TOPICS]
+        self.handled = {topic_id: self.handled[topic_id] for topic_id in newest}
+
+        state = self._state()
+        if state != self._saved_state:
+            self.client.storage.put(INBOX_STORAGE_KEY, state)
+            self._saved_state = state
@@ -0,0 +1,240 @@
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from contextvars import copy_context
+from dataclasses import dataclass
+from datetime import datetime, time, timedelta, timezone
+from typing import Callable, Iterable
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceLocks:
+    """
+    Named locks for the resources jobs use, like a storage key or the IMAP connection.
+    Locks of other components can be registered, e.g. a storage key's lock, so jobs and
+    code outside of jobs exclude each other.
+    """
+
+    def __init__(self):
+        self._locks: dict[str, threading.RLock] = {}
+        self._guard = threading.Lock()
+
+    def register(self, name: str, lock) -> None:
+        with self._guard:
+            self._locks[name] = lock
+
+    def get(self, name: str):
+        with self._guard:
+            return self._locks.setdefault(name, threading.RLock())
+
+    @contextmanager
+    def hold(self, names: Iterable[str]):
+        """Acquires the locks, always in the same order so jobs can't deadlock"""
+        with ExitStack() as stack:
+            for name in sorted(set(names)):
+                stack.enter_context(self.get(name))
+            yield
+
+
+@dataclass
+class Job:
+    name: str
+    fn: Callable
+    args: tuple
+    kwargs: dict
+    # Either runs every `interval`, or daily at the wall-clock time `at`
+    interval: timedelta | None = None
+    at: time | None = None
+    # Names of the ResourceLocks held while the job runs
+    resources: tuple[str, ...] = ()
+    next_run: datetime | None = None
+    running: bool = False
+    runs: int = 0
+    failures: int = 0
+    lateness: float = 0.0
+    max_lateness: float = 0.0
+    run_seconds: float = 0.0
+
+    def schedule_after(self, previous: datetime, now: datetime, tz) -> datetime:
+        """The first run time after `now`, keeping the rhythm of `previous`"""
+        if self.interval:
+            missed = (now - previous) // self.interval
+            return previous + self.interval * (missed + 1)
+        day = now.astimezone(tz).date()
+        while True:
+            # pytz picks the right UTC offset for the day, also around DST changes
+            run = tz.localize(datetime.combine(day, self.at))
+            if run > now:
+                return run
+            day += timedelta(days=1)
+
+    def __str__(self) -> str:
+        when = f"every {self.interval}" if self.interval else f"daily at {self.at}"
+        return f"{self.name} {when}, next run at {self.next_run.isoformat()}"
+
+
+class JobScheduler:
+    """
+    Runs jobs at their due time. The jobs are kept in a heap ordered by their next run, so the
+    main loop can sleep until exactly the next one is due instead of checking every second.
+
+    Due jobs run on a pool of `workers` threads. A job holds the locks of the resources it
+    declares while it runs, so jobs using the same resources run one after another, while
+    others overlap. A job which is still running when it's due again skips that run.
+
+    Daily jobs run at a wall-clock time in `tz`, independent of the timezone of the host.
+    A job which starts more than `late_after` after its due time is logged, and its lateness is
+    kept for the metrics. A failing job is logged and runs again at its next time.
+    """
+
+    def __init__(
+        self,
+        tz: str = "Europe/Berlin",
+        late_after: timedelta = timedelta(seconds=30),
+        clock: Callable[[], datetime] | None = None,
+        workers: int = 4,
+        locks: ResourceLocks | None = None,
+    ):
+        self.tz = pytz.timezone(tz)
+        self.late_after = late_after
+        self._clock = clock or (lambda: datetime.now(timezone.utc))
+        self._queue: list[tuple[datetime, int, Job]] = []
+        self._counter = itertools.count()
+        self.locks = locks or ResourceLocks()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="job")
+        self._futures: set[Future] = set()
+
+    @staticmethod
+    def _name(fn: Callable) -> str:
+        # Partials and other callables have no name
+        name = getattr(fn, "__name__", type(fn).__name__)
+        module = getattr(fn, "__module__", None)
+        if module in (None, "__main__"):
+            return name
+        return f"{module}.{name}"
+
+    def _push(self, job: Job, run: datetime) -> None:
+        job.next_run = run
+        heapq.heappush(self._queue, (run, next(self._counter), job))
+
+    def every(
+        self,
+        interval: timedelta,
+        fn: Callable,
+        *args,
+        resources: Iterable[str] = (),
+        **kwargs,
+    ) -> Job:
+        """Runs `fn` every `interval`, the first time after one interval"""
+        job = Job(
+            self._name(fn),
+            fn,
+            args,
+            kwargs,
+            interval=interval,
+            resources=tuple(resources),
+        )
+        self._push(job, self._clock() + interval)
+        return job
+
+    def daily(
+        self, at: str, fn: Callable, *args, resources: Iterable[str] = (), **kwargs
+    ) -> Job:
+        """Runs `fn` every day at `at` ("HH:MM") in the scheduler's timezone"""
+        job = Job(
+            self._name(fn),
+            fn,
+            args,
+            kwargs,
+            at=time.fromisoformat(at),
+            resources=tuple(resources),
+        )
+        now = self._clock()
+        self._push(job, job.schedule_after(now, now, self.tz))
+        return job
+
+    def submit(
+        self, fn: Callable, *args, resources: Iterable[str] = (), **kwargs
+    ) -> Future:
+        """Runs `fn` once on the pool, e.g. to handle an event"""
+        job = Job(self._name(fn), fn, args, kwargs, resources=tuple(resources))
+        return self._start(job, self._clock())
+
+    @property
+    def jobs(self) -> list[Job]:
+        return [job for _, _, job in sorted(self._queue)]
+
+    def wait_time(self, limit: float = 3600) -> float:
+        """
+        Seconds until the next job is due. Capped at `limit`, so a jump of the system clock
+        doesn't delay the jobs for long.
+        """
+        if not self._queue:
+            return limit
+        seconds = (self._queue[0][0] - self._clock()).total_seconds()
+        return min(max(seconds, 0.0), limit)
+
+    def _run(self, job: Job, due: datetime) -> None:
+        with self.locks.hold(job.resources):
+            started = self._clock()
+            job.lateness = (started - due).total_seconds()
+            job.max_lateness = max(job.max_lateness, job.lateness)
+            if job.lateness > self.late_after.total_seconds():
+                logger.warning(
+                    f"Job {job.name} started {job.lateness:.1f}s late (due at {due.isoformat()})"
+                )
+            try:
+                job.fn(*job.args, **job.kwargs)
+            except Exception:
+                job.failures += 1
+                logger.exception(f"Job {job.name} failed")
+            finally:
+                job.runs += 1
+                job.run_seconds = (self._clock() - started).total_seconds()
+                job.running = False
+
+    def _start(self, job: Job, due: datetime) -> Future:
+        job.running = True
+        # Every job gets its own copy of the context variables, like the request priority
+        future = self._executor.submit(copy_context().run, self._run, job, due)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    def run_pending(self) -> int:
+        """Starts all jobs which are due, returns how many were started"""
+        started = 0
+        while self._queue and self._queue[0][0] <= self._clock():
+            due, _, job = heapq.heappop(self._queue)
+            if job.running:
+                logger.warning(f"Job {job.name} is still running, skipping a run")
+            else:
+                self._start(job, due)
+                started += 1
+            self._push(job, job.schedule_after(due, self._clock(), self.tz))
+        return started
+
+    def join(self, timeout: float | None = None) -> None:
+        """Waits for the running jobs"""
+        wait(list(self._futures), timeout)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            job.name: {
+                "runs": job.runs,
+                "failures": job.failures,
+                "lateness_seconds": job.lateness,
+                "max_lateness_seconds": job.max_lateness,
+                "run_seconds": job.run_seconds,
+            }
+            for job in self.jobs
+        }
@@ -7,6 +7,7 @@ from datetime import datetime, timedelta
 import pytz
 
 from constants import IMAP_HOST, IMAP_USERNAME, IMAP_PASSWORD
+from metrics import request_metrics
 from tasks.voucher import process_email_voucheringress
 
 logger = logging.getLogger(__name__)
@@ -42,18 +43,27 @@ def read_emails(discourse_client: DiscourseStorageClient, days_back: int = 90):
             "Environment variables `IMAP_USERNAME` and / or `IMAP_PASSWORD` missing. Skipping email processing."
         )
         return
-    mail = imaplib.IMAP4_SSL(IMAP_HOST)
-    mail.login(IMAP_USERNAME, IMAP_PASSWORD)
-    mail.select("inbox")
+    with request_metrics.track("imap", "login") as call:
+        mail = imaplib.IMAP4_SSL(IMAP_HOST)
+        call.status = mail.login(IMAP_USERNAME, IMAP_PASSWORD)[0]
+    with request_metrics.track("imap", "select") as call:
+        call.status = mail.select("inbox")[0]
 
     today = datetime.now(pytz.timezone("Europe/Berlin"))
     since_date = imap_date_format(today - timedelta(days=days_back))
 
-    status, messages = mail.search(None, f"SINCE {since_date}")
+    with request_metrics.track("imap", "search") as call:
+        status, messages = mail.search(None, f"SINCE {since_date}")
+        call.status = status
     mail_ids = messages[0].split()
 
     for mail_id in mail_ids:
-        status, msg_data = mail.fetch(mail_id, "(RFC822)")
+        with request_metrics.track("imap", "fetch") as call:
+            status, msg_data = mail.fetch(mail_id, "(RFC822)")
+            call.status = status
+            call.bytes_received = sum(
+                len(part[1]) for part in msg_data if isinstance(part, tuple)
+            )
         for response_part in msg_data:
             if not isinstance(response_part, tuple):
                 continue
@@ -0,0 +1,175 @@
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import requests
+
+
+@dataclass
+class EndpointStats:
+    count: int = 0
+    errors: int = 0
+    seconds: float = 0.0
+    max_seconds: float = 0.0
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    status_codes: Counter = field(default_factory=Counter)
+
+
+@dataclass
+class TrackedCall:
+    status: int | str | None = None
+    bytes_sent: int = 0
+    bytes_received: int = 0
+    error: bool = False
+
+    def response(self, response: requests.Response) -> None:
+        """Takes status code and sizes from a `requests` response."""
+        self.status = response.status_code
+        self.bytes_received = len(response.content)
+        body = response.request.body if response.request else None
+        self.bytes_sent = len(body) if body else 0
+        self.error = response.status_code >= 400
+
+
+def endpoint_label(path: str) -> str:
+    """Groups URLs like /t/123/posts.json as /t/{id}/posts.json"""
+    path = path.split("?", 1)[0]
+    return re.sub(r"/\d+(?=[/.]|$)", "/{id}", path)
+
+
+class RequestMetrics:
+    """
+    Collects timings, sizes, status codes and errors of outgoing calls per system (discourse,
+    pad, imap) and endpoint. They can be exported in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: dict[tuple[str, str], EndpointStats] = {}
+
+    def observe(
+        self,
+        system: str,
+        endpoint: str,
+        seconds: float,
+        status: int | str | None = None,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+        error: bool = False,
+    ) -> None:
+        with self._lock:
+            stats = self._stats.setdefault((system, endpoint), EndpointStats())
+            stats.count += 1
+            stats.errors += int(error)
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            if status is not None:
+                stats.status_codes[str(status)] += 1
+
+    @contextmanager
+    def track(self, system: str, endpoint: str):
+        """
+        Times the block. Details like the status code can be set on the yielded TrackedCall.
+        Exceptions are counted as errors and re-raised.
+        """
+        call = TrackedCall()
+        start = time.perf_counter()
+        try:
+            yield call
+        except Exception:
+            call.error = True
+            raise
+        finally:
+            self.observe(
+                system,
+                endpoint,
+                time.perf_counter() - start,
+                status=call.status,
+                bytes_sent=call.bytes_sent,
+                bytes_received=call.bytes_received,
+                error=call.error,
+            )
+
+    def snapshot(self) -> dict[tuple[str, str], EndpointStats]:
+        with self._lock:
+            return {
+                key: EndpointStats(
+                    stats.count,
+                    stats.errors,
+                    stats.seconds,
+                    stats.max_seconds,
+                    stats.bytes_sent,
+                    stats.bytes_received,
+                    Counter(stats.status_codes),
+                )
+                for key, stats in self._stats.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def render(self, gauges: dict[str, float] | None = None) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        `gauges` are added as additional `forumbot_<name>` gauges.
+        """
+        snapshot = self.snapshot()
+        counters = [
+            ("requests_total", "Number of requests", lambda s: s.count),
+            ("request_errors_total", "Number of failed requests", lambda s: s.errors),
+            (
+                "request_seconds_total",
+                "Total time spent in requests",
+                lambda s: round(s.seconds, 6),
+            ),
+            (
+                "request_seconds_max",
+                "Slowest request",
+                lambda s: round(s.max_seconds, 6),
+            ),
+            ("request_bytes_sent_total", "Bytes sent", lambda s: s.bytes_sent),
+            (
+                "request_bytes_received_total",
+                "Bytes received",
+                lambda s: s.bytes_received,
+            ),
+        ]
+        lines = []
+        for name, description, value in counters:
+            metric_type = "gauge" if name.endswith("_max") else "counter"
+            lines.append(f"# HELP forumbot_{name} {description}")
+            lines.append(f"# TYPE forumbot_{name} {metric_type}")
+            for (system, endpoint), stats in sorted(snapshot.items()):
+                labels = f'system="{system}",endpoint="{endpoint}"'
+                lines.append(f"forumbot_{name}{{{labels}}} {value(stats)}")
+
+        lines.append("# HELP forumbot_responses_total Responses by status code")
+        lines.append("# TYPE forumbot_responses_total counter")
+        for (system, endpoint), stats in sorted(snapshot.items()):
+            for status, count in sorted(stats.status_codes.items()):
+                labels = f'system="{system}",endpoint="{endpoint}",status="{status}"'
+                lines.append(f"forumbot_responses_total{{{labels}}} {count}")
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE forumbot_{name} gauge")
+            lines.append(f"forumbot_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: Path, gauges: dict[str, float] | None = None) -> None:
+        """Atomically rewrites the metrics file, e.g. for the node_exporter textfile collector."""
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(self.render(gauges))
+        os.replace(tmp_path, path)
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,147 @@
+"""
+Serialization of storage values. Every document starts with a header line naming its format,
+e.g. `#storage-format: json/1`, so the codec can be switched at any time: documents are always
+read with the codec they were written with, and rewritten in the configured one on the next put.
+Documents without header are plain YAML, as written by earlier versions.
+
+Compressed documents (header e.g. `#storage-format: yaml/1+zlib`) contain the zlib compressed,
+base85 encoded document in a fenced code block, so the forum doesn't render it as markdown.
+"""
+
+import base64
+import json
+import re
+import zlib
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+import yaml
+
+HEADER_PREFIX = "#storage-format: "
+COMPRESSION = "zlib"
+LINE_LENGTH = 76
+
+
+class UnknownFormatError(ValueError):
+    pass
+
+
+class StorageCodec(ABC):
+    name: str
+    version: int = 1
+
+    @abstractmethod
+    def dumps(self, value) -> str: ...
+
+    @abstractmethod
+    def loads(self, data: str): ...
+
+
+class YamlCodec(StorageCodec):
+    """Uses the libyaml C bindings when PyYAML was built with them"""
+
+    name = "yaml"
+
+    def __init__(self, use_libyaml: bool = True):
+        use_libyaml = use_libyaml and yaml.__with_libyaml__
+        self.loader = yaml.CSafeLoader if use_libyaml else yaml.SafeLoader
+        self.dumper = yaml.CSafeDumper if use_libyaml else yaml.SafeDumper
+
+    def dumps(self, value) -> str:
+        # Same output as yaml.safe_dump, keys are sorted
+        return yaml.dump(value, Dumper=self.dumper)
+
+    def loads(self, data: str):
+        return yaml.load(data, Loader=self.loader)
+
+
+class JsonCodec(StorageCodec):
+    """
+    JSON keeps only strings as object keys and has no dates. To read back exactly what was
+    written (like YAML does), those are wrapped in tagged objects.
+    """
+
+    name = "json"
+
+    @classmethod
+    def _encode(cls, value):
+        if isinstance(value, dict):
+            if all(isinstance(k, str) for k in value):
+                return {k: cls._encode(v) for k, v in value.items()}
+            return {
+                "$items": [[cls._encode(k), cls._encode(v)] for k, v in value.items()]
+            }
+        if isinstance(value, (list, tuple)):
+            return [cls._encode(v) for v in value]
+        if isinstance(value, datetime):
+            return {"$datetime": value.isoformat()}
+        if isinstance(value, date):
+            return {"$date": value.isoformat()}
+        return value
+
+    @staticmethod
+    def _decode_object(obj: dict):
+        if len(obj) == 1:
+            if "$datetime" in obj:
+                return datetime.fromisoformat(obj["$datetime"])
+            if "$date" in obj:
+                return date.fromisoformat(obj["$date"])
+            if "$items" in obj:
+                return {k: v for k, v in obj["$items"]}
+        return obj
+
+    def dumps(self, value) -> str:
+        return json.dumps(
+            self._encode(value), sort_keys=True, ensure_ascii=False, indent=1
+        )
+
+    def loads(self, data: str):
+        return json.loads(data, object_hook=self._decode_object)
+
+
+CODECS: dict[str, StorageCodec] = {
+    codec.name: codec for codec in (YamlCodec(), JsonCodec())
+}
+
+
+def _compress(body: str) -> str:
+    packed = base64.b85encode(zlib.compress(body.encode(), 9)).decode()
+    lines = [packed[i : i + LINE_LENGTH] for i in range(0, len(packed), LINE_LENGTH)]
+    # base85 uses backticks, the fence must be longer than any run of them
+    longest = max((len(run) for run in re.findall("`+", packed)), default=0)
+    fence = "`" * max(3, longest + 1)
+    return "\n".join([fence, *lines, fence]) + "\n"
+
+
+def _decompress(body: str) -> str:
+    lines = body.strip().splitlines()
+    return zlib.decompress(base64.b85decode("".join(lines[1:-1]))).decode()
+
+
+def encode(value, codec: str = "yaml", compress: bool = False) -> str:
+    storage_codec = CODECS[codec]
+    header = f"{HEADER_PREFIX}{storage_codec.name}/{storage_codec.version}"
+    body = storage_codec.dumps(value)
+    if compress:
+        return f"{header}+{COMPRESSION}\n{_compress(body)}"
+    return f"{header}\n{body}"
+
+
+def decode(data: str):
+    if not data.startswith(HEADER_PREFIX):
+        return CODECS["yaml"].loads(data)
+    header, _, body = data.partition("\n")
+    codec_format, _, compression = (
+        header.removeprefix(HEADER_PREFIX).strip().partition("+")
+    )
+    name, _, version = codec_format.partition("/")
+    storage_codec = CODECS.get(name)
+    if (
+        not storage_codec
+        or int(version or 1) > storage_codec.version
+        or compression not in ("", COMPRESSION)
+    ):
+        raise UnknownFormatError(f"Unknown storage format: {header}")
+    if compression:
+        body = _decompress(body)
+    return storage_codec.loads(body)
@@ -0,0 +1,52 @@
+"""
+Deltas between two storage values, so a change can be written without rewriting the whole value.
+
+A delta is a list of operations `[op, path, argument]`, with `path` the list of dict keys and
+list indices leading to the changed element:
+
+- `["set", path, value]` sets the element (an empty path replaces the whole value)
+- `["del", path]` removes a dict entry
+- `["extend", path, items]` appends items to a list
+"""
+
+
+def diff(old, new, path: tuple = ()) -> list[list]:
+    """Returns the operations which turn `old` into `new`"""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = [["del", [*path, key]] for key in old if key not in new]
+        for key, value in new.items():
+            if key not in old:
+                ops.append(["set", [*path, key], value])
+            elif old[key] != value:
+                ops += diff(old[key], value, (*path, key))
+        return ops
+    if isinstance(old, list) and isinstance(new, list) and len(old) <= len(new):
+        # Lists mostly grow at the end, like the voucher history
+        ops = []
+        for index, (old_item, new_item) in enumerate(zip(old, new)):
+            if old_item != new_item:
+                ops += diff(old_item, new_item, (*path, index))
+        if len(new) > len(old):
+            ops.append(["extend", list(path), new[len(old) :]])
+        return ops
+    return [["set", list(path), new]]
+
+
+def apply(value, ops: list[list]):
+    """Applies the operations of `diff` to `value` in place and returns the result"""
+    for op, path, *args in ops:
+        if op == "set" and not path:
+            value = args[0]
+            continue
+        parent = value
+        for key in path[:-1]:
+            parent = parent[key]
+        if op == "set":
+            parent[path[-1]] = args[0]
+        elif op == "del":
+            del parent[path[-1]]
+        elif op == "extend":
+            (parent[path[-1]] if path else value).extend(args[0])
+        else:
+            raise ValueError(f"Unknown journal operation: {op}")
+    return value
@@ -10,6 +10,10 @@ PROTOCOL_PLACEHOLDER = "PROTOCOL_PLACEHOLDER"
 
 PLENUM_CATEGORY_NAME = "test" if DEBUG else "orga/plena"
 
+# Plenum topics are announced up to four weeks in advance. Older topics are not relevant for us,
+# so we don't need to page through the whole category.
+PLENUM_TOPIC_LOOKBACK = timedelta(days=60)
+
 
 def get_next_plenum_date(now: datetime) -> Tuple[datetime, timedelta]:
     next_days = (now + timedelta(days=i) for i in count())
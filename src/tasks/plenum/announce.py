@@ -8,7 +8,9 @@ from tasks.plenum import (
     PAD_BASE_URL,
     PROTOCOL_PLACEHOLDER,
     PLENUM_CATEGORY_NAME,
+    PLENUM_TOPIC_LOOKBACK,
 )
+from metrics import request_metrics
 from utils import render
 from datetime import datetime
 import pytz
@@ -26,7 +28,9 @@ def main(client: DiscourseStorageClient) -> None:
     title = plenum_date.strftime("%Y-%m-%d Plenum")
     topics = [
         x["title"]
-        for x in client.category_topics(PLENUM_CATEGORY_NAME)["topic_list"]["topics"]
+        for x in client.iter_category_topics(
+            PLENUM_CATEGORY_NAME, since=now - PLENUM_TOPIC_LOOKBACK
+        )
     ]
 
     if topic_exists(title, topics):
@@ -39,13 +43,15 @@ def main(client: DiscourseStorageClient) -> None:
     pad_template = render(
         "plenum_pad_template.md", plenum_date=plenum_date, topics=plenum_topics
     ).encode("utf-8")
-    res = requests.post(
-        PAD_BASE_URL + "/new",
-        data=pad_template,
-        headers={
-            "Content-Type": "text/markdown; charset=utf-8",
-        },
-    )
+    with request_metrics.track("pad", "POST /new") as call:
+        res = requests.post(
+            PAD_BASE_URL + "/new",
+            data=pad_template,
+            headers={
+                "Content-Type": "text/markdown; charset=utf-8",
+            },
+        )
+        call.response(res)
     if res.status_code != 200:
         logging.error("Could not generate a new pad")
         return
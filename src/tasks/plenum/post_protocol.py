@@ -8,10 +8,12 @@ import mistune
 import numpy as np
 
 from client import DiscourseStorageClient
+from metrics import request_metrics
 from tasks.plenum import (
     get_next_plenum_date,
     PROTOCOL_PLACEHOLDER,
     PLENUM_CATEGORY_NAME,
+    PLENUM_TOPIC_LOOKBACK,
 )
 from utils import render
 
@@ -64,7 +66,9 @@ def main(client: DiscourseStorageClient) -> None:
     title = plenum_date.strftime("%Y-%m-%d Plenum")
     topics = [
         x
-        for x in client.category_topics(PLENUM_CATEGORY_NAME)["topic_list"]["topics"]
+        for x in client.iter_category_topics(
+            PLENUM_CATEGORY_NAME, since=now - PLENUM_TOPIC_LOOKBACK
+        )
         if x["title"] == title
     ]
 
@@ -98,7 +102,9 @@ def main(client: DiscourseStorageClient) -> None:
 
     pad_link = pad_links[0]
 
-    res = requests.get(pad_link + "/download")
+    with request_metrics.track("pad", "GET /{pad}/download") as call:
+        res = requests.get(pad_link + "/download")
+        call.response(res)
     if res.status_code != 200:
         logging.error("Could not download protocol from pad. Aborting")
         return
@@ -8,7 +8,7 @@ from typing import List, Optional, Dict
 import re
 from dateutil.parser import parse
 from constants import DISCOURSE_HOST
-from tasks.plenum import PLENUM_CATEGORY_NAME
+from tasks.plenum import PLENUM_CATEGORY_NAME, PLENUM_TOPIC_LOOKBACK
 
 
 def extract_plenum_date_from_topic(topic: Dict[str, str]) -> Optional[datetime]:
@@ -55,7 +55,12 @@ TOPIC_LINK_BASE = DISCOURSE_HOST + "/t/"
 
 
 def main(client: DiscourseStorageClient) -> None:
-    topics = client.category_topics(PLENUM_CATEGORY_NAME)["topic_list"]["topics"]
+    now = datetime.now(pytz.timezone("Europe/Berlin"))
+    topics = list(
+        client.iter_category_topics(
+            PLENUM_CATEGORY_NAME, since=now - PLENUM_TOPIC_LOOKBACK
+        )
+    )
 
     latest = latest_topic(topics)
     if not latest:
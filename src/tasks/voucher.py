@@ -1,3 +1,4 @@
+import asyncio
 import base64
 import logging
 import re
@@ -10,9 +11,15 @@ import random
 import pytz
 from pydiscourse import DiscourseClient
 from pydiscourse.exceptions import DiscourseClientError
+from requests import RequestException
 
 import constants
-from client import DiscourseStorageClient
+from client import (
+    AsyncDiscourseStorageClient,
+    DiscourseStorageClient,
+    RequestPriority,
+    ShardLayout,
+)
 from gantt import plot_gantt_chart
 from babel.dates import format_date
 
@@ -32,6 +39,18 @@ VoucherConfigElement = Dict
 
 VoucherConfig = List[VoucherConfigElement]
 
+# The storage "voucher" is written by almost every job. Most of them only change the queue or a
+# voucher's owner, so the per-congress data and the growing voucher history are stored separately.
+STORAGE_LAYOUT = ShardLayout(
+    partitioned_fields=(
+        "voucher_topics",
+        "voucher_phase_range",
+        "voucher_history_image",
+    ),
+    cold_fields={"voucher": ("history",)},
+    current_partition=lambda: get_congress_id(),
+)
+
 
 def handle_private_message_bedarf(
     client: DiscourseStorageClient, topic, posts, posts_content
@@ -44,15 +63,27 @@ def handle_private_message_bedarf(
     else:
         persons = int(persons[0])
 
-    data = client.storage.get("voucher", {"voucher": [], "queue": [], "demand": {}})
-    demand = data.setdefault("demand", {})
     name = posts["post_stream"]["posts"][-1]["username"]
+    removed = False
+
+    def update_demand(data):
+        nonlocal removed
+        demand = data.setdefault("demand", {})
+        if persons == 0:
+            removed = demand.pop(name, None) is not None
+            if removed:
+                data["queue"] = [u for u in data.get("queue", []) if u != name]
+        else:
+            demand[name] = persons
+        return data
+
+    # Doesn't overwrite changes made to the vouchers in the meantime, e.g. by another instance
+    client.storage.update(
+        "voucher", update_demand, {"voucher": [], "queue": [], "demand": {}}
+    )
 
     if persons == 0:
-        if name in demand:
-            del demand[name]
-            data["queue"] = [u for u in data.get("queue", []) if u != name]
-            client.storage.put("voucher", data)
+        if removed:
             client.create_post(
                 "0 Voucher also? Okay, ich habe dich aus der Warteschlange entfernt.",
                 topic_id=topic["id"],
@@ -69,8 +100,6 @@ def handle_private_message_bedarf(
             )
         return
 
-    demand[name] = persons
-    client.storage.put("voucher", data)
     # send a confirmation to the user
     client.create_post(
         f"Alles klar! Ich habe dich für {persons} Voucher vorgemerkt. Falls du es dir anders überlegst, "
@@ -92,22 +121,20 @@ def handle_private_message_gesamtbedarf(
         return
 
     persons = int(persons[0])
-    data = client.storage.get("voucher")
-    if data.get("voucher"):
-        client.create_post(
-            "Wir haben doch schon Voucher erhalten. Ist jetzt ein bisschen spät für ne Abschätzung.",
-            topic_id=topic["id"],
-        )
-        return
-    if data.get("total_persons_reported"):
-        client.create_post(
-            "Es wurde bereits eine Anzahl an Personen gemeldet.",
-            topic_id=topic["id"],
-        )
-        return
-    data["total_persons_reported"] = persons
-
-    client.storage.put("voucher", data)
+    with client.storage.transaction("voucher") as data:
+        if data.get("voucher"):
+            client.create_post(
+                "Wir haben doch schon Voucher erhalten. Ist jetzt ein bisschen spät für ne Abschätzung.",
+                topic_id=topic["id"],
+            )
+            return
+        if data.get("total_persons_reported"):
+            client.create_post(
+                "Es wurde bereits eine Anzahl an Personen gemeldet.",
+                topic_id=topic["id"],
+            )
+            return
+        data["total_persons_reported"] = persons
     client.create_post(
         f"Danke für die Information! Ich schreibe in meinen Post, dass du {persons} Personen "
         f"an die Congress Organisation gemeldet hast.",
@@ -142,33 +169,30 @@ def handle_private_message_voucher_list(
         )
         return
 
-    data = client.storage.get("voucher")
-
-    if data["voucher"]:
-        logger.error("Voucher list already exists. Is somebody trolling us?")
-        client.create_post(
-            "Es existiert bereits eine Voucher-Liste. Ich kann nur eine Liste verwalten.",
-            topic_id=topic["id"],
-        )
-        return
-
-    logging.info("Saving new vouchers to storage")
-    username = posts["post_stream"]["posts"][0]["username"]
-    data["voucher"] = [
-        {
-            "index": i,
-            "voucher": v,
-            "owner": None,
-            "old_owner": username,
-            "message_id": None,
-            "persons": None,
-            "received_at": datetime.now(pytz.timezone("Europe/Berlin")),
-            "history": [],
-        }
-        for i, v in enumerate(received_voucher)
-    ]
+    with client.storage.transaction("voucher") as data:
+        if data["voucher"]:
+            logger.error("Voucher list already exists. Is somebody trolling us?")
+            client.create_post(
+                "Es existiert bereits eine Voucher-Liste. Ich kann nur eine Liste verwalten.",
+                topic_id=topic["id"],
+            )
+            return
 
-    client.storage.put("voucher", data)
+        logging.info("Saving new vouchers to storage")
+        username = posts["post_stream"]["posts"][0]["username"]
+        data["voucher"] = [
+            {
+                "index": i,
+                "voucher": v,
+                "owner": None,
+                "old_owner": username,
+                "message_id": None,
+                "persons": None,
+                "received_at": datetime.now(pytz.timezone("Europe/Berlin")),
+                "history": [],
+            }
+            for i, v in enumerate(received_voucher)
+        ]
     client.create_post(
         f"Danke für die Liste! Ich habe {len(received_voucher)} Voucher gefunden abgespeichert. "
         f"Ich werde sie nun an die Interessenten verteilen.",
@@ -200,31 +224,28 @@ def handle_private_message_voucher_phase_range(
         )
         return
 
-    data = client.storage.get("voucher")
-
-    if "voucher_phase_range" not in data:
-        data["voucher_phase_range"] = {}
-
-    parsed_ranges = {
-        "start": datetime.fromisoformat(phase_range[1]).astimezone(
-            pytz.timezone("Europe/Berlin")
-        ),
-        "end": datetime.fromisoformat(phase_range[2]).astimezone(
-            pytz.timezone("Europe/Berlin")
-        ),
-    }
-
-    formatted_ranges = {
-        "start": format_date(parsed_ranges["start"], format="long", locale="de_DE"),
-        "end": format_date(parsed_ranges["end"], format="long", locale="de_DE"),
-    }
+    with client.storage.transaction("voucher") as data:
+        if "voucher_phase_range" not in data:
+            data["voucher_phase_range"] = {}
+
+        parsed_ranges = {
+            "start": datetime.fromisoformat(phase_range[1]).astimezone(
+                pytz.timezone("Europe/Berlin")
+            ),
+            "end": datetime.fromisoformat(phase_range[2]).astimezone(
+                pytz.timezone("Europe/Berlin")
+            ),
+        }
 
-    data["voucher_phase_range"][get_congress_id()] = {
-        "start": parsed_ranges["start"],
-        "end": parsed_ranges["end"],
-    }
+        formatted_ranges = {
+            "start": format_date(parsed_ranges["start"], format="long", locale="de_DE"),
+            "end": format_date(parsed_ranges["end"], format="long", locale="de_DE"),
+        }
 
-    client.storage.put("voucher", data)
+        data["voucher_phase_range"][get_congress_id()] = {
+            "start": parsed_ranges["start"],
+            "end": parsed_ranges["end"],
+        }
     client.create_post(
         f"Danke für die Information! Ich schreibe in meinen Post, dass die Voucher "
         f"vom {formatted_ranges['start']} bis {formatted_ranges['end']} genutzt werden können.",
@@ -245,39 +266,38 @@ def handle_private_message_voucher_exhausted_at(
         )
         return
 
-    data = client.storage.get("voucher")
-
-    if (
-        "voucher_phase_range" not in data
-        or get_congress_id() not in data["voucher_phase_range"]
-    ):
-        client.create_post(
-            "Ich konnte keinen Zeitraum für die Voucher finden. "
-            "Bitte gib zuerst den Zeitraum mittels `VOUCHER-PHASE YYYY-MM-DD bis YYYY-MM-DD` an, bevor du mir "
-            "mitteilst, dass die Voucher erschöpft sind.",
-            topic_id=topic["id"],
-        )
-        return
-
-    start_date = data["voucher_phase_range"][get_congress_id()]["start"]
-    end_date = data["voucher_phase_range"][get_congress_id()]["end"]
+    with client.storage.transaction("voucher") as data:
+        if (
+            "voucher_phase_range" not in data
+            or get_congress_id() not in data["voucher_phase_range"]
+        ):
+            client.create_post(
+                "Ich konnte keinen Zeitraum für die Voucher finden. "
+                "Bitte gib zuerst den Zeitraum mittels `VOUCHER-PHASE YYYY-MM-DD bis YYYY-MM-DD` an, bevor du mir "
+                "mitteilst, dass die Voucher erschöpft sind.",
+                topic_id=topic["id"],
+            )
+            return
 
-    parsed_exhausted_at = datetime.fromisoformat(exhausted_at[1]).astimezone(
-        pytz.timezone("Europe/Berlin")
-    )
+        start_date = data["voucher_phase_range"][get_congress_id()]["start"]
+        end_date = data["voucher_phase_range"][get_congress_id()]["end"]
 
-    if parsed_exhausted_at < start_date or parsed_exhausted_at > end_date:
-        client.create_post(
-            "Der Zeitpunkt, an dem die Voucher erschöpft sein sollen, liegt nicht innerhalb des "
-            "Zeitraums, in dem die Voucher genutzt werden können. Bitte gib einen Zeitpunkt "
-            "zwischen dem Start- und Enddatum der Voucherphase an.",
-            topic_id=topic["id"],
+        parsed_exhausted_at = datetime.fromisoformat(exhausted_at[1]).astimezone(
+            pytz.timezone("Europe/Berlin")
         )
-        return
 
-    data["voucher_phase_range"][get_congress_id()]["exhausted_at"] = parsed_exhausted_at
+        if parsed_exhausted_at < start_date or parsed_exhausted_at > end_date:
+            client.create_post(
+                "Der Zeitpunkt, an dem die Voucher erschöpft sein sollen, liegt nicht innerhalb des "
+                "Zeitraums, in dem die Voucher genutzt werden können. Bitte gib einen Zeitpunkt "
+                "zwischen dem Start- und Enddatum der Voucherphase an.",
+                topic_id=topic["id"],
+            )
+            return
 
-    client.storage.put("voucher", data)
+        data["voucher_phase_range"][get_congress_id()]["exhausted_at"] = (
+            parsed_exhausted_at
+        )
     client.create_post(
         "Danke für die Information! Ich aktualisiere die Grafik in meinem Post.",
         topic_id=topic["id"],
@@ -291,49 +311,51 @@ def private_message_handler(client: DiscourseStorageClient, topic, posts) -> boo
     topic_id = topic["id"]
 
     if "VOUCHER_JETZT_EINLOESEN" in posts_content:
-        data = client.storage.get("voucher")
-
-        # Find if this topic belongs to an offer
-        voucher_to_award = None
-        for voucher in data.get("voucher", []):
-            for offer in voucher.get("offered_to", []):
-                if offer["message_id"] == topic_id and offer["username"] == username:
-                    voucher_to_award = voucher
+        with client.storage.transaction("voucher") as data:
+            # Find if this topic belongs to an offer
+            voucher_to_award = None
+            for voucher in data.get("voucher", []):
+                for offer in voucher.get("offered_to", []):
+                    if (
+                        offer["message_id"] == topic_id
+                        and offer["username"] == username
+                    ):
+                        voucher_to_award = voucher
+                        break
+                if voucher_to_award:
                     break
-            if voucher_to_award:
-                break
-
-        if not voucher_to_award:
-            # User sent the trigger in a random thread or they were not offered THIS voucher
-            return False
-
-        if voucher_to_award.get("owner"):
-            # Voucher already gone (someone else accepted faster)
-            client.create_post(
-                "Dein Voucher ist ausgelaufen. Du erhältst eine Nachricht, wenn wieder ein Voucher verfügbar ist",
-                topic_id=topic_id,
-            )
-            return True
-
-        # Award the voucher
-        voucher_to_award["owner"] = username
-        # Removal from queue is needed: only remove ONE occurrence
-        if username in data.get("queue", []):
-            data["queue"].remove(username)
 
-        # Send voucher code to THIS topic
-        send_voucher_to_user(client, voucher_to_award, topic_id=topic_id)
+            if not voucher_to_award:
+                # User sent the trigger in a random thread or they were not offered THIS voucher
+                return False
 
-        # Notify other people who had offers for this voucher
-        for offer in voucher_to_award.get("offered_to", []):
-            if offer["username"] != username:
+            if voucher_to_award.get("owner"):
+                # Voucher already gone (someone else accepted faster)
                 client.create_post(
                     "Dein Voucher ist ausgelaufen. Du erhältst eine Nachricht, wenn wieder ein Voucher verfügbar ist",
-                    topic_id=offer["message_id"],
+                    topic_id=topic_id,
                 )
-
-        voucher_to_award["offered_to"] = []
-        client.storage.put("voucher", data)
+                return True
+
+            # Award the voucher
+            voucher_to_award["owner"] = username
+            # Removal from queue is needed: only remove ONE occurrence
+            if username in data.get("queue", []):
+                data["queue"].remove(username)
+
+            # Send voucher code to THIS topic
+            send_voucher_to_user(client, voucher_to_award, topic_id=topic_id)
+
+            # Notify other people who had offers for this voucher
+            with client.request_priority(RequestPriority.NOTIFICATION):
+                for offer in voucher_to_award.get("offered_to", []):
+                    if offer["username"] != username:
+                        client.create_post(
+                            "Dein Voucher ist ausgelaufen. Du erhältst eine Nachricht, wenn wieder ein Voucher verfügbar ist",
+                            topic_id=offer["message_id"],
+                        )
+
+            voucher_to_award["offered_to"] = []
         return True
 
     bedarf_strings = ["voucher-bedarf", "voucherbedarf", "voucher bedarf"]
@@ -425,7 +447,7 @@ def encode_voucher_identifier(index: int, history_length: int, congress_id: str)
 
 
 def send_voucher_to_user(
-    client: DiscourseClient,
+    client: DiscourseStorageClient,
     voucher: VoucherConfigElement,
     topic_id: Optional[int] = None,
 ):
@@ -443,20 +465,21 @@ def send_voucher_to_user(
         voucher_ingress_email=voucher_ingress_email,
     )
     logging.info(f"Sending voucher to {username}")
-    if topic_id:
-        client.create_post(
-            message_content,
-            topic_id=topic_id,
-        )
-        message_id = topic_id
-    else:
-        res = client.create_post(
-            message_content,
-            title=f"Dein {get_congress_id()} Voucher",
-            archetype="private_message",
-            target_recipients=username,
-        )
-        message_id = res.get("topic_id")
+    with client.request_priority(RequestPriority.VOUCHER_DELIVERY):
+        if topic_id:
+            client.create_post(
+                message_content,
+                topic_id=topic_id,
+            )
+            message_id = topic_id
+        else:
+            res = client.create_post(
+                message_content,
+                title=f"Dein {get_congress_id()} Voucher",
+                archetype="private_message",
+                target_recipients=username,
+            )
+            message_id = res.get("topic_id")
 
     logging.info(f"Sent, message_id is {message_id}")
     voucher["message_id"] = message_id
@@ -495,24 +518,24 @@ def send_offer_to_user(
 
 
 def send_message_to_user(
-    client: DiscourseClient, voucher: VoucherConfigElement, message: str
+    client: DiscourseStorageClient, voucher: VoucherConfigElement, message: str
 ) -> None:
     username = voucher["owner"]
     message_id = voucher.get("message_id")
     if not message_id:
         return
     logging.info(f"Sending message to {username} (Thread {message_id})")
-    client.create_post(message, topic_id=message_id)
+    with client.request_priority(RequestPriority.NOTIFICATION):
+        client.create_post(message, topic_id=message_id)
 
 
 def check_for_returned_voucher(
-    client: DiscourseClient, voucher: VoucherConfigElement
+    client: DiscourseStorageClient, voucher: VoucherConfigElement
 ) -> Optional[str]:
     message_id = voucher["message_id"]
-    posts = client.posts(message_id)
     user_posts = [
         post
-        for post in posts["post_stream"]["posts"]
+        for post in client.iter_posts(message_id)
         if post["username"] != constants.DISCOURSE_CREDENTIALS["api_username"]
     ]
     user_posts_content = " ".join([p["cooked"] for p in user_posts])
@@ -521,6 +544,81 @@ def check_for_returned_voucher(
         return new_voucher[0]
 
 
+def find_changed_voucher_threads(
+    client: DiscourseStorageClient, vouchers: VoucherConfig, cursor: str | None = None
+) -> tuple[VoucherConfig, Dict[int, int], str | None]:
+    """
+    Uses the PM list to find the voucher threads which got new posts since we last
+    checked them. The list is only walked down to `cursor`, the `bumped_at` of the newest
+    PM of the last walk, so a deleted or archived thread doesn't make us page through the
+    whole inbox. Threads missing from the list are treated as changed, unless they were
+    checked before and are just older than the cursor.
+    Returns the vouchers whose threads need to be checked, the highest post number
+    of every listed thread and the new cursor.
+    """
+    wanted = {v["message_id"] for v in vouchers}
+    highest_post_numbers = {}
+    newest = cursor
+    since = datetime.fromisoformat(cursor) if cursor else None
+    try:
+        # Stop paging as soon as we've seen all threads we're interested in
+        for topic in client.iter_private_messages(since=since):
+            bumped_at = topic.get("bumped_at")
+            if bumped_at and not topic.get("pinned") and bumped_at > (newest or ""):
+                newest = bumped_at
+            if topic["id"] in wanted:
+                highest_post_numbers[topic["id"]] = topic["highest_post_number"]
+                if len(highest_post_numbers) == len(wanted):
+                    break
+    except RequestException:
+        logger.exception("Could not list private messages. Checking all threads.")
+        return vouchers, {}, cursor
+
+    def is_changed(voucher) -> bool:
+        if voucher["message_id"] in highest_post_numbers:
+            return highest_post_numbers[voucher["message_id"]] > voucher.get(
+                "checked_post_number", 0
+            )
+        return since is None or "checked_post_number" not in voucher
+
+    changed = [v for v in vouchers if is_changed(v)]
+    return changed, highest_post_numbers, newest
+
+
+def find_returned_vouchers(
+    client: DiscourseStorageClient, vouchers: VoucherConfig
+) -> List[Optional[str]]:
+    """
+    Runs `check_for_returned_voucher` for all given vouchers concurrently.
+    Returns the returned voucher codes in the same order as `vouchers`.
+    """
+
+    async def check_all():
+        async_client = AsyncDiscourseStorageClient(client)
+        return await asyncio.gather(
+            *(
+                async_client.run(check_for_returned_voucher, client, voucher)
+                for voucher in vouchers
+            )
+        )
+
+    if not vouchers:
+        return []
+    return asyncio.run(check_all())
+
+
+def handle_voucher_thread_post(client: DiscourseStorageClient, topic_id: int) -> bool:
+    """
+    Called when a new post arrives in `topic_id`. If it is the thread of an assigned voucher,
+    the distribution runs right away so returned vouchers are picked up without waiting for the next poll.
+    """
+    data = client.storage.get("voucher", {})
+    if not any(v.get("message_id") == topic_id for v in data.get("voucher", [])):
+        return False
+    process_voucher_distribution(client)
+    return True
+
+
 def get_topic(title: str, topics):
     for t in topics:
         if title == t["title"]:
@@ -605,97 +703,119 @@ def render_post_content(data: dict) -> str:
 
 
 def process_voucher_distribution(client: DiscourseStorageClient):
-    data = client.storage.get("voucher", {"voucher": [], "queue": [], "demand": {}})
-    now = datetime.now(pytz.timezone("Europe/Berlin"))
+    with client.storage.transaction(
+        "voucher", {"voucher": [], "queue": [], "demand": {}}
+    ) as data:
+        now = datetime.now(pytz.timezone("Europe/Berlin"))
 
-    # Track who already has an active offer to avoid offering them multiple vouchers
-    all_offered_users = set()
-    for v in data.get("voucher", []):
-        for offer in v.get("offered_to", []):
-            all_offered_users.add(offer["username"])
-
-    for voucher in data.get("voucher", []):
-        if voucher.get("message_id"):
-            # The voucher is already assigned to someone. Check if they returned it
-            new_voucher_code = check_for_returned_voucher(client, voucher)
-            if new_voucher_code:
-                logging.info(f"Voucher returned by {voucher['owner']}")
-                send_message_to_user(
-                    client,
-                    voucher,
-                    message=f'Prima, vielen Dank für "{new_voucher_code}"!',
-                )
+        # Track who already has an active offer to avoid offering them multiple vouchers
+        all_offered_users = set()
+        for v in data.get("voucher", []):
+            for offer in v.get("offered_to", []):
+                all_offered_users.add(offer["username"])
+
+        # Vouchers which are already assigned to someone. Check if they returned it,
+        # but only look into threads with new posts.
+        assigned_vouchers = [v for v in data.get("voucher", []) if v.get("message_id")]
+        changed_vouchers, highest_post_numbers, cursor = find_changed_voucher_threads(
+            client, assigned_vouchers, data.get("voucher_thread_cursor")
+        )
+        if cursor:
+            data["voucher_thread_cursor"] = cursor
+        returned_voucher_codes = dict(
+            zip(
+                (id(v) for v in changed_vouchers),
+                find_returned_vouchers(client, changed_vouchers),
+            )
+        )
 
-                now = datetime.now(pytz.timezone("Europe/Berlin"))
-                voucher["voucher"] = new_voucher_code
-                voucher["old_owner"] = voucher["owner"]
-                voucher["owner"] = None
-                voucher["message_id"] = None
-                voucher["history"][-1]["returned_at"] = now.isoformat()
-                voucher["received_at"] = now
-
-        if not voucher.get("owner"):
-            # Check for active offers on this voucher
-            offered_to = voucher.get("offered_to", [])
-            last_offer = offered_to[-1] if offered_to else None
-
-            needs_new_offer = False
-            if not last_offer:
-                needs_new_offer = True
-            else:
-                offered_at = datetime.fromisoformat(
-                    last_offer["offered_at"]
-                ).astimezone(pytz.timezone("Europe/Berlin"))
-                if now - offered_at > timedelta(hours=3):
-                    needs_new_offer = True
+        for voucher in data.get("voucher", []):
+            if voucher.get("message_id"):
+                new_voucher_code = returned_voucher_codes.get(id(voucher))
+                if (
+                    not new_voucher_code
+                    and voucher["message_id"] in highest_post_numbers
+                ):
+                    voucher["checked_post_number"] = highest_post_numbers[
+                        voucher["message_id"]
+                    ]
+                if new_voucher_code:
+                    logging.info(f"Voucher returned by {voucher['owner']}")
+                    send_message_to_user(
+                        client,
+                        voucher,
+                        message=f'Prima, vielen Dank für "{new_voucher_code}"!',
+                    )
 
-            if needs_new_offer:
-                next_recipient = None
-                # Try to find a recipient in the existing queue; if none found, replenish from demand and try once more.
-                for _ in range(2):
-                    for user in data.get("queue", []):
-                        if user not in all_offered_users:
-                            next_recipient = user
+                    now = datetime.now(pytz.timezone("Europe/Berlin"))
+                    voucher["voucher"] = new_voucher_code
+                    voucher["old_owner"] = voucher["owner"]
+                    voucher["owner"] = None
+                    voucher["message_id"] = None
+                    voucher.pop("checked_post_number", None)
+                    voucher["history"][-1]["returned_at"] = now.isoformat()
+                    voucher["received_at"] = now
+
+            if not voucher.get("owner"):
+                # Check for active offers on this voucher
+                offered_to = voucher.get("offered_to", [])
+                last_offer = offered_to[-1] if offered_to else None
+
+                needs_new_offer = False
+                if not last_offer:
+                    needs_new_offer = True
+                else:
+                    offered_at = datetime.fromisoformat(
+                        last_offer["offered_at"]
+                    ).astimezone(pytz.timezone("Europe/Berlin"))
+                    if now - offered_at > timedelta(hours=3):
+                        needs_new_offer = True
+
+                if needs_new_offer:
+                    next_recipient = None
+                    # Try to find a recipient in the existing queue; if none found, replenish from demand and try once more.
+                    for _ in range(2):
+                        for user in data.get("queue", []):
+                            if user not in all_offered_users:
+                                next_recipient = user
+                                break
+
+                        if next_recipient:
                             break
 
-                    if next_recipient:
-                        break
+                        # No recipient found in current queue, replenish from demand
+                        demand = data.setdefault("demand", {})
+                        potential_recipients = [
+                            name for name, count in demand.items() if count > 0
+                        ]
+                        if not potential_recipients:
+                            break  # No more demand to replenish from
 
-                    # No recipient found in current queue, replenish from demand
-                    demand = data.setdefault("demand", {})
-                    potential_recipients = [
-                        name for name, count in demand.items() if count > 0
-                    ]
-                    if not potential_recipients:
-                        break  # No more demand to replenish from
-
-                    random.shuffle(potential_recipients)
-                    data.setdefault("queue", []).extend(potential_recipients)
-                    for name in potential_recipients:
-                        demand[name] -= 1
-                    # Continue to second iteration to find recipient in the replenished queue
-
-                if next_recipient:
-                    send_offer_to_user(client, voucher, next_recipient)
-                    all_offered_users.add(next_recipient)
-
-        # Legacy sending (still needed for when a voucher is finally accepted)
-        if not voucher.get("message_id") and voucher.get("owner"):
-            try:
-                send_voucher_to_user(client, voucher)
-            except DiscourseClientError:
-                logging.exception(
-                    f"Failed to send voucher {voucher['voucher']} to {voucher['owner']}"
-                )
-                voucher["retry_counter"] = voucher.get("retry_counter", 0) + 1
-                if voucher["retry_counter"] >= 10:
-                    logging.error(
-                        f"Giving up sending voucher {voucher['voucher']} to {voucher['owner']} after 10 attempts"
-                    )
-                    voucher["owner"] = None
-                    voucher["retry_counter"] = 0
+                        random.shuffle(potential_recipients)
+                        data.setdefault("queue", []).extend(potential_recipients)
+                        for name in potential_recipients:
+                            demand[name] -= 1
+                        # Continue to second iteration to find recipient in the replenished queue
 
-    client.storage.put("voucher", data)
+                    if next_recipient:
+                        send_offer_to_user(client, voucher, next_recipient)
+                        all_offered_users.add(next_recipient)
+
+            # Legacy sending (still needed for when a voucher is finally accepted)
+            if not voucher.get("message_id") and voucher.get("owner"):
+                try:
+                    send_voucher_to_user(client, voucher)
+                except DiscourseClientError:
+                    logging.exception(
+                        f"Failed to send voucher {voucher['voucher']} to {voucher['owner']}"
+                    )
+                    voucher["retry_counter"] = voucher.get("retry_counter", 0) + 1
+                    if voucher["retry_counter"] >= 10:
+                        logging.error(
+                            f"Giving up sending voucher {voucher['voucher']} to {voucher['owner']} after 10 attempts"
+                        )
+                        voucher["owner"] = None
+                        voucher["retry_counter"] = 0
 
 
 def get_congress_id(now: datetime | None = None) -> str:
@@ -713,49 +833,46 @@ def update_history_image(client: DiscourseStorageClient) -> None:
         logging.info("Not voucher season. Skipping.")
         return
 
-    data = client.storage.get("voucher", {})
-
-    if not data.get("voucher"):
-        return
-
-    phase_range = data.get("voucher_phase_range", {}).get(get_congress_id(), {})
-    if ts := phase_range.get("start"):
-        start_date = ts
-    else:
-        return
+    with client.storage.transaction("voucher", {}) as data:
+        if not data.get("voucher"):
+            return
 
-    if ts := phase_range.get("end"):
-        end_date = ts
-    else:
-        return
+        phase_range = data.get("voucher_phase_range", {}).get(get_congress_id(), {})
+        if ts := phase_range.get("start"):
+            start_date = ts
+        else:
+            return
 
-    if start_date > (now + timedelta(days=1)):
-        return
+        if ts := phase_range.get("end"):
+            end_date = ts
+        else:
+            return
 
-    if end_date < (now - timedelta(days=3)):
-        return
+        if start_date > (now + timedelta(days=1)):
+            return
 
-    exhausted_at = phase_range.get("exhausted_at")
-    fig = plot_gantt_chart(
-        data["voucher"],
-        start_date=start_date,
-        end_date=end_date,
-        exhausted_at=exhausted_at,
-    )
-    path = Path("gantt.png")
+        if end_date < (now - timedelta(days=3)):
+            return
 
-    fig.savefig(path)
-    res = client.upload_image(path, "png", synchronous=True)
+        exhausted_at = phase_range.get("exhausted_at")
+        fig = plot_gantt_chart(
+            data["voucher"],
+            start_date=start_date,
+            end_date=end_date,
+            exhausted_at=exhausted_at,
+        )
+        path = Path("gantt.png")
 
-    if "voucher_history_image" not in data:
-        data["voucher_history_image"] = {}
+        fig.savefig(path)
+        res = client.upload_image(path, "png", synchronous=True)
 
-    if "short_url" in res:
-        data["voucher_history_image"][get_congress_id()] = res
-    else:
-        logger.error(f"Unexpected response from Discourse: {res}")
+        if "voucher_history_image" not in data:
+            data["voucher_history_image"] = {}
 
-    client.storage.put("voucher", data)
+        if "short_url" in res:
+            data["voucher_history_image"][get_congress_id()] = res
+        else:
+            logger.error(f"Unexpected response from Discourse: {res}")
 
 
 def process_email_voucheringress(
@@ -793,21 +910,20 @@ def _mail_new_voucherlist(client: DiscourseStorageClient, msg: Message) -> None:
         return
     voucher_lines = voucher_match.group(1)
     voucher_codes = [line.strip() for line in voucher_lines.split()]
-    data = client.storage.get("voucher", {})
-    now = datetime.now(pytz.timezone("Europe/Berlin"))
-    data["voucher"] = [
-        {
-            "index": i,
-            "voucher": v,
-            "owner": None,
-            "old_owner": constants.DISCOURSE_CREDENTIALS["api_username"],
-            "message_id": None,
-            "received_at": now,
-            "history": [],
-        }
-        for i, v in enumerate(voucher_codes)
-    ]
-    client.storage.put("voucher", data)
+    with client.storage.transaction("voucher", {}) as data:
+        now = datetime.now(pytz.timezone("Europe/Berlin"))
+        data["voucher"] = [
+            {
+                "index": i,
+                "voucher": v,
+                "owner": None,
+                "old_owner": constants.DISCOURSE_CREDENTIALS["api_username"],
+                "message_id": None,
+                "received_at": now,
+                "history": [],
+            }
+            for i, v in enumerate(voucher_codes)
+        ]
     logging.info(f"Stored {len(voucher_codes)} fresh vouchers from email")
     post_content = render(
         "voucher_list_received.md",
@@ -845,88 +961,89 @@ def _mail_voucher_returned(
             },
         )
         return
-    data = client.storage.get("voucher", {})
-
-    if congress_id not in data.get("voucher_topics", {}):
-        logger.info(
-            f"No active voucher topic for {congress_id}, ignoring returned voucher."
-        )
-        return
-
-    now = datetime.now(pytz.timezone("Europe/Berlin"))
-    if phase_range := data.get("voucher_phase_range", {}).get(congress_id):
-        end_date = phase_range.get("end")
-        if end_date and now > end_date:
+    with client.storage.transaction("voucher", {}) as data:
+        if congress_id not in data.get("voucher_topics", {}):
             logger.info(
-                f"Voucher phase for {congress_id} ended on {end_date}, ignoring returned voucher."
+                f"No active voucher topic for {congress_id}, ignoring returned voucher."
             )
             return
 
-    try:
-        voucher = data["voucher"][voucher_index]
-    except IndexError:
-        logger.error(
-            "Invalid voucher index in email",
-            extra={
-                "mail_param": mail_param,
-                "voucher_index": voucher_index,
-                "mail_to": msg.get("To"),
-                "mail_from": msg.get("From"),
-                "mail_subject": msg.get("Subject"),
-                "mail_date": msg.get("Date"),
-            },
-        )
-        return
-    assert voucher["index"] == voucher_index, "List index and voucher index mismatch"
-    if len(voucher["history"]) != history_length:
-        logger.info(
-            "Mail was already processed, because history length mismatched",
-            extra={
-                "mail_param": mail_param,
-                "voucher_index": voucher_index,
-                "expected_history_length": history_length,
-                "actual_history_length": len(voucher["history"]),
-                "mail_to": msg.get("To"),
-                "mail_from": msg.get("From"),
-                "mail_subject": msg.get("Subject"),
-                "mail_date": msg.get("Date"),
-            },
-        )
-        return
-    if voucher["owner"] is None:
-        logging.info(
-            "Mail was already processed, because voucher is already available (owner is None)",
+        now = datetime.now(pytz.timezone("Europe/Berlin"))
+        if phase_range := data.get("voucher_phase_range", {}).get(congress_id):
+            end_date = phase_range.get("end")
+            if end_date and now > end_date:
+                logger.info(
+                    f"Voucher phase for {congress_id} ended on {end_date}, ignoring returned voucher."
+                )
+                return
+
+        try:
+            voucher = data["voucher"][voucher_index]
+        except IndexError:
+            logger.error(
+                "Invalid voucher index in email",
+                extra={
+                    "mail_param": mail_param,
+                    "voucher_index": voucher_index,
+                    "mail_to": msg.get("To"),
+                    "mail_from": msg.get("From"),
+                    "mail_subject": msg.get("Subject"),
+                    "mail_date": msg.get("Date"),
+                },
+            )
+            return
+        assert voucher["index"] == voucher_index, (
+            "List index and voucher index mismatch"
         )
-        return
+        if len(voucher["history"]) != history_length:
+            logger.info(
+                "Mail was already processed, because history length mismatched",
+                extra={
+                    "mail_param": mail_param,
+                    "voucher_index": voucher_index,
+                    "expected_history_length": history_length,
+                    "actual_history_length": len(voucher["history"]),
+                    "mail_to": msg.get("To"),
+                    "mail_from": msg.get("From"),
+                    "mail_subject": msg.get("Subject"),
+                    "mail_date": msg.get("Date"),
+                },
+            )
+            return
+        if voucher["owner"] is None:
+            logging.info(
+                "Mail was already processed, because voucher is already available (owner is None)",
+            )
+            return
 
-    content = _mail_msg_to_str(msg, accepted_content_types=("text/plain",))
-    matches = re.search(r"CHAOS[a-zA-Z0-9]+", content)
-    if not matches:
-        logger.error(
-            "Couldn't find voucher code in email",
-            extra={
-                "mail_to": msg.get("To"),
-                "mail_from": msg.get("From"),
-                "mail_subject": msg.get("Subject"),
-                "mail_date": msg.get("Date"),
-            },
+        content = _mail_msg_to_str(msg, accepted_content_types=("text/plain",))
+        matches = re.search(r"CHAOS[a-zA-Z0-9]+", content)
+        if not matches:
+            logger.error(
+                "Couldn't find voucher code in email",
+                extra={
+                    "mail_to": msg.get("To"),
+                    "mail_from": msg.get("From"),
+                    "mail_subject": msg.get("Subject"),
+                    "mail_date": msg.get("Date"),
+                },
+            )
+            return
+        returned_voucher_code = matches.group(0)
+        now = datetime.now(pytz.timezone("Europe/Berlin"))
+        send_message_to_user(
+            client,
+            voucher,
+            message="Vielen Dank, ich habe den replizierten Voucher erhalten!",
         )
-        return
-    returned_voucher_code = matches.group(0)
-    now = datetime.now(pytz.timezone("Europe/Berlin"))
-    send_message_to_user(
-        client,
-        voucher,
-        message="Vielen Dank, ich habe den replizierten Voucher erhalten!",
-    )
 
-    voucher["voucher"] = returned_voucher_code
-    voucher["old_owner"] = voucher["owner"]
-    voucher["owner"] = None
-    voucher["message_id"] = None
-    voucher["history"][-1]["returned_at"] = now.isoformat()
-    voucher["received_at"] = now
-    client.storage.put("voucher", data)
+        voucher["voucher"] = returned_voucher_code
+        voucher["old_owner"] = voucher["owner"]
+        voucher["owner"] = None
+        voucher["message_id"] = None
+        voucher.pop("checked_post_number", None)
+        voucher["history"][-1]["returned_at"] = now.isoformat()
+        voucher["received_at"] = now
     logging.info(f"Voucher {returned_voucher_code} returned by email")
 
 
@@ -968,29 +1085,30 @@ def main(client: DiscourseStorageClient) -> None:
         logging.info("Not voucher season. Skipping.")
         return
 
+    # The distribution is saved before the topic is touched, so a failing topic update
+    # doesn't lose the messages which were already sent
     process_voucher_distribution(client)
 
-    topics = client.category_topics(constants.CCC_CATEGORY_NAME)["topic_list"]["topics"]
-
-    congress_id = get_congress_id(now)
-    title = f"Voucher {congress_id}"
-
-    data = client.storage.get("voucher", {})
-    if "voucher_topics" not in data:
-        data["voucher_topics"] = {}
-    voucher_topics = data["voucher_topics"]
-    topic_id = voucher_topics.get(congress_id)
-
-    if not topic_id:
-        if topic := get_topic(title, topics):
-            voucher_topics[congress_id] = topic["id"]
-            topic_id = topic["id"]
-
-    if topic_id:
-        topic_posts = client.topic_posts(topic_id)
-        post = topic_posts["post_stream"]["posts"][0]
-        update_voucher_topic(client, data, post["id"])
-    else:
-        create_voucher_topic(client, data, title, congress_id)
-
-    client.storage.put("voucher", data)
+    with client.storage.transaction(
+        "voucher", {"voucher": [], "queue": [], "demand": {}}
+    ) as data:
+        congress_id = get_congress_id(now)
+        title = f"Voucher {congress_id}"
+
+        if "voucher_topics" not in data:
+            data["voucher_topics"] = {}
+        voucher_topics = data["voucher_topics"]
+        topic_id = voucher_topics.get(congress_id)
+
+        if not topic_id:
+            topics = client.iter_category_topics(constants.CCC_CATEGORY_NAME)
+            if topic := get_topic(title, topics):
+                voucher_topics[congress_id] = topic["id"]
+                topic_id = topic["id"]
+
+        if topic_id:
+            topic_posts = client.topic_posts(topic_id)
+            post = topic_posts["post_stream"]["posts"][0]
+            update_voucher_topic(client, data, post["id"])
+        else:
+            create_voucher_topic(client, data, title, congress_id)
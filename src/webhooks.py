@@ -0,0 +1,125 @@
+import hashlib
+import hmac
+import json
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# Events we act on. Everything else is acknowledged and dropped.
+HANDLED_EVENTS = {"post_created", "topic_created"}
+MAX_BODY_SIZE = 1024 * 1024
+
+
+@dataclass
+class WebhookEvent:
+    name: str
+    payload: dict
+
+
+def sign(secret: str, body: bytes) -> str:
+    """Signature in the format of the X-Discourse-Event-Signature header"""
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def verify_signature(secret: str, body: bytes, signature: str | None) -> bool:
+    if not signature:
+        return False
+    return hmac.compare_digest(sign(secret, body), signature)
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    server: "WebhookServer"
+
+    def _reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if not self.headers.get("Content-Length"):
+            self._reply(411)
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._reply(400)
+            return
+        if length > MAX_BODY_SIZE:
+            self._reply(413)
+            return
+        body = self.rfile.read(length)
+
+        signature = self.headers.get("X-Discourse-Event-Signature")
+        if not verify_signature(self.server.secret, body, signature):
+            logger.warning(
+                f"Rejected webhook with invalid signature from {self.client_address[0]}"
+            )
+            self._reply(403)
+            return
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            self._reply(400)
+            return
+
+        name = self.headers.get("X-Discourse-Event", "")
+        if name in HANDLED_EVENTS:
+            self.server.events.put(WebhookEvent(name, payload))
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Receives Discourse webhooks in a background thread. Verified events are queued and
+    passed on by `handle_pending` in the main loop, which hands them to the job scheduler
+    with the storage keys they modify, so they wait for the jobs using the same keys.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str, port: int, secret: str):
+        super().__init__((host, port), WebhookRequestHandler)
+        self.secret = secret
+        self.events: queue.Queue[WebhookEvent] = queue.Queue()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f"Listening for webhooks on port {self.server_port}")
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def handle_pending(
+        self, handler: Callable[[WebhookEvent], None], timeout: float = 0
+    ) -> int:
+        """
+        Calls `handler` for every queued event, waiting up to `timeout` seconds for the first one.
+        A failing handler is logged and doesn't stop the others. Returns the number of events.
+        """
+        handled = 0
+        while True:
+            try:
+                event = self.events.get(block=timeout > 0, timeout=timeout or None)
+            except queue.Empty:
+                return handled
+            timeout = 0
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"Failed to handle webhook {event.name}")
+            handled += 1
@@ -1,6 +1,13 @@
 import pytest
+import responses as responses_module
 from dotenv import load_dotenv
-from client import DiscourseStorageClient, BaseDiscourseStorage
+from client import (
+    ANY_REVISION,
+    BaseDiscourseStorage,
+    DiscourseStorageClient,
+    StorageConflictError,
+)
+from tests.fake_discourse import FakeDiscourse
 
 load_dotenv(".env.unittests", override=True)
 
@@ -11,14 +18,21 @@ class DiscourseDummyStorage(BaseDiscourseStorage):
     def __init__(self, client: DiscourseStorageClient):
         super().__init__(client)
         self._storage = {}
+        self._revisions = {}
 
     def get(self, key, default=None):
         if key not in self._storage:
             return default or {}
         return self._storage[key]
 
-    def put(self, key, value):
+    def get_versioned(self, key, default=None):
+        return self.get(key, default), self._revisions.get(key)
+
+    def put(self, key, value, expected_revision=ANY_REVISION):
+        if expected_revision not in (ANY_REVISION, self._revisions.get(key)):
+            raise StorageConflictError(key)
         self._storage[key] = value
+        self._revisions[key] = self._revisions.get(key, 0) + 1
 
 
 @pytest.fixture
@@ -29,3 +43,22 @@ def dummy_storage_client(responses):
         api_key="secret-key",
         storage_cls=DiscourseDummyStorage,
     )
+
+
+@pytest.fixture
+def fake_discourse():
+    """In-process fake Discourse server. Requests to it are passed through by `responses`."""
+    with FakeDiscourse(username="testbot_username") as fake:
+        responses_module.add_passthru(fake.url)
+        yield fake
+
+
+@pytest.fixture
+def fake_discourse_client(fake_discourse):
+    client = DiscourseStorageClient(
+        host=fake_discourse.url,
+        api_username=fake_discourse.username,
+        api_key="secret-key",
+    )
+    yield client
+    client.close()
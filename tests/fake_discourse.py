@@ -0,0 +1,465 @@
+"""
+An in-process stand-in for the parts of the Discourse API (and the pad) the bot talks to.
+
+Topics and posts are kept in memory, so tasks can run end-to-end against it offline:
+
+    with FakeDiscourse(username="flipbot", latency=0.05) as fake:
+        client = DiscourseStorageClient(host=fake.url, api_username="flipbot", api_key="x")
+        fake.create_topic("Hallo", "Hi bot", username="alice", recipients=["flipbot"])
+        ...
+
+Requests made by the bot are recorded in `fake.requests`. `latency` delays every response,
+`fail_next()` injects errors like rate limits.
+"""
+
+import hashlib
+import html
+import itertools
+import json
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+TOPICS_PER_PAGE = 30
+POSTS_PER_CHUNK = 20
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+@dataclass
+class FakePost:
+    id: int
+    topic_id: int
+    post_number: int
+    username: str
+    raw: str
+    created_at: str = field(default_factory=_now)
+    updated_at: str = field(default_factory=_now)
+    version: int = 1
+
+    def to_json(self, api_username: str, include_raw: bool = False) -> dict:
+        data = {
+            "id": self.id,
+            "topic_id": self.topic_id,
+            "post_number": self.post_number,
+            "username": self.username,
+            "cooked": f"<p>{html.escape(self.raw)}</p>",
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+            "version": self.version,
+            "yours": self.username == api_username,
+            "link_counts": [
+                {"url": url, "internal": False, "clicks": 0}
+                for url in re.findall(r"https?://[^\s)\]]+", self.raw)
+            ],
+        }
+        if include_raw:
+            data["raw"] = self.raw
+        return data
+
+
+@dataclass
+class FakeTopic:
+    id: int
+    title: str
+    username: str
+    archetype: str = "regular"
+    category_id: int | None = None
+    allowed_users: set[str] = field(default_factory=set)
+    posts: list[FakePost] = field(default_factory=list)
+    created_at: str = field(default_factory=_now)
+    bumped_at: str = field(default_factory=_now)
+
+    @property
+    def is_private_message(self) -> bool:
+        return self.archetype == "private_message"
+
+    def to_list_json(self, api_username: str) -> dict:
+        own_posts = [p.post_number for p in self.posts if p.username == api_username]
+        last_read = max(own_posts) if own_posts else None
+        return {
+            "id": self.id,
+            "title": self.title,
+            "fancy_title": html.escape(self.title),
+            "archetype": self.archetype,
+            "category_id": self.category_id,
+            "posts_count": len(self.posts),
+            "highest_post_number": self.posts[-1].post_number if self.posts else 0,
+            "last_read_post_number": last_read,
+            "unseen": last_read is None,
+            "created_at": self.created_at,
+            "bumped_at": self.bumped_at,
+            "last_poster_username": self.posts[-1].username if self.posts else None,
+        }
+
+
+class FakeDiscourse:
+    def __init__(
+        self,
+        username: str = "flipbot",
+        categories: dict[str, int] | None = None,
+        latency: float = 0.0,
+    ):
+        """
+        :param username: the bot user, used for topics created through `create_topic` by default
+        :param categories: slug -> id of the categories known to the forum
+        :param latency: seconds every response is delayed
+        """
+        self.username = username
+        self.categories = categories or {"ccc": 17, "orga/plena": 23, "test": 24}
+        self.latency = latency
+        self.topics: dict[int, FakeTopic] = {}
+        self.posts: dict[int, FakePost] = {}
+        self.pads: dict[str, str] = {}
+        self.requests: list[tuple[str, str]] = []
+        self._failures: list[tuple[int, dict, dict]] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._server: ThreadingHTTPServer | None = None
+
+    # -- state helpers ---------------------------------------------------------
+
+    def create_topic(
+        self,
+        title: str,
+        raw: str,
+        username: str | None = None,
+        category_id: int | None = None,
+        recipients: list[str] | None = None,
+    ) -> FakeTopic:
+        """Creates a topic, or a private message if `recipients` are given."""
+        username = username or self.username
+        with self._lock:
+            topic = FakeTopic(
+                id=next(self._ids),
+                title=title,
+                username=username,
+                archetype="private_message" if recipients else "regular",
+                category_id=category_id,
+                allowed_users={username, *(recipients or [])},
+            )
+            self.topics[topic.id] = topic
+            self.create_post(topic.id, raw, username)
+            return topic
+
+    def create_post(self, topic_id: int, raw: str, username: str) -> FakePost:
+        with self._lock:
+            topic = self.topics[topic_id]
+            post = FakePost(
+                id=next(self._ids),
+                topic_id=topic_id,
+                post_number=len(topic.posts) + 1,
+                username=username,
+                raw=raw,
+            )
+            topic.posts.append(post)
+            topic.bumped_at = post.created_at
+            self.posts[post.id] = post
+            return post
+
+    def fail_next(
+        self,
+        status: int,
+        body: dict | None = None,
+        headers: dict | None = None,
+        count: int = 1,
+    ) -> None:
+        """The next `count` requests are answered with the given error."""
+        with self._lock:
+            self._failures.extend([(status, body or {}, headers or {})] * count)
+
+    def request_count(self, verb: str | None = None, pattern: str = "") -> int:
+        return sum(
+            1
+            for v, path in self.requests
+            if (verb is None or v == verb) and re.search(pattern, path)
+        )
+
+    # -- server ----------------------------------------------------------------
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeDiscourse":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "FakeDiscourse":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    # -- API -------------------------------------------------------------------
+
+    def handle(
+        self, verb: str, path: str, query: dict, form: dict, user: str
+    ) -> tuple[int, dict | str, dict]:
+        with self._lock:
+            self.requests.append((verb, path))
+            if self._failures:
+                return self._failures.pop(0)
+            for route_verb, pattern, handler in self._routes:
+                if route_verb != verb:
+                    continue
+                if match := re.fullmatch(pattern, path):
+                    return handler(self, user, query, form, *match.groups())
+        return _not_found()
+
+    def _topic_list(self, topics: list[FakeTopic], user: str, query: dict) -> dict:
+        topics = sorted(topics, key=lambda t: t.bumped_at, reverse=True)
+        page = int(query.get("page", ["0"])[0])
+        start = page * TOPICS_PER_PAGE
+        page_topics = topics[start : start + TOPICS_PER_PAGE]
+        topic_list = {"topics": [t.to_list_json(user) for t in page_topics]}
+        if start + TOPICS_PER_PAGE < len(topics):
+            topic_list["more_topics_url"] = f"?page={page + 1}"
+        return {"topic_list": topic_list}
+
+    def _visible(self, topic: FakeTopic, user: str) -> bool:
+        return not topic.is_private_message or user in topic.allowed_users
+
+    def _get_search(self, user, query, form):
+        terms = query.get("q", query.get("term", [""]))[0].split()
+        words = [t.lower() for t in terms if not t.startswith(("@", "in:"))]
+        participants = [t[1:] for t in terms if t.startswith("@")]
+        only_messages = "in:messages" in terms
+        topics = [
+            t
+            for t in self.topics.values()
+            if self._visible(t, user)
+            and (not only_messages or t.is_private_message)
+            and all(p in t.allowed_users for p in participants if t.is_private_message)
+            and all(w in t.title.lower() for w in words)
+        ]
+        return (
+            200,
+            {"topics": [{"id": t.id, "title": t.title} for t in topics], "posts": []},
+            {},
+        )
+
+    def _get_latest(self, user, query, form):
+        topics = [t for t in self.topics.values() if not t.is_private_message]
+        return 200, self._topic_list(topics, user, query), {}
+
+    def _get_category(self, user, query, form, slug):
+        category_id = self.categories.get(slug)
+        if category_id is None and slug.isdigit():
+            category_id = int(slug)
+        if category_id is None:
+            return _not_found()
+        topics = [t for t in self.topics.values() if t.category_id == category_id]
+        return 200, self._topic_list(topics, user, query), {}
+
+    def _get_private_messages(self, user, query, form, kind, username):
+        topics = [
+            t
+            for t in self.topics.values()
+            if t.is_private_message
+            and username in t.allowed_users
+            and (kind != "-sent" or any(p.username == username for p in t.posts))
+        ]
+        return 200, self._topic_list(topics, user, query), {}
+
+    def _get_topic_posts(self, user, query, form, topic_id):
+        topic = self.topics.get(int(topic_id))
+        if not topic or not self._visible(topic, user):
+            return _not_found()
+        if post_ids := query.get("post_ids[]"):
+            posts = [p for p in topic.posts if str(p.id) in post_ids]
+        else:
+            posts = topic.posts[:POSTS_PER_CHUNK]
+        include_raw = query.get("include_raw", [""])[0] == "true"
+        return (
+            200,
+            {"post_stream": {"posts": [p.to_json(user, include_raw) for p in posts]}},
+            {},
+        )
+
+    def _get_topic(self, user, query, form, topic_id):
+        topic = self.topics.get(int(topic_id))
+        if not topic or not self._visible(topic, user):
+            return _not_found()
+        data = topic.to_list_json(user)
+        data["post_stream"] = {
+            "posts": [p.to_json(user) for p in topic.posts[:POSTS_PER_CHUNK]],
+            "stream": [p.id for p in topic.posts],
+        }
+        return 200, data, {}
+
+    def _get_post(self, user, query, form, post_id):
+        post = self.posts.get(int(post_id))
+        if not post or not self._visible(self.topics[post.topic_id], user):
+            return _not_found()
+        return 200, post.to_json(user, include_raw=True), {}
+
+    def _post_posts(self, user, query, form):
+        raw = form.get("raw", [""])[0]
+        if topic_id := form.get("topic_id", [None])[0]:
+            topic = self.topics.get(int(topic_id))
+            if not topic or not self._visible(topic, user):
+                return _not_found()
+            post = self.create_post(topic.id, raw, user)
+        else:
+            title = form.get("title", [""])[0]
+            if not title:
+                return 422, {"errors": ["Title can't be blank"]}, {}
+            recipients = None
+            if form.get("archetype", [""])[0] == "private_message":
+                recipients = form.get("target_recipients", [""])[0].split(",")
+            category = form.get("category", [None])[0]
+            topic = self.create_topic(
+                title,
+                raw,
+                username=user,
+                category_id=int(category) if category else None,
+                recipients=recipients,
+            )
+            post = topic.posts[0]
+        return 200, post.to_json(user, include_raw=True), {}
+
+    def _put_post(self, user, query, form, post_id):
+        post = self.posts.get(int(post_id))
+        if not post:
+            return _not_found()
+        if post.username != user:
+            return (
+                403,
+                {"errors": ["You are not permitted to view the requested resource."]},
+                {},
+            )
+        raw_old = form.get("post[raw_old]", [None])[0]
+        if raw_old is not None and raw_old != post.raw:
+            return 409, {"errors": ["Someone else edited this post"]}, {}
+        new_raw = form.get("post[raw]", [post.raw])[0]
+        if new_raw != post.raw:
+            post.raw = new_raw
+            post.version += 1
+            post.updated_at = _now()
+        return 200, {"post": post.to_json(user, include_raw=True)}, {}
+
+    def _post_upload(self, user, query, form):
+        upload_id = next(self._ids)
+        return (
+            200,
+            {
+                "id": upload_id,
+                "url": f"/uploads/default/original/{upload_id}.png",
+                "short_url": f"upload://{upload_id}.png",
+                "original_filename": "gantt.png",
+            },
+            {},
+        )
+
+    def _post_pad(self, user, query, form):
+        pad_id = f"pad{next(self._ids)}"
+        self.pads[pad_id] = form.get("_body", [""])[0]
+        return 302, "", {"Location": f"/{pad_id}"}
+
+    def _get_pad(self, user, query, form, pad_id, download):
+        if pad_id not in self.pads:
+            return _not_found()
+        return 200, self.pads[pad_id], {}
+
+    _routes = [
+        ("GET", r"/search\.json", _get_search),
+        ("GET", r"/latest\.json", _get_latest),
+        ("GET", r"/c/(.+)\.json", _get_category),
+        (
+            "GET",
+            r"/topics/private-messages(|-sent)/([^/]+)\.json",
+            _get_private_messages,
+        ),
+        ("GET", r"/t/(\d+)/posts\.json", _get_topic_posts),
+        ("GET", r"/t/(\d+)\.json", _get_topic),
+        ("GET", r"/posts/(\d+)\.json", _get_post),
+        ("POST", r"/posts(?:\.json)?", _post_posts),
+        ("PUT", r"/posts/(\d+)(?:\.json)?", _put_post),
+        ("POST", r"/uploads\.json", _post_upload),
+        ("POST", r"/new", _post_pad),
+        ("GET", r"/(pad\d+)(/download)?", _get_pad),
+    ]
+
+
+def _not_found():
+    return (
+        404,
+        {
+            "errors": ["The requested URL or resource could not be found."],
+            "error_type": "not_found",
+        },
+        {},
+    )
+
+
+def _make_handler(fake: FakeDiscourse):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, avoid waiting for delayed ACKs on keep-alive connections
+        disable_nagle_algorithm = True
+
+        def _handle(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length).decode("utf-8", errors="replace")
+            form = {}
+            content_type = self.headers.get("Content-Type", "")
+            if content_type.startswith("application/x-www-form-urlencoded"):
+                form = parse_qs(body, keep_blank_values=True)
+            elif body:
+                form = {"_body": [body]}
+
+            if fake.latency:
+                time.sleep(fake.latency)
+            status, payload, headers = fake.handle(
+                self.command,
+                url.path,
+                parse_qs(url.query),
+                form,
+                self.headers.get("Api-Username", ""),
+            )
+
+            if isinstance(payload, dict):
+                data = json.dumps(payload).encode()
+                headers = {"Content-Type": JSON_CONTENT_TYPE, **headers}
+            else:
+                data = payload.encode()
+                headers = {"Content-Type": "text/plain; charset=utf-8", **headers}
+
+            if self.command == "GET" and status == 200:
+                etag = f'W/"{hashlib.md5(data).hexdigest()}"'
+                headers["ETag"] = etag
+                if self.headers.get("If-None-Match") == etag:
+                    status, data = 304, b""
+                    headers.pop("Content-Type")
+
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,59 @@
+import locale
+
+import pytest
+
+from webhooks import WebhookEvent
+
+
+@pytest.fixture
+def app(monkeypatch):
+    # The app sets a German locale on import, which isn't installed everywhere
+    monkeypatch.setattr(locale, "setlocale", lambda *args: None)
+    import app
+
+    return app
+
+
+def post_created(username, archetype="private_message"):
+    return WebhookEvent(
+        "post_created",
+        {"post": {"topic_id": 7, "username": username, "topic_archetype": archetype}},
+    )
+
+
+@pytest.mark.parametrize(
+    "event, dispatched",
+    [
+        (post_created("alice"), True),
+        (post_created("alice", archetype="regular"), False),
+        (post_created("testuser"), False),
+        (
+            WebhookEvent(
+                "topic_created",
+                {
+                    "topic": {
+                        "id": 7,
+                        "archetype": "private_message",
+                        "created_by": {"username": "alice"},
+                    }
+                },
+            ),
+            True,
+        ),
+    ],
+)
+def test_webhook_event_dispatch(app, dummy_storage_client, mocker, event, dispatched):
+    thread_post = mocker.patch(
+        "tasks.voucher.handle_voucher_thread_post", return_value=True
+    )
+    fetch = mocker.patch.object(app, "fetch_unread_messages")
+
+    app.dispatch_webhook_event(dummy_storage_client, event)
+
+    if dispatched:
+        thread_post.assert_called_once_with(dummy_storage_client, 7)
+        # Also a post in a voucher thread may be a question for the inbox
+        fetch.assert_called_once_with(dummy_storage_client)
+    else:
+        thread_post.assert_not_called()
+        fetch.assert_not_called()
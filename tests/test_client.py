@@ -1,8 +1,25 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timezone
+
 import pytest
 import yaml
 from urllib.parse import quote_plus
 
-from client import DiscourseStorageClient, DiscourseStorageError
+from pydiscourse.exceptions import DiscourseClientError
+
+from client import (
+    AsyncDiscourseStorageClient,
+    DiscourseStorageClient,
+    DiscourseStorageError,
+    RequestPriority,
+    RequestScheduler,
+    ShardLayout,
+    SQLiteStorage,
+    StorageConflictError,
+    TokenBucket,
+)
 
 HOST = "https://discourse.example.com"
 API_USERNAME = "testuser"
@@ -199,3 +216,531 @@ def test_storage_custom_storage_cls(dummy_storage_client):
 
     client.storage.put("alpha", {"value": 1})
     assert client.storage.get("alpha") == {"value": 1}
+
+
+def test_storage_transaction(dummy_storage_client, mocker):
+    storage = dummy_storage_client.storage
+    storage.put("voucher", {"queue": []})
+    put = mocker.spy(storage, "put")
+
+    with storage.transaction("voucher") as data:
+        with storage.transaction("voucher") as nested:
+            assert nested is data
+            nested["queue"].append("alice")
+        assert put.call_count == 0
+    assert put.call_count == 1
+    assert storage.get("voucher") == {"queue": ["alice"]}
+
+    with pytest.raises(ValueError):
+        with storage.transaction("voucher") as data:
+            data["queue"].append("bob")
+            raise ValueError
+    # Unchanged
+    with storage.transaction("voucher") as data:
+        pass
+    assert put.call_count == 1
+
+    # A change made in the meantime isn't overwritten
+    with pytest.raises(StorageConflictError):
+        with storage.transaction("voucher") as data:
+            storage.put("voucher", {"queue": ["carol"]})
+            data["queue"].append("dave")
+    assert storage.get("voucher") == {"queue": ["carol"]}
+
+
+def test_sqlite_storage(tmp_path):
+    path = tmp_path / "storage.sqlite3"
+    client = DiscourseStorageClient(
+        host=HOST,
+        api_username=API_USERNAME,
+        api_key=API_KEY,
+        storage_cls=SQLiteStorage,
+        storage_options={"path": path},
+    )
+
+    assert client.storage.get("voucher") == {}
+    client.storage.put("voucher", {"queue": ["alice"]})
+    client.storage.put("voucher", {"queue": ["bob"]})
+    client.close()
+
+    reopened = SQLiteStorage(client, path=path)
+    assert reopened.get("voucher") == {"queue": ["bob"]}
+    reopened.close()
+
+
+def test_sqlite_storage_revisions(tmp_path):
+    client = DiscourseStorageClient(
+        host=HOST,
+        api_username=API_USERNAME,
+        api_key=API_KEY,
+        storage_cls=SQLiteStorage,
+        storage_options={"path": tmp_path / "storage.sqlite3"},
+    )
+    storage = client.storage
+
+    assert storage.get_versioned("voucher") == ({}, None)
+    storage.put("voucher", {"queue": []}, expected_revision=None)
+    with pytest.raises(StorageConflictError):
+        storage.put("voucher", {"queue": []}, expected_revision=None)
+
+    data, revision = storage.get_versioned("voucher")
+    storage.put("voucher", {"queue": ["bob"]})
+    with pytest.raises(StorageConflictError):
+        storage.put("voucher", {"queue": ["alice"]}, expected_revision=revision)
+
+    storage.update("voucher", lambda d: {"queue": d["queue"] + ["alice"]})
+    assert storage.get("voucher") == {"queue": ["bob", "alice"]}
+
+    values = storage.get_many_versioned(["voucher", "missing"])
+    assert values == {
+        "voucher": ({"queue": ["bob", "alice"]}, 3),
+        "missing": ({}, None),
+    }
+    # All or nothing
+    with pytest.raises(StorageConflictError):
+        storage.put_many(
+            {"settings": {"theme": "dark"}, "voucher": {"queue": []}},
+            {"voucher": 2},
+        )
+    assert storage.get_many(["settings", "voucher"]) == {
+        "settings": {},
+        "voucher": {"queue": ["bob", "alice"]},
+    }
+    client.close()
+
+
+def test_sharded_storage(tmp_path, mocker):
+    client = DiscourseStorageClient(
+        host=HOST,
+        api_username=API_USERNAME,
+        api_key=API_KEY,
+        storage_cls=SQLiteStorage,
+        storage_options={"path": tmp_path / "storage.sqlite3"},
+        storage_layouts={
+            "voucher": ShardLayout(
+                partitioned_fields=("voucher_topics",),
+                cold_fields={"voucher": ("history",)},
+            )
+        },
+    )
+    storage = client.storage
+    # Stored before sharding
+    storage.storage.put("voucher", {"queue": [], "voucher_topics": {"37C3": 1}})
+    assert storage.get("voucher") == {"queue": [], "voucher_topics": {"37C3": 1}}
+
+    data = {
+        "queue": ["alice"],
+        "voucher_topics": {"37C3": 1, "38C3": 2},
+        "voucher": [{"voucher": "CHAOS1", "owner": "bob", "history": [{"a": 1}]}],
+    }
+    storage.put("voucher", data)
+    assert storage.storage.get("voucher_38C3") == {"voucher_topics": 2}
+    assert storage.storage.get("voucher_cold") == {
+        "voucher": {"history": {0: [{"a": 1}]}}
+    }
+
+    put_many = mocker.spy(storage.storage, "put_many")
+    get_versioned = mocker.spy(storage.storage, "get_versioned")
+    with storage.transaction("voucher") as data:
+        # The cold shard isn't read until it's needed
+        assert data == {
+            "queue": ["alice"],
+            "voucher_topics": {"37C3": 1, "38C3": 2},
+            "voucher": [{"voucher": "CHAOS1", "owner": "bob"}],
+        }
+        data["queue"].append("carol")
+    assert [c.args[0] for c in get_versioned.call_args_list] == ["voucher"]
+    assert [list(c.args[0]) for c in put_many.call_args_list] == [["voucher"]]
+
+    with storage.transaction("voucher") as data:
+        data["voucher"][0]["history"].append({"a": 2})
+    assert [list(c.args[0]) for c in put_many.call_args_list][1] == ["voucher_cold"]
+    assert storage.get("voucher")["voucher"][0]["history"] == [{"a": 1}, {"a": 2}]
+
+    # A new item moves the items, so the cold shard is read and written completely
+    with storage.transaction("voucher") as data:
+        data["voucher"].append({"voucher": "CHAOS2", "owner": None, "history": []})
+    assert storage.storage.get("voucher_cold") == {
+        "voucher": {"history": {0: [{"a": 1}, {"a": 2}], 1: []}}
+    }
+    client.close()
+
+
+def test_sharded_storage_reads_only_the_current_partition(tmp_path, mocker):
+    client = DiscourseStorageClient(
+        host=HOST,
+        api_username=API_USERNAME,
+        api_key=API_KEY,
+        storage_cls=SQLiteStorage,
+        storage_options={"path": tmp_path / "storage.sqlite3"},
+        storage_layouts={
+            "voucher": ShardLayout(
+                partitioned_fields=("voucher_topics", "voucher_phase_range"),
+                current_partition=lambda: "38C3",
+            )
+        },
+    )
+    storage = client.storage
+    storage.put(
+        "voucher",
+        {
+            "voucher_topics": {"37C3": 1, "38C3": 2},
+            "voucher_phase_range": {"37C3": {"end": 1}},
+        },
+    )
+    get_many = mocker.spy(storage.storage, "get_many_versioned")
+
+    with storage.transaction("voucher") as data:
+        assert data == {"voucher_topics": {"38C3": 2}, "voucher_phase_range": {}}
+        data["voucher_topics"]["38C3"] = 3
+        # Written without being read
+        data["voucher_phase_range"]["37C3"] = {"start": 0}
+    assert get_many.call_args.args[0] == ["voucher_38C3"]
+
+    assert storage.storage.get("voucher_37C3") == {
+        "voucher_topics": 1,
+        "voucher_phase_range": {"start": 0},
+    }
+    storage.layouts["voucher"].current_partition = None
+    assert storage.get("voucher") == {
+        "voucher_topics": {"37C3": 1, "38C3": 3},
+        "voucher_phase_range": {"37C3": {"start": 0}},
+    }
+    client.close()
+
+
+def test_requests_share_pooled_session(client, responses, mocker):
+    """All requests go through the client's keep-alive session instead of a fresh connection."""
+    responses.add(
+        responses.GET,
+        f"{HOST}/posts/1.json",
+        json={"id": 1},
+        content_type=JSON_CONTENT_TYPE,
+    )
+    spy = mocker.spy(client.session, "request")
+
+    client.single_post(1)
+    client.single_post(1)
+
+    assert spy.call_count == 2
+    request = responses.calls[0].request
+    assert request.headers["Api-Key"] == API_KEY
+    assert request.headers["Api-Username"] == API_USERNAME
+
+
+def test_pool_configuration():
+    client = DiscourseStorageClient(
+        host=HOST,
+        api_username=API_USERNAME,
+        api_key=API_KEY,
+        pool_connections=2,
+        pool_maxsize=16,
+        timeout=(1, 2),
+    )
+    adapter = client.session.get_adapter(HOST)
+    assert adapter._pool_connections == 2
+    assert adapter._pool_maxsize == 16
+    assert client.timeout == (1, 2)
+
+
+def test_client_error_is_raised(client, responses):
+    responses.add(
+        responses.GET,
+        f"{HOST}/posts/1.json",
+        json={"errors": ["not found"]},
+        status=404,
+        content_type=JSON_CONTENT_TYPE,
+    )
+
+    with pytest.raises(DiscourseClientError, match="not found"):
+        client.single_post(1)
+
+
+def test_conditional_get_served_from_cache(client, responses):
+    url = f"{HOST}/t/1/posts.json"
+    responses.add(
+        responses.GET,
+        url,
+        json={"post_stream": {"posts": [{"id": 1}]}},
+        headers={"ETag": 'W/"abc"'},
+        content_type=JSON_CONTENT_TYPE,
+    )
+    responses.add(responses.GET, url, status=304)
+
+    first = client.topic_posts(1)
+    first["post_stream"]["posts"].clear()
+    second = client.topic_posts(1)
+
+    assert second == {"post_stream": {"posts": [{"id": 1}]}}
+    assert "If-None-Match" not in responses.calls[0].request.headers
+    assert responses.calls[1].request.headers["If-None-Match"] == 'W/"abc"'
+    stats = client.response_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["bytes_saved"] == len(responses.calls[0].response.content)
+
+
+def test_conditional_get_cache_keys_include_params(client, responses):
+    url = f"{HOST}/t/1/posts.json"
+    responses.add(
+        responses.GET,
+        url,
+        json={"post_stream": {"posts": []}},
+        headers={"Last-Modified": "Sat, 17 Oct 2026 10:00:00 GMT"},
+        content_type=JSON_CONTENT_TYPE,
+    )
+
+    client.posts(1)
+    client.posts(1, post_ids=[2, 3])
+    client.posts(1)
+
+    assert "If-Modified-Since" not in responses.calls[1].request.headers
+    assert (
+        responses.calls[2].request.headers["If-Modified-Since"]
+        == "Sat, 17 Oct 2026 10:00:00 GMT"
+    )
+
+
+def test_response_cache_can_be_disabled(responses):
+    client = DiscourseStorageClient(
+        host=HOST, api_username=API_USERNAME, api_key=API_KEY, response_cache_size=0
+    )
+    responses.add(
+        responses.GET,
+        f"{HOST}/posts/1.json",
+        json={"id": 1},
+        headers={"ETag": '"abc"'},
+        content_type=JSON_CONTENT_TYPE,
+    )
+
+    client.single_post(1)
+    client.single_post(1)
+
+    assert client.response_cache is None
+    assert "If-None-Match" not in responses.calls[1].request.headers
+
+
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0])
+
+    bucket.take()
+    bucket.take()
+    assert bucket.delay() == pytest.approx(0.5)
+
+    now[0] += 0.5
+    assert bucket.delay() == 0
+
+    bucket.block(3)
+    assert bucket.delay() == pytest.approx(3)
+
+
+def test_scheduler_serves_higher_priority_first():
+    now = [0.0]
+    scheduler = RequestScheduler(read_rate=10, read_burst=1, clock=lambda: now[0])
+    scheduler.buckets["read"].tokens = 0
+    order = []
+
+    def request(priority):
+        scheduler.acquire("GET", priority)
+        order.append(priority)
+
+    def wait_for_queue(length):
+        while scheduler.stats()["read"]["queued"] != length:
+            time.sleep(0.01)
+
+    threads = [
+        threading.Thread(target=request, args=(RequestPriority.NOTIFICATION,)),
+        threading.Thread(target=request, args=(RequestPriority.VOUCHER_DELIVERY,)),
+    ]
+    for i, thread in enumerate(threads):
+        thread.start()
+        wait_for_queue(i + 1)
+    assert scheduler.stats()["read"]["queued_by_priority"]["VOUCHER_DELIVERY"] == 1
+
+    for _ in range(2):
+        now[0] += 0.1
+        wait_for_queue(len(threads) - len(order) - 1)
+    for thread in threads:
+        thread.join()
+
+    assert order == [RequestPriority.VOUCHER_DELIVERY, RequestPriority.NOTIFICATION]
+    assert scheduler.stats()["read"]["throttled"] == 2
+
+
+def test_scheduler_shares_the_total_budget():
+    now = [0.0]
+    scheduler = RequestScheduler(total_rate=1, total_burst=2, clock=lambda: now[0])
+
+    scheduler.acquire("GET", RequestPriority.DEFAULT)
+    scheduler.acquire("POST", RequestPriority.DEFAULT)
+    # Both buckets still have tokens, but the shared budget is used up
+    assert scheduler.buckets["read"].delay() == 0
+    assert scheduler.total.delay() == pytest.approx(1)
+
+    thread = threading.Thread(
+        target=scheduler.acquire, args=("GET", RequestPriority.DEFAULT)
+    )
+    thread.start()
+    while scheduler.stats()["read"]["throttled"] != 1:
+        time.sleep(0.01)
+    now[0] += 1
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+
+
+def test_rate_limited_request_honours_retry_after(client, responses, mocker):
+    url = f"{HOST}/posts"
+    responses.add(
+        responses.POST,
+        url,
+        json={"errors": ["slow down"]},
+        status=429,
+        headers={"Retry-After": "0"},
+        content_type=JSON_CONTENT_TYPE,
+    )
+    responses.add(responses.POST, url, json={"id": 1}, content_type=JSON_CONTENT_TYPE)
+    back_off = mocker.patch.object(client.scheduler, "back_off")
+
+    assert client.create_post("hello", topic_id=1) == {"id": 1}
+
+    # retry_backoff (1s) on top of the Retry-After header
+    back_off.assert_called_once_with("POST", 1.0)
+    assert len(responses.calls) == 2
+
+
+def test_request_priority_is_restored(client, mocker):
+    acquire = mocker.patch.object(client.scheduler, "acquire")
+    mocker.patch.object(client, "_send")
+    mocker.patch.object(client, "_decode_response")
+
+    with client.request_priority(RequestPriority.VOUCHER_DELIVERY):
+        client.create_post("hello", topic_id=1)
+    client.create_post("hello", topic_id=1)
+
+    assert [c.args[1] for c in acquire.call_args_list] == [
+        RequestPriority.VOUCHER_DELIVERY,
+        RequestPriority.DEFAULT,
+    ]
+
+
+def test_async_client_bounds_concurrency(client, mocker):
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def slow_posts(topic_id, post_ids=None):
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+        return {"topic_id": topic_id}
+
+    mocker.patch.object(client, "posts", side_effect=slow_posts)
+    async_client = AsyncDiscourseStorageClient(client, max_concurrency=3)
+
+    async def fan_out():
+        return await asyncio.gather(*(async_client.posts(i) for i in range(9)))
+
+    results = asyncio.run(fan_out())
+
+    assert [r["topic_id"] for r in results] == list(range(9))
+    assert max_running == 3
+
+
+def test_async_client_storage(dummy_storage_client):
+    async_client = AsyncDiscourseStorageClient(dummy_storage_client)
+
+    async def roundtrip():
+        await async_client.storage.put("alpha", {"value": 1})
+        return await async_client.storage.get("alpha")
+
+    assert asyncio.run(roundtrip()) == {"value": 1}
+
+
+def test_async_client_requests(client, responses):
+    responses.add(
+        responses.GET,
+        f"{HOST}/posts/1.json",
+        json={"id": 1},
+        content_type=JSON_CONTENT_TYPE,
+    )
+    responses.add(
+        responses.GET,
+        f"{HOST}/t/2/posts.json",
+        json={"post_stream": {"posts": []}},
+        content_type=JSON_CONTENT_TYPE,
+    )
+    async_client = AsyncDiscourseStorageClient(client)
+
+    async def fan_out():
+        return await asyncio.gather(
+            async_client.single_post(1), async_client.topic_posts(2)
+        )
+
+    assert asyncio.run(fan_out()) == [{"id": 1}, {"post_stream": {"posts": []}}]
+
+
+def test_iter_private_messages_walks_pages(client, responses):
+    url = f"{HOST}/topics/private-messages/{API_USERNAME}.json"
+    responses.add(
+        responses.GET,
+        url,
+        match=[responses.matchers.query_param_matcher({})],
+        json={"topic_list": {"topics": [{"id": 1}], "more_topics_url": "?page=1"}},
+        content_type=JSON_CONTENT_TYPE,
+    )
+    responses.add(
+        responses.GET,
+        url,
+        match=[responses.matchers.query_param_matcher({"page": "1"})],
+        json={"topic_list": {"topics": [{"id": 2}]}},
+        content_type=JSON_CONTENT_TYPE,
+    )
+
+    topics = client.iter_private_messages()
+    assert next(topics)["id"] == 1
+    # The second page is only requested when needed
+    assert len(responses.calls) == 1
+
+    assert [t["id"] for t in topics] == [2]
+    assert len(responses.calls) == 2
+
+
+def test_iter_category_topics_stops_at_old_topics(client, responses):
+    responses.add(
+        responses.GET,
+        f"{HOST}/c/ccc.json",
+        json={
+            "topic_list": {
+                "topics": [
+                    {"id": 1, "pinned": True, "bumped_at": "2020-01-01T00:00:00Z"},
+                    {"id": 2, "bumped_at": "2026-10-10T00:00:00.000Z"},
+                    {"id": 3, "bumped_at": "2026-09-01T00:00:00.000Z"},
+                ],
+                "more_topics_url": "?page=1",
+            }
+        },
+        content_type=JSON_CONTENT_TYPE,
+    )
+
+    since = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    topics = list(client.iter_category_topics("ccc", since=since))
+
+    assert [t["id"] for t in topics] == [1, 2]
+    assert len(responses.calls) == 1
+
+
+def test_iter_posts_fetches_whole_stream(fake_discourse, fake_discourse_client):
+    topic = fake_discourse.create_topic("Lang", "Post 1")
+    for i in range(2, 46):
+        fake_discourse.create_post(topic.id, f"Post {i}", "alice")
+
+    posts = list(fake_discourse_client.iter_posts(topic.id))
+
+    assert [p["post_number"] for p in posts] == list(range(1, 46))
+    # first chunk, stream ids, and two chunks fetched by id
+    assert fake_discourse.request_count("GET", rf"^/t/{topic.id}") == 4
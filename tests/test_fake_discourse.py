@@ -0,0 +1,475 @@
+"""
+End-to-end tests running the client and tasks against the in-process fake Discourse.
+"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import yaml
+
+import storage_codecs
+from client import (
+    DiscourseStorage,
+    DiscourseStorageClient,
+    RequestScheduler,
+    SQLiteStorage,
+    StorageConflictError,
+)
+from tasks.voucher import process_voucher_distribution
+
+
+def test_storage_roundtrip(fake_discourse, fake_discourse_client):
+    fake_discourse_client.storage.put("settings", {"theme": "dark"})
+    topic = next(iter(fake_discourse.topics.values()))
+    assert topic.title == "STORAGE_settings"
+    assert topic.allowed_users == {fake_discourse.username}
+
+    fake_discourse_client.storage.put("settings", {"theme": "light"})
+    # A fresh client has to resolve the key again
+    fake_discourse_client.storage._storage_ids.clear()
+
+    assert fake_discourse_client.storage.get("settings") == {"theme": "light"}
+    assert len(fake_discourse.topics) == 1
+
+
+def test_unchanged_storage_is_not_written(fake_discourse, fake_discourse_client):
+    storage = fake_discourse_client.storage
+    storage.put("settings", {"theme": "dark", "lang": "de"})
+
+    data = storage.get("settings")
+    storage.put("settings", data)
+    storage.put("settings", {"lang": "de", "theme": "dark"})
+    data["theme"] = "light"
+    storage.put("settings", data)
+
+    topic = next(iter(fake_discourse.topics.values()))
+    assert topic.posts[0].version == 2
+    assert storage.writes_performed == 2
+    assert storage.writes_skipped == 2
+
+
+def test_storage_read_cache(fake_discourse, fake_discourse_client):
+    storage = fake_discourse_client.storage
+    storage.put("settings", {"theme": "dark"})
+    post = next(iter(fake_discourse.posts.values()))
+
+    data = storage.get("settings")
+    data["theme"] = "light"
+    assert storage.get("settings") == {"theme": "dark"}
+    assert fake_discourse.request_count("GET", f"/posts/{post.id}") == 0
+
+    # After the TTL, the revision of the post is checked
+    fake_discourse_client.storage_cache_ttl = 0
+    assert storage.get("settings") == {"theme": "dark"}
+    assert storage.cache_revalidations == 1
+
+    # Edited by someone else
+    post.raw = "theme: blue\n"
+    post.version += 1
+    assert storage.get("settings") == {"theme": "blue"}
+    assert storage.cache_misses == 1
+
+
+def test_storage_snapshot_warm_start(fake_discourse, tmp_path):
+    bot = fake_discourse.username
+    fake_discourse.create_topic("STORAGE_voucher", "queue: []\n", recipients=[bot])
+    settings = fake_discourse.create_topic(
+        "STORAGE_settings", "theme: dark\n", recipients=[bot]
+    ).posts[0]
+
+    def make_client():
+        return DiscourseStorageClient(
+            host=fake_discourse.url,
+            api_username=bot,
+            api_key="secret-key",
+            storage_options={"snapshot_path": tmp_path / "snapshot.json"},
+        )
+
+    client = make_client()
+    client.storage.put("voucher", {"queue": ["alice"], "handled": {123: 4}})
+    assert client.storage.get("settings") == {"theme": "dark"}
+    client.close()
+    fake_discourse.requests.clear()
+    settings.raw = "theme: light\n"
+    settings.version += 1
+
+    restarted = make_client()
+    assert restarted.storage.get("voucher") == {"queue": ["alice"], "handled": {123: 4}}
+    assert restarted.storage.get("settings") == {"theme": "light"}
+    # No key lookups, one revision check per key
+    assert fake_discourse.request_count("GET") == 2
+    assert restarted.storage.cache_revalidations == 1
+    assert restarted.storage.cache_misses == 1
+    restarted.close()
+
+
+def test_stale_storage_snapshot(fake_discourse, tmp_path):
+    bot = fake_discourse.username
+    voucher = fake_discourse.create_topic(
+        "STORAGE_voucher", "queue: []\n", recipients=[bot]
+    )
+    fake_discourse.create_topic("STORAGE_settings", "theme: dark\n", recipients=[bot])
+
+    def make_client():
+        return DiscourseStorageClient(
+            host=fake_discourse.url,
+            api_username=bot,
+            api_key="secret-key",
+            storage_options={"snapshot_path": tmp_path / "snapshot.json"},
+        )
+
+    client = make_client()
+    assert client.storage.get_many(["voucher", "settings"]) == {
+        "voucher": {"queue": []},
+        "settings": {"theme": "dark"},
+    }
+    client.close()
+    # Both storage PMs were recreated while the bot was stopped
+    for topic in list(fake_discourse.topics.values()):
+        del fake_discourse.topics[topic.id]
+        for post in topic.posts:
+            del fake_discourse.posts[post.id]
+    fake_discourse.create_topic("STORAGE_voucher", "queue: [alice]\n", recipients=[bot])
+    fake_discourse.create_topic("STORAGE_settings", "theme: light\n", recipients=[bot])
+
+    restarted = make_client()
+    assert restarted.storage.get("voucher") == {"queue": ["alice"]}
+    restarted.storage.put("settings", {"theme": "blue"})
+    assert restarted.storage.get_many(["voucher", "settings"]) == {
+        "voucher": {"queue": ["alice"]},
+        "settings": {"theme": "blue"},
+    }
+    assert voucher.id not in fake_discourse.topics
+    restarted.close()
+
+
+def test_storage_get_many(fake_discourse, fake_discourse_client):
+    bot = fake_discourse.username
+    for key in ("voucher", "settings", "pm_inbox"):
+        fake_discourse.create_topic(f"STORAGE_{key}", f"key: {key}\n", recipients=[bot])
+    storage = fake_discourse_client.storage
+    assert storage.get("voucher") == {"key": "voucher"}
+
+    values = storage.get_many(["voucher", "settings", "pm_inbox", "missing"])
+
+    assert values == {
+        "voucher": {"key": "voucher"},
+        "settings": {"key": "settings"},
+        "pm_inbox": {"key": "pm_inbox"},
+        "missing": {},
+    }
+    # The cached key isn't fetched again
+    assert fake_discourse.request_count("GET", "/posts/") == 3
+
+
+def test_storage_keys_are_resolved_in_bulk(fake_discourse, fake_discourse_client):
+    bot = fake_discourse.username
+    fake_discourse.create_topic("STORAGE_voucher", "queue: []\n", recipients=[bot])
+    for i in range(40):
+        fake_discourse.create_topic(f"Dein Voucher {i}", "CHAOS", recipients=["alice"])
+    fake_discourse.create_topic("STORAGE_settings", "theme: dark\n", recipients=[bot])
+
+    storage = fake_discourse_client.storage
+    assert storage.get("voucher") == {"queue": []}
+    storage.put("settings", {"theme": "light"})
+    assert storage.get("missing") == {}
+
+    assert fake_discourse.request_count("GET", "/topics/private-messages-sent/") == 2
+    # Only the key which doesn't exist is searched
+    assert fake_discourse.request_count("GET", "/search") == 1
+    assert len(fake_discourse.topics) == 42
+
+
+def test_storage_index_is_limited_to_recent_messages(
+    fake_discourse, fake_discourse_client
+):
+    bot = fake_discourse.username
+    fake_discourse.create_topic("STORAGE_voucher", "queue: []\n", recipients=[bot])
+    for i in range(100):
+        fake_discourse.create_topic(f"Dein Voucher {i}", "CHAOS", recipients=["alice"])
+
+    assert fake_discourse_client.storage.get("voucher") == {"queue": []}
+
+    # The key is older than the scanned pages, so it's searched instead
+    sent_pages = fake_discourse.request_count("GET", "/topics/private-messages-sent/")
+    assert sent_pages == DiscourseStorage.INDEX_PAGES
+    assert fake_discourse.request_count("GET", "/search") == 1
+
+
+def test_missing_storage_keys_are_remembered(fake_discourse, fake_discourse_client):
+    storage = fake_discourse_client.storage
+
+    assert storage.get("NEXT_PLENUM_TOPICS") == {}
+    assert storage.get("NEXT_PLENUM_TOPICS") == {}
+    assert fake_discourse.request_count("GET", "/search") == 1
+
+    storage.put("NEXT_PLENUM_TOPICS", {"topics": []})
+    fake_discourse_client.storage_cache_ttl = 0
+    assert storage.get("NEXT_PLENUM_TOPICS") == {"topics": []}
+
+    fake_discourse_client.storage_missing_ttl = 0
+    assert storage.get("other") == {}
+    assert storage.get("other") == {}
+    assert fake_discourse.request_count("GET", "/search") == 3
+
+
+def test_sqlite_storage_mirrors_to_discourse(fake_discourse, tmp_path):
+    bot = fake_discourse.username
+    fake_discourse.create_topic("STORAGE_voucher", "queue: []\n", recipients=[bot])
+    client = DiscourseStorageClient(
+        host=fake_discourse.url,
+        api_username=bot,
+        api_key="secret-key",
+        storage_cls=SQLiteStorage,
+        storage_options={"path": tmp_path / "storage.sqlite3", "mirror": True},
+    )
+
+    # Imported from the forum once, then read locally
+    assert client.storage.get("voucher") == {"queue": []}
+    assert client.storage.get("voucher") == {"queue": []}
+    client.storage.mirror._cache.clear()
+    assert client.storage.get("voucher") == {"queue": []}
+    assert fake_discourse.request_count("GET", "/posts/") == 1
+
+    client.storage.put("voucher", {"queue": ["alice"]})
+    client.close()
+
+    topic = next(iter(fake_discourse.topics.values()))
+    assert yaml.safe_load(topic.posts[0].raw) == {"queue": ["alice"]}
+
+
+def test_concurrent_storage_updates(fake_discourse, fake_discourse_client):
+    other_instance = DiscourseStorageClient(
+        host=fake_discourse.url,
+        api_username=fake_discourse.username,
+        api_key="secret-key",
+    )
+    fake_discourse_client.storage.put("voucher", {"queue": []})
+
+    data, revision = fake_discourse_client.storage.get_versioned("voucher")
+    other_instance.storage.update("voucher", lambda d: {"queue": d["queue"] + ["bob"]})
+    with pytest.raises(StorageConflictError):
+        fake_discourse_client.storage.put(
+            "voucher", {"queue": ["alice"]}, expected_revision=revision
+        )
+
+    # The cached value is outdated, the mutation is applied again to the current one
+    fake_discourse_client.storage.get("voucher")
+    other_instance.storage.update(
+        "voucher", lambda d: {"queue": d["queue"] + ["carol"]}
+    )
+    fake_discourse_client.storage.update(
+        "voucher", lambda d: {"queue": d["queue"] + ["alice"]}
+    )
+
+    other_instance.close()
+    topic = next(iter(fake_discourse.topics.values()))
+    assert yaml.safe_load(topic.posts[0].raw) == {"queue": ["bob", "carol", "alice"]}
+
+
+def test_storage_is_shared_by_threads(fake_discourse, tmp_path):
+    client = DiscourseStorageClient(
+        host=fake_discourse.url,
+        api_username=fake_discourse.username,
+        api_key="secret-key",
+        storage_options={"snapshot_path": tmp_path / "snapshot.json"},
+        scheduler=RequestScheduler(read_rate=1000, write_rate=1000),
+    )
+    storage = client.storage
+    jobs, rounds = 3, 10
+
+    def job(key, name):
+        for i in range(rounds):
+            storage.update(
+                key, lambda d: {"log": d["log"] + [f"{name}{i}"]}, {"log": []}
+            )
+            storage.get_many(["a", "b"])
+            storage.stats()
+
+    # Jobs on both keys run at the same time, like on the job scheduler's workers
+    with ThreadPoolExecutor(2 * jobs) as executor:
+        futures = [
+            executor.submit(job, key, f"{key}{n}")
+            for key in ("a", "b")
+            for n in range(jobs)
+        ]
+        for future in futures:
+            future.result()
+    client.close()
+
+    for key in ("a", "b"):
+        assert sorted(storage.get(key)["log"]) == sorted(
+            f"{key}{n}{i}" for n in range(jobs) for i in range(rounds)
+        )
+    assert storage.stats()["writes_performed"] == 2 * jobs * rounds
+    snapshot = storage_codecs.decode((tmp_path / "snapshot.json").read_text())
+    assert set(snapshot["keys"]) == {"a", "b"}
+
+
+def test_storage_codec_can_be_switched(fake_discourse):
+    bot = fake_discourse.username
+    fake_discourse.create_topic("STORAGE_voucher", "queue: []\n", recipients=[bot])
+    client = DiscourseStorageClient(
+        host=fake_discourse.url,
+        api_username=bot,
+        api_key="secret-key",
+        storage_options={"codec": "json"},
+    )
+
+    with client.storage.transaction("voucher") as data:
+        data["queue"].append("alice")
+    client.close()
+
+    raw = next(iter(fake_discourse.topics.values())).posts[0].raw
+    assert raw.startswith("#storage-format: json/1\n")
+    assert json.loads(raw.partition("\n")[2]) == {"queue": ["alice"]}
+
+
+def test_compressed_storage_size_warnings(fake_discourse, caplog):
+    client = DiscourseStorageClient(
+        host=fake_discourse.url,
+        api_username=fake_discourse.username,
+        api_key="secret-key",
+        storage_options={"compress": True, "max_post_length": 300},
+    )
+    storage = client.storage
+
+    storage.put("voucher", {"queue": ["alice"] * 1000})
+    raw = next(iter(fake_discourse.topics.values())).posts[0].raw
+    assert raw.startswith("#storage-format: yaml/1+zlib\n```")
+    storage._cache.clear()
+    assert storage.get("voucher") == {"queue": ["alice"] * 1000}
+    assert storage.stats()["size_warnings"] == 0
+
+    storage.put("voucher", {"queue": [f"user{i}" for i in range(100)]})
+    assert 'Storage "voucher" has' in caplog.text
+    stats = storage.stats()
+    assert stats["size_warnings"] == 1
+    assert stats["largest_value_size"] == len(
+        next(iter(fake_discourse.topics.values())).posts[0].raw
+    )
+    assert stats["largest_value_usage"] > 0.8
+    client.close()
+
+
+def test_journal_storage(fake_discourse):
+    bot = fake_discourse.username
+    fake_discourse.create_topic(
+        "STORAGE_voucher", "queue: []\nhistory: []\n", recipients=[bot]
+    )
+
+    def make_client():
+        return DiscourseStorageClient(
+            host=fake_discourse.url,
+            api_username=bot,
+            api_key="secret-key",
+            storage_cache_ttl=0,
+            storage_options={"journal": True, "journal_compact_after": 3},
+        )
+
+    client = make_client()
+    for i in range(5):
+        with client.storage.transaction("voucher") as data:
+            data["history"].append(f"entry{i}")
+    stats = client.storage.stats()
+    assert (stats["journal_entries"], stats["journal_compactions"]) == (4, 1)
+    client.close()
+
+    topic = next(iter(fake_discourse.topics.values()))
+    # Entries 0-2 as replies, a compaction, and entry 4 as reply again
+    assert len(topic.posts) == 5
+    assert topic.posts[0].raw.startswith(f"#storage-journal: {topic.posts[3].id}\n")
+    assert "entry3" in topic.posts[0].raw and "entry4" not in topic.posts[0].raw
+    assert "entry4" in topic.posts[4].raw and "entry3" not in topic.posts[4].raw
+
+    other = make_client()
+    assert other.storage.get("voucher") == {
+        "queue": [],
+        "history": [f"entry{i}" for i in range(5)],
+    }
+    with other.storage.transaction("voucher") as data:
+        data["queue"].append("alice")
+    other.storage.journal = False
+    with other.storage.transaction("voucher") as data:
+        data["queue"].append("bob")
+    other.close()
+
+    assert yaml.safe_load(topic.posts[0].raw) == {
+        "queue": ["alice", "bob"],
+        "history": [f"entry{i}" for i in range(5)],
+    }
+
+
+def test_conditional_requests(fake_discourse, fake_discourse_client):
+    topic = fake_discourse.create_topic("Hallo", "Hallo Welt")
+
+    first = fake_discourse_client.topic_posts(topic.id)
+    second = fake_discourse_client.topic_posts(topic.id)
+
+    assert first == second
+    assert fake_discourse_client.response_cache.hits == 1
+
+
+def test_rate_limit_is_retried(fake_discourse, fake_discourse_client):
+    fake_discourse.fail_next(
+        429, {"errors": ["too many"], "extras": {"wait_seconds": 0}}
+    )
+
+    fake_discourse_client.latest_topics()
+
+    assert fake_discourse.request_count("GET", "/latest") == 2
+    assert fake_discourse_client.scheduler.stats()["read"]["rate_limited"] == 1
+
+
+def test_returned_voucher_end_to_end(fake_discourse, fake_discourse_client, mocker):
+    mocker.patch.dict(
+        "constants.DISCOURSE_CREDENTIALS", {"api_username": fake_discourse.username}
+    )
+    bot = fake_discourse.username
+    # Older conversations, enough for a second page of the PM list
+    for i in range(40):
+        fake_discourse.create_topic(f"Frage {i}", "Hallo", "carol", recipients=[bot])
+    returned = fake_discourse.create_topic(
+        "Dein Voucher", "CHAOSOLD", recipients=["alice"]
+    )
+    fake_discourse.create_post(returned.id, "Hier, CHAOSNEW", "alice")
+    kept = fake_discourse.create_topic("Dein Voucher", "CHAOSKEEP", recipients=["bob"])
+    vouchers = [
+        {
+            "index": i,
+            "voucher": code,
+            "owner": owner,
+            "message_id": topic.id,
+            "history": [{"username": owner, "received_at": "2024-01-01T09:00:00"}],
+        }
+        for i, (code, owner, topic) in enumerate(
+            [("CHAOSOLD", "alice", returned), ("CHAOSKEEP", "bob", kept)]
+        )
+    ]
+    fake_discourse.create_topic(
+        "STORAGE_voucher",
+        yaml.safe_dump({"voucher": vouchers, "queue": [], "demand": {}}),
+        recipients=[bot],
+    )
+
+    process_voucher_distribution(fake_discourse_client)
+
+    data = fake_discourse_client.storage.get("voucher")
+    assert data["voucher"][0]["voucher"] == "CHAOSNEW"
+    assert data["voucher"][0]["owner"] is None
+    assert data["voucher"][1]["owner"] == "bob"
+    assert returned.posts[-1].raw == 'Prima, vielen Dank für "CHAOSNEW"!'
+    assert returned.posts[-1].username == bot
+
+    # Nothing changed in bob's thread, so the next tick doesn't fetch it again
+    fake_discourse.requests.clear()
+    process_voucher_distribution(fake_discourse_client)
+    assert fake_discourse.request_count("GET", rf"^/t/{kept.id}/posts") == 0
+
+    # A deleted thread doesn't make us walk the whole PM list, only down to the cursor
+    del fake_discourse.topics[kept.id]
+    fake_discourse.requests.clear()
+    process_voucher_distribution(fake_discourse_client)
+    assert fake_discourse.request_count("GET", r"^/topics/private-messages/") == 1
+    assert fake_discourse.request_count("GET", rf"^/t/{kept.id}/posts") == 0
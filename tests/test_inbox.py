@@ -0,0 +1,83 @@
+from inbox import INBOX_STORAGE_KEY, InboxSync
+
+
+def handle_all(client):
+    inbox = InboxSync(client)
+    pending = inbox.pending()
+    for topic, _ in pending:
+        inbox.mark_handled(topic)
+    inbox.save()
+    return pending
+
+
+def test_only_new_posts_are_dispatched(fake_discourse, fake_discourse_client):
+    bot = fake_discourse.username
+    topic = fake_discourse.create_topic(
+        "Frage", "Hallo?", username="alice", recipients=[bot]
+    )
+
+    pending = handle_all(fake_discourse_client)
+    assert [t["id"] for t, _ in pending] == [topic.id]
+    assert pending[0][1]["post_stream"]["posts"][-1]["cooked"] == "<p>Hallo?</p>"
+
+    # Handled without an answer, e.g. a voucher code
+    fake_discourse.requests.clear()
+    assert handle_all(fake_discourse_client) == []
+    assert fake_discourse.request_count("GET", f"/t/{topic.id}/posts.json") == 0
+
+    fake_discourse.create_post(topic.id, "Nochmal hallo?", "alice")
+    pending = handle_all(fake_discourse_client)
+    assert [t["id"] for t, _ in pending] == [topic.id]
+    assert (
+        pending[0][1]["post_stream"]["posts"][-1]["cooked"] == "<p>Nochmal hallo?</p>"
+    )
+
+    fake_discourse.create_post(topic.id, "Hallo!", bot)
+    assert handle_all(fake_discourse_client) == []
+
+    state = fake_discourse_client.storage.get(INBOX_STORAGE_KEY)
+    assert state["handled"][topic.id] == 3
+
+
+def test_unhandled_topics_are_retried(fake_discourse, fake_discourse_client):
+    bot = fake_discourse.username
+    first = fake_discourse.create_topic("Eins", "1", username="alice", recipients=[bot])
+    second = fake_discourse.create_topic("Zwei", "2", username="bob", recipients=[bot])
+
+    inbox = InboxSync(fake_discourse_client)
+    pending = inbox.pending()
+    assert [t["id"] for t, _ in pending] == [first.id, second.id]
+    # The handler of the second topic failed
+    inbox.mark_handled(pending[0][0])
+    inbox.save()
+
+    pending = handle_all(fake_discourse_client)
+    assert [t["id"] for t, _ in pending] == [second.id]
+
+
+def test_handled_posts_of_quiet_topics_are_kept(
+    fake_discourse, fake_discourse_client, mocker
+):
+    bot = fake_discourse.username
+    quiet = fake_discourse.create_topic("Eins", "1", username="alice", recipients=[bot])
+    handle_all(fake_discourse_client)
+    busy = fake_discourse.create_topic("Zwei", "2", username="bob", recipients=[bot])
+    handle_all(fake_discourse_client)
+
+    # The first conversation wasn't listed by the second sync
+    state = fake_discourse_client.storage.get(INBOX_STORAGE_KEY)
+    assert state["handled"][quiet.id] == 1
+    assert state["handled"][busy.id] == 1
+
+    mocker.patch("inbox.MAX_HANDLED_TOPICS", 1)
+    fake_discourse.create_post(busy.id, "Noch was", "bob")
+    handle_all(fake_discourse_client)
+    state = fake_discourse_client.storage.get(INBOX_STORAGE_KEY)
+    assert state["handled"] == {busy.id: 2}
+
+
+def test_unchanged_state_is_not_written(fake_discourse, fake_discourse_client):
+    handle_all(fake_discourse_client)
+    handle_all(fake_discourse_client)
+
+    assert fake_discourse.request_count("POST", "/posts") == 0
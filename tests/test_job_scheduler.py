@@ -0,0 +1,107 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytz
+
+from job_scheduler import JobScheduler
+
+BERLIN = pytz.timezone("Europe/Berlin")
+
+
+class Clock:
+    def __init__(self, now: datetime):
+        self.now = now
+
+    def __call__(self) -> datetime:
+        return self.now
+
+    def advance(self, **kwargs) -> None:
+        self.now += timedelta(**kwargs)
+
+
+def test_interval_jobs_run_in_order():
+    clock = Clock(datetime(2024, 11, 1, 12, tzinfo=pytz.utc))
+    scheduler = JobScheduler(clock=clock)
+    calls = []
+    scheduler.every(timedelta(minutes=1), calls.append, "minute")
+    scheduler.every(timedelta(hours=1), calls.append, "hour")
+
+    assert scheduler.wait_time() == 60
+    assert scheduler.run_pending() == 0
+    clock.advance(minutes=1)
+    assert scheduler.run_pending() == 1
+    scheduler.join()
+    clock.advance(minutes=59)
+    assert scheduler.run_pending() == 2
+    scheduler.join()
+    assert calls == ["minute", "minute", "hour"]
+    assert scheduler.wait_time() == 60
+
+
+def test_daily_jobs_use_the_wall_clock_of_the_timezone():
+    # The day before the switch to winter time
+    clock = Clock(BERLIN.localize(datetime(2024, 10, 26, 14)))
+    scheduler = JobScheduler(clock=clock)
+    job = scheduler.daily("13:37", print)
+
+    assert job.next_run == BERLIN.localize(datetime(2024, 10, 27, 13, 37))
+    assert job.next_run.astimezone(pytz.utc).hour == 12
+    clock.now = job.next_run
+    scheduler.run_pending()
+    scheduler.join()
+    assert job.next_run == BERLIN.localize(datetime(2024, 10, 28, 13, 37))
+
+
+def test_lateness_and_failures_are_reported(caplog):
+    clock = Clock(datetime(2024, 11, 1, 12, tzinfo=pytz.utc))
+    scheduler = JobScheduler(clock=clock)
+
+    def failing():
+        clock.advance(seconds=5)
+        raise ValueError
+
+    scheduler.every(timedelta(minutes=1), failing)
+    clock.advance(minutes=3, seconds=10)
+    assert scheduler.run_pending() == 1
+    scheduler.join()
+
+    stats = scheduler.stats()[f"{__name__}.failing"]
+    assert stats["failures"] == 1
+    assert stats["lateness_seconds"] == 130
+    assert stats["run_seconds"] == 5
+    assert "started 130.0s late" in caplog.text
+    # Missed runs are skipped
+    assert scheduler.jobs[0].next_run == datetime(2024, 11, 1, 12, 4, tzinfo=pytz.utc)
+
+
+def test_jobs_overlap_unless_they_share_a_resource():
+    clock = Clock(datetime(2024, 11, 1, 12, tzinfo=pytz.utc))
+    scheduler = JobScheduler(clock=clock)
+    imap_started, release = threading.Event(), threading.Event()
+    events = []
+
+    def fetch_mails():
+        imap_started.set()
+        assert release.wait(5)
+        events.append("mails")
+
+    def update_voucher(name):
+        events.append(name)
+
+    scheduler.every(timedelta(minutes=1), fetch_mails, resources=["imap", "voucher"])
+    scheduler.every(timedelta(minutes=1), update_voucher, "other", resources=["log"])
+    scheduler.every(timedelta(minutes=1), update_voucher, "same", resources=["voucher"])
+    clock.advance(minutes=1)
+    assert scheduler.run_pending() == 3
+    assert imap_started.wait(5)
+    # Only the job without a shared resource ran while the mails are fetched
+    scheduler.join(timeout=0.2)
+    assert events == ["other"]
+
+    # A job still running skips its next run
+    clock.advance(minutes=1)
+    assert scheduler.run_pending() == 1
+    release.set()
+    scheduler.join()
+    assert events == ["other", "other", "mails", "same"]
+    scheduler.shutdown()
@@ -0,0 +1,81 @@
+import pytest
+
+from metrics import RequestMetrics, endpoint_label, request_metrics
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("/t/123/posts.json", "/t/{id}/posts.json"),
+        ("/posts/42", "/posts/{id}"),
+        ("/posts/42.json?post_ids[]=1", "/posts/{id}.json"),
+        ("/c/ccc.json", "/c/ccc.json"),
+        ("/search.json", "/search.json"),
+    ],
+)
+def test_endpoint_label(path, expected):
+    assert endpoint_label(path) == expected
+
+
+def test_track_counts_errors():
+    metrics = RequestMetrics()
+
+    with metrics.track("imap", "login") as call:
+        call.status = "OK"
+    with pytest.raises(ConnectionError):
+        with metrics.track("imap", "login"):
+            raise ConnectionError()
+
+    stats = metrics.snapshot()[("imap", "login")]
+    assert stats.count == 2
+    assert stats.errors == 1
+    assert stats.status_codes == {"OK": 1}
+
+
+def test_render_prometheus_text():
+    metrics = RequestMetrics()
+    metrics.observe(
+        "discourse",
+        "GET /t/{id}/posts.json",
+        0.25,
+        status=200,
+        bytes_received=100,
+    )
+
+    text = metrics.render(gauges={"response_cache_hits": 3})
+
+    assert "# TYPE forumbot_requests_total counter" in text
+    labels = 'system="discourse",endpoint="GET /t/{id}/posts.json"'
+    assert f"forumbot_requests_total{{{labels}}} 1" in text
+    assert f"forumbot_request_seconds_total{{{labels}}} 0.25" in text
+    assert f"forumbot_request_bytes_received_total{{{labels}}} 100" in text
+    assert f'forumbot_responses_total{{{labels},status="200"}} 1' in text
+    assert "forumbot_response_cache_hits 3" in text
+
+
+def test_write_metrics_file(tmp_path):
+    metrics = RequestMetrics()
+    metrics.observe("pad", "POST /new", 1.0, status=200)
+    path = tmp_path / "forumbot.prom"
+
+    metrics.write(path)
+
+    assert path.read_text() == metrics.render()
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_discourse_requests_are_tracked(dummy_storage_client, responses):
+    responses.add(
+        responses.GET,
+        "https://discourse.example.com/t/7/posts.json",
+        json={"post_stream": {"posts": []}},
+        content_type="application/json; charset=utf-8",
+    )
+    request_metrics.reset()
+
+    dummy_storage_client.topic_posts(7)
+
+    stats = request_metrics.snapshot()[("discourse", "GET /t/{id}/posts.json")]
+    assert stats.count == 1
+    assert stats.status_codes == {"200": 1}
+    assert stats.bytes_received == len(responses.calls[0].response.content)
@@ -0,0 +1,83 @@
+from datetime import date, datetime
+
+import pytest
+import pytz
+import yaml
+
+from storage_codecs import (
+    CODECS,
+    StorageCodec,
+    UnknownFormatError,
+    YamlCodec,
+    decode,
+    encode,
+)
+
+VALUE = {
+    "voucher": [
+        {
+            "voucher": "CHAOSÄ1",
+            "owner": "alice",
+            "received_at": datetime(2024, 11, 1, 10, tzinfo=pytz.utc),
+            "history": [{"username": "alice", "received_at": "2024-11-01T10:00:00"}],
+        }
+    ],
+    "voucher_phase_range": {"38C3": {"start": date(2024, 12, 1)}},
+    "handled": {123: 4, 456: 7},
+    "total_persons_reported": None,
+}
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_roundtrip(codec):
+    document = encode(VALUE, codec)
+
+    assert document.startswith(f"#storage-format: {codec}/1\n")
+    assert decode(document) == VALUE
+    assert encode(decode(document), codec) == document
+
+
+def test_yaml_documents_stay_readable_without_header():
+    legacy = yaml.safe_dump(VALUE)
+
+    assert decode(legacy) == VALUE
+    # The header is a YAML comment
+    assert yaml.safe_load(encode(VALUE, "yaml")) == VALUE
+
+
+def test_libyaml_and_pure_python_yaml_agree():
+    assert YamlCodec(use_libyaml=False).dumps(VALUE) == yaml.safe_dump(VALUE)
+    assert YamlCodec().dumps(VALUE) == yaml.safe_dump(VALUE)
+
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_compressed_roundtrip(codec):
+    value = {**VALUE, "queue": [f"user{i}" for i in range(500)]}
+    document = encode(value, codec, compress=True)
+    header, fence, *lines, closing_fence, end = document.split("\n")
+
+    assert header == f"#storage-format: {codec}/1+zlib"
+    assert fence == closing_fence and set(fence) == {"`"} and end == ""
+    assert all(fence not in line for line in lines)
+    assert len(document) < len(encode(value, codec)) / 3
+    assert decode(document) == value
+
+
+def test_unknown_format():
+    with pytest.raises(UnknownFormatError):
+        decode("#storage-format: msgpack/1\n...")
+    with pytest.raises(UnknownFormatError):
+        decode("#storage-format: json/2\n{}")
+    with pytest.raises(UnknownFormatError):
+        decode("#storage-format: json/1+lzma\n{}")
+
+
+def test_incomplete_codec_cannot_be_created():
+    class WriteOnlyCodec(StorageCodec):
+        name = "write-only"
+
+        def dumps(self, value) -> str:
+            return ""
+
+    with pytest.raises(TypeError):
+        WriteOnlyCodec()
@@ -0,0 +1,42 @@
+import copy
+
+import pytest
+
+from storage_journal import apply, diff
+
+OLD = {
+    "queue": ["alice", "bob"],
+    "demand": {"alice": 1, "bob": 2},
+    "voucher": [{"voucher": "CHAOS1", "owner": None, "history": []}],
+    "handled": {123: 4},
+}
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        lambda d: d["voucher"][0]["history"].append({"username": "alice"}),
+        lambda d: d["voucher"][0].update(owner="alice"),
+        lambda d: d["queue"].pop(0),
+        lambda d: d["demand"].pop("bob"),
+        lambda d: d["handled"].update({456: 7}),
+        lambda d: d.update(total_persons_reported=3),
+        lambda d: d.clear(),
+    ],
+)
+def test_roundtrip(change):
+    new = copy.deepcopy(OLD)
+    change(new)
+
+    assert apply(copy.deepcopy(OLD), diff(OLD, new)) == new
+
+
+def test_diff_is_small():
+    new = copy.deepcopy(OLD)
+    new["voucher"][0]["history"].append({"username": "alice"})
+
+    assert diff(OLD, new) == [
+        ["extend", ["voucher", 0, "history"], [{"username": "alice"}]]
+    ]
+    assert diff(OLD, OLD) == []
+    assert apply(OLD, [["set", [], []]]) == []
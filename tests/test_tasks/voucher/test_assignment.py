@@ -1,8 +1,11 @@
 import freezegun
 from datetime import datetime, timedelta
 
+import pytest
 import pytz
+from requests import HTTPError
 
+import tasks.voucher
 from tasks.voucher import process_voucher_distribution, private_message_handler
 
 
@@ -558,3 +561,23 @@ def test_complex_demand_and_queue_replenishment(mocker, dummy_storage_client):
 
     # Demand should be decreased
     assert final_storage["demand"] == {"alice": 1, "bob": 1, "dan": 2}
+
+
+@freezegun.freeze_time("2024-11-01 12:00:00")
+def test_distribution_is_saved_before_the_topic_update(mocker, dummy_storage_client):
+    dummy_storage_client.storage.put(
+        "voucher",
+        {"voucher": [], "queue": [], "demand": {}, "voucher_topics": {"38C3": 5}},
+    )
+
+    def distribute(client):
+        with client.storage.transaction("voucher") as data:
+            data["queue"].append("alice")
+
+    mocker.patch.object(tasks.voucher, "process_voucher_distribution", distribute)
+    mocker.patch.object(dummy_storage_client, "topic_posts", side_effect=HTTPError)
+
+    with pytest.raises(HTTPError):
+        tasks.voucher.main(dummy_storage_client)
+
+    assert dummy_storage_client.storage.get("voucher")["queue"] == ["alice"]
@@ -1,4 +1,8 @@
-from tasks.voucher import handle_private_message_bedarf, private_message_handler
+from tasks.voucher import (
+    handle_private_message_bedarf,
+    handle_voucher_thread_post,
+    private_message_handler,
+)
 from datetime import datetime
 import pytz
 from freezegun import freeze_time
@@ -207,3 +211,80 @@ def test_offered_to_cleared_on_acceptance(dummy_storage_client, mocker):
     # offered_to should be cleared
     assert updated_data["voucher"][0]["offered_to"] == []
     assert updated_data["voucher"][0]["owner"] == "alice"
+
+
+def test_only_changed_voucher_threads_are_fetched(dummy_storage_client, mocker):
+    """
+    Threads whose highest post number in the PM list did not grow since the last check are skipped.
+    """
+    mocker.patch.object(dummy_storage_client, "create_post")
+    mocker.patch.object(
+        dummy_storage_client,
+        "private_messages",
+        return_value={
+            "topic_list": {
+                "topics": [
+                    {"id": 1, "highest_post_number": 2},
+                    {"id": 2, "highest_post_number": 3},
+                ]
+            }
+        },
+    )
+    mock_client_posts = mocker.patch.object(
+        dummy_storage_client,
+        "posts",
+        return_value={
+            "post_stream": {"posts": [{"username": "bob", "cooked": "Danke!"}]}
+        },
+    )
+
+    def assigned_voucher(index, owner, message_id, checked_post_number=None):
+        voucher = {
+            "index": index,
+            "voucher": f"CHAOS{index}",
+            "owner": owner,
+            "message_id": message_id,
+            "history": [{"username": owner, "received_at": "2024-01-01T09:00:00"}],
+        }
+        if checked_post_number:
+            voucher["checked_post_number"] = checked_post_number
+        return voucher
+
+    dummy_storage_client.storage.put(
+        "voucher",
+        {
+            "voucher": [
+                # unchanged since the last check
+                assigned_voucher(0, "alice", 1, checked_post_number=2),
+                # got a new post
+                assigned_voucher(1, "bob", 2, checked_post_number=2),
+                # not in the PM list, so we have to look
+                assigned_voucher(2, "carol", 3),
+            ],
+            "queue": [],
+            "demand": {},
+        },
+    )
+
+    with freeze_time("2024-01-01 10:00:00+01:00"):
+        process_voucher_distribution(dummy_storage_client)
+
+    assert sorted(c.args[0] for c in mock_client_posts.call_args_list) == [2, 3]
+    vouchers = dummy_storage_client.storage.get("voucher")["voucher"]
+    assert vouchers[0]["checked_post_number"] == 2
+    assert vouchers[1]["checked_post_number"] == 3
+    assert "checked_post_number" not in vouchers[2]
+
+
+def test_voucher_thread_post_runs_the_distribution(dummy_storage_client, mocker):
+    distribution = mocker.patch("tasks.voucher.process_voucher_distribution")
+    dummy_storage_client.storage.put(
+        "voucher",
+        {"voucher": [{"index": 0, "message_id": 7}, {"index": 1, "message_id": None}]},
+    )
+
+    assert handle_voucher_thread_post(dummy_storage_client, 7)
+    distribution.assert_called_once_with(dummy_storage_client)
+
+    assert not handle_voucher_thread_post(dummy_storage_client, 8)
+    distribution.assert_called_once()
@@ -0,0 +1,88 @@
+import http.client
+import json
+
+import pytest
+import requests
+
+from webhooks import WebhookEvent, WebhookServer, sign, verify_signature
+
+SECRET = "webhook-secret"
+
+
+@pytest.fixture
+def webhook_server(responses):
+    server = WebhookServer("127.0.0.1", 0, SECRET)
+    server.start()
+    url = f"http://127.0.0.1:{server.server_port}/"
+    responses.add_passthru(url)
+    yield server, url
+    server.stop()
+
+
+def post_event(url, event, payload, secret=SECRET):
+    body = json.dumps(payload).encode()
+    return requests.post(
+        url,
+        data=body,
+        headers={
+            "X-Discourse-Event": event,
+            "X-Discourse-Event-Signature": sign(secret, body),
+        },
+    )
+
+
+def test_verify_signature():
+    body = b'{"post": {}}'
+
+    assert verify_signature(SECRET, body, sign(SECRET, body))
+    assert not verify_signature(SECRET, body, sign("other", body))
+    assert not verify_signature(SECRET, body, None)
+
+
+def test_signed_events_are_queued(webhook_server):
+    server, url = webhook_server
+    payload = {"post": {"topic_id": 5, "username": "alice"}}
+
+    assert post_event(url, "post_created", payload).status_code == 200
+    assert post_event(url, "post_edited", payload).status_code == 200
+
+    events = []
+    assert server.handle_pending(events.append, timeout=1) == 1
+    assert events == [WebhookEvent("post_created", payload)]
+
+
+def test_invalid_signature_is_rejected(webhook_server):
+    server, url = webhook_server
+
+    response = post_event(url, "post_created", {"post": {}}, secret="guessed")
+
+    assert response.status_code == 403
+    assert server.handle_pending(lambda event: None) == 0
+
+
+def test_failing_handler_does_not_stop_others(webhook_server):
+    server, url = webhook_server
+    post_event(url, "topic_created", {"topic": {"id": 1}})
+    post_event(url, "topic_created", {"topic": {"id": 2}})
+
+    handled = []
+
+    def handler(event):
+        handled.append(event.payload["topic"]["id"])
+        raise ValueError
+
+    assert server.handle_pending(handler, timeout=1) == 2
+    assert handled == [1, 2]
+
+
+@pytest.mark.parametrize("length, status", [(None, 411), ("-1", 400), ("x", 400)])
+def test_invalid_content_length_is_rejected(webhook_server, length, status):
+    server, url = webhook_server
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+    connection.putrequest("POST", "/")
+    if length is not None:
+        connection.putheader("Content-Length", length)
+    connection.endheaders()
+
+    assert connection.getresponse().status == status
+    connection.close()